@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+"""
+Measure how collection scales with the size of the monitor tree.
+
+The LDAP connections are replaced with an in-process stand-in serving
+a synthetic tree, and the real path is driven: the configuration and
+its transformer chain, then the collection of every metric set.  The
+results are written as JSON, one record per tree size, so they can be
+compared across releases.
+
+    python3 -m benchmarks.collection --entries 10 1000 50000 --output results.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+import ldap.ldapobject
+import yaml
+
+from benchmarks.fake_ldap import FakeLDAPObject, monitor_tree, SYNC_BASE_DN
+from openldap_opencensus_stats.collector import CollectionEngine
+from openldap_opencensus_stats.configuration import Configuration
+from openldap_opencensus_stats.ldap_server import LdapServerPool
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description='Benchmark the collection of statistics.')
+    parser.add_argument('--entries', type=int, nargs='+', default=[10, 100, 1000, 10000, 50000],
+                        help='Sizes of the synthetic monitor trees')
+    parser.add_argument('--servers', type=int, default=2, help='Number of LDAP servers')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds before each reply is ready')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Probability of each request failing')
+    parser.add_argument('--cycles', type=int, default=20, help='Collection cycles to time')
+    parser.add_argument('--output', help='File to write the JSON results to, instead of standard output')
+    return parser.parse_args()
+
+
+def benchmark_configuration(servers):
+    names = [f'ldap{index}' for index in range(1, servers + 1)]
+    return {
+        'ldapServers': [
+            {'database': name, 'connection': {'serverUri': f'ldap://{name}.example.org/', 'timeout': 5}}
+            for name in names
+        ],
+        'sync': {SYNC_BASE_DN: {'clusterServers': names, 'reportServers': names}},
+        'object': {
+            'Monitor': {
+                'rdn': 'cn=Monitor',
+                'object': {
+                    'database': {
+                        'rdn': 'cn=Databases',
+                        'object': {
+                            'children': {
+                                'rdn': 'cn=Database ([0-9]+)',
+                                'name': '{attr.monitoredInfo}{rdn.1}',
+                                'metric': {
+                                    'max_database_size': {'attribute': 'olmMDBPagesMax', 'unit': 'By'},
+                                    'used_database_size': {'attribute': 'olmMDBPagesUsed', 'unit': 'By'},
+                                },
+                            },
+                        },
+                    },
+                    'operations': {
+                        'rdn': 'cn=Operations',
+                        'object': {
+                            'children': {
+                                'rdn': 'cn=(.*)',
+                                'name': '{rdn.1}',
+                                'metric': {
+                                    'initiated': {'attribute': 'monitorOpInitiated', 'unit': '1'},
+                                    'completed': {'attribute': 'monitorOpCompleted', 'unit': '1'},
+                                },
+                            },
+                        },
+                    },
+                    'statistics': {
+                        'rdn': 'cn=Statistics',
+                        'object': {
+                            'children': {
+                                'rdn': 'cn=(.*)',
+                                'name': '{rdn.1}',
+                                'metric': {
+                                    'count': {'attribute': 'monitorCounter', 'unit': '1', 'func': 'value * 64'},
+                                },
+                            },
+                        },
+                    },
+                },
+            },
+        },
+    }
+
+
+def run(entries, args, config_file_name):
+    tree = monitor_tree(entries)
+    LdapServerPool._ldap_servers.clear()
+    ldap.ldapobject.ReconnectLDAPObject = lambda uri: FakeLDAPObject(
+        uri, tree=tree, latency=args.latency, failure_rate=args.failure_rate
+    )
+
+    tracemalloc.start()
+    start = perf_counter()
+    # The configuration chain reports its progress on standard output
+    with contextlib.redirect_stdout(sys.stderr):
+        configuration = Configuration(config_file_name)
+    startup = perf_counter() - start
+
+    metric_sets = configuration.metric_sets()
+    engine = CollectionEngine(max_workers=configuration.max_workers())
+    cycles = []
+    late = 0
+    for _ in range(args.cycles):
+        start = perf_counter()
+        late += len(engine.collect(metric_sets))
+        cycles.append(perf_counter() - start)
+    current_memory, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    cycles.sort()
+    return {
+        'entries': len(tree),
+        'servers': args.servers,
+        'latency': args.latency,
+        'failure_rate': args.failure_rate,
+        'metric_sets': len(metric_sets),
+        'startup_seconds': startup,
+        'cycles': len(cycles),
+        'cycle_seconds': {
+            'mean': statistics.mean(cycles),
+            'p50': cycles[len(cycles) // 2],
+            'p95': cycles[min(len(cycles) - 1, int(len(cycles) * 0.95))],
+            'max': cycles[-1],
+        },
+        'late_metric_sets': late,
+        'peak_memory_bytes': peak_memory,
+    }
+
+
+def main():
+    args = parse_command_line()
+    with tempfile.NamedTemporaryFile('w', suffix='.yml', delete=False) as config_file:
+        yaml.safe_dump(benchmark_configuration(args.servers), config_file)
+    try:
+        results = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': [run(entries, args, config_file.name) for entries in args.entries],
+        }
+    finally:
+        os.unlink(config_file.name)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/python3
+"""
+Compare the CSN parser with decoding and parsing each contextCSN value
+with `datetime.strptime`, as SyncMetricSet used to.
+
+    python3 -m benchmarks.csn
+"""
+import argparse
+import timeit
+from datetime import datetime, timedelta
+
+from openldap_opencensus_stats.csn import parse_csn
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description='Benchmark the CSN parser.')
+    parser.add_argument('--samples', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    return parser.parse_args()
+
+
+def strptime_csn(value):
+    segments = value.decode('utf-8').split('#')
+    return str(int(segments[2], 16)), datetime.strptime(segments[0], '%Y%m%d%H%M%S.%fZ')
+
+
+def main():
+    args = parse_command_line()
+    start = datetime(2023, 1, 1)
+    values = [
+        f"{(start + timedelta(microseconds=index * 1013)).strftime('%Y%m%d%H%M%S.%f')}Z#000000#{index % 4:03x}#000000".encode()
+        for index in range(args.samples)
+    ]
+    timings = {
+        'strptime': lambda: [strptime_csn(value) for value in values],
+        'parse_csn': lambda: [parse_csn.__wrapped__(value) for value in values],
+        'parse_csn cached': lambda: [parse_csn(values[0]) for _ in values],
+    }
+    print(f"{'parser':<20}{'ns':>10}")
+    for name, timing in timings.items():
+        print(f"{name:<20}{min(timeit.repeat(timing, number=1, repeat=args.repeat)) / args.samples * 1e9:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
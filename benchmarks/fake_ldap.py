@@ -0,0 +1,218 @@
+"""
+An in-process stand-in for `ldap.ldapobject.ReconnectLDAPObject`, serving
+a synthetic `cn=Monitor` tree of a chosen size.
+"""
+import itertools
+import random
+import re
+import threading
+from datetime import datetime, timezone
+from time import monotonic, sleep
+
+import ldap
+import ldap.controls
+
+SYNC_BASE_DN = 'dc=example,dc=org'
+DATABASES = 4
+OPERATIONS = ['Bind', 'Unbind', 'Search', 'Compare', 'Modify', 'Modrdn', 'Add', 'Delete', 'Abandon', 'Extended']
+STATISTICS = ['Bytes', 'PDU', 'Referrals', 'Entries']
+
+
+def monitor_tree(entries=1000, rids=3, databases=DATABASES):
+    """
+    Build a monitor tree of about `entries` entries, as a mapping from
+    DN to attributes.  The databases, operations and statistics the
+    benchmark configuration reads always exist; the remaining entries
+    are connections, which the configuration does not read.  Each
+    database is a `children` expansion of the configuration.
+    """
+    counter = iter(range(1, 1 << 30))
+
+    def value():
+        return [str(next(counter)).encode()]
+
+    tree = {
+        'cn=Monitor': {'monitoredInfo': [b'OpenLDAP']},
+        'cn=Databases,cn=Monitor': {},
+        'cn=Operations,cn=Monitor': {},
+        'cn=Statistics,cn=Monitor': {},
+        'cn=Connections,cn=Monitor': {},
+    }
+    for index in range(databases):
+        tree[f'cn=Database {index},cn=Databases,cn=Monitor'] = {
+            'monitoredInfo': [b'mdb'],
+            'olmMDBPagesMax': value(),
+            'olmMDBPagesUsed': value(),
+        }
+    for operation in OPERATIONS:
+        tree[f'cn={operation},cn=Operations,cn=Monitor'] = {
+            'monitorOpInitiated': value(),
+            'monitorOpCompleted': value(),
+        }
+    for statistic in STATISTICS:
+        tree[f'cn={statistic},cn=Statistics,cn=Monitor'] = {'monitorCounter': value()}
+    index = 0
+    while len(tree) < entries:
+        tree[f'cn=Connection {index},cn=Connections,cn=Monitor'] = {
+            'monitorConnectionNumber': [str(index).encode()],
+            'monitorConnectionOpsReceived': value(),
+        }
+        index += 1
+
+    now = datetime.now(timezone.utc)
+    tree[SYNC_BASE_DN] = {
+        'contextCSN': [
+            f"{now.strftime('%Y%m%d%H%M%S.%f')}Z#000000#{rid:03x}#000000".encode()
+            for rid in range(1, rids + 1)
+        ]
+    }
+    return tree
+
+
+class FakeLDAPObject:
+    """
+    Answers searches from a synthetic tree.  Every reply is ready
+    `latency` seconds after its request was sent, so pipelined searches
+    overlap as they would against a real server, and each request
+    fails with SERVER_DOWN with probability `failure_rate`.  Replies are
+    read whole, or an entry at a time, and searches with the Simple
+    Paged Results control are answered a page at a time.
+    """
+    def __init__(self, uri, tree=None, latency=0.0, failure_rate=0.0):
+        self.uri = uri
+        self.timeout = -1
+        self.protocol_version = ldap.VERSION3
+        self._tree = tree if tree is not None else monitor_tree()
+        self._dns = dict((normalize(dn), dn) for dn in self._tree)
+        self._children = {}
+        for dn in self._dns:
+            self._children.setdefault(dn.partition(',')[2], []).append(dn)
+        self._latency = latency
+        self._failure_rate = failure_rate
+        self._pending = {}
+        # The rest of the replies being read an entry at a time
+        self._streams = {}
+        self._msgid = 0
+        self._lock = threading.Lock()
+
+    def set_option(self, option, value):
+        pass
+
+    def start_tls_s(self):
+        pass
+
+    def simple_bind_s(self, who=None, cred=None):
+        self.fail_randomly()
+
+    def sasl_external_bind_s(self):
+        self.fail_randomly()
+
+    def whoami_s(self):
+        self.fail_randomly()
+        return ''
+
+    def unbind_s(self):
+        pass
+
+    def fail_randomly(self):
+        if self._failure_rate and random.random() < self._failure_rate:
+            raise ldap.SERVER_DOWN({'desc': "Can't contact LDAP server (simulated)"})
+
+    def search_s(self, base, scope, filterstr='(objectClass=*)', attrlist=None):
+        msgid = self.search_ext(base, scope, filterstr=filterstr, attrlist=attrlist)
+        return self.result3(msgid)[1]
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)', attrlist=None, serverctrls=None):
+        self.fail_randomly()
+        page = next(
+            (
+                control for control in serverctrls or []
+                if control.controlType == ldap.controls.SimplePagedResultsControl.controlType
+            ),
+            None
+        )
+        with self._lock:
+            self._msgid += 1
+            self._pending[self._msgid] = (monotonic() + self._latency, base, scope, filterstr, attrlist, page)
+            return self._msgid
+
+    def result3(self, msgid, all=1, timeout=-1):
+        if msgid in self._streams:
+            return self.next_message(msgid)
+        ready, base, scope, filterstr, attrlist, page = self._pending.pop(msgid)
+        delay = ready - monotonic()
+        if timeout is not None and 0 <= timeout < delay:
+            sleep(timeout)
+            raise ldap.TIMEOUT({'desc': 'Timed out (simulated)'})
+        if delay > 0:
+            sleep(delay)
+        self.fail_randomly()
+        entries = self.search(base, scope, filterstr, attrlist)
+        controls = []
+        if page is not None and page.size:
+            offset = int(page.cookie or 0)
+            entries = itertools.islice(entries, offset, None)
+            entries, rest = list(itertools.islice(entries, page.size)), next(entries, None)
+            cookie = str(offset + page.size).encode() if rest is not None else b''
+            controls = [ldap.controls.SimplePagedResultsControl(criticality=False, size=0, cookie=cookie)]
+        if all:
+            return ldap.RES_SEARCH_RESULT, list(entries), msgid, controls
+        self._streams[msgid] = (iter(entries), controls)
+        return self.next_message(msgid)
+
+    def next_message(self, msgid):
+        entries, controls = self._streams[msgid]
+        entry = next(entries, None)
+        if entry is None:
+            del self._streams[msgid]
+            return ldap.RES_SEARCH_RESULT, [], msgid, controls
+        return ldap.RES_SEARCH_ENTRY, [entry], msgid, []
+
+    def abandon(self, msgid):
+        self._pending.pop(msgid, None)
+        self._streams.pop(msgid, None)
+
+    def search(self, base, scope, filterstr, attrlist):
+        base = normalize(base)
+        if base not in self._dns:
+            raise ldap.NO_SUCH_OBJECT({'desc': 'No such object (simulated)', 'matched': ''})
+        if scope == ldap.SCOPE_BASE:
+            dns = [base]
+        elif scope == ldap.SCOPE_ONELEVEL:
+            dns = self._children.get(base, [])
+        else:
+            dns = [base]
+            index = 0
+            while index < len(dns):
+                dns.extend(self._children.get(dns[index], []))
+                index += 1
+
+        wanted = entry_dns(filterstr)
+        if wanted is not None:
+            dns = [dn for dn in dns if dn in wanted]
+        # Each entry is built as it is read, as a server sends them
+        return ((self._dns[dn], project(self._tree[self._dns[dn]], attrlist)) for dn in dns)
+
+
+def normalize(dn):
+    return ','.join(rdn.strip() for rdn in dn.split(',')).lower()
+
+
+def entry_dns(filterstr):
+    """
+    Return the DNs named by an entryDN filter, or None for any other filter.
+    """
+    matches = re.findall(r'\(entryDN=((?:[^()\\]|\\[0-9a-fA-F]{2})*)\)', filterstr or '')
+    if not matches:
+        return None
+    return set(
+        normalize(re.sub(r'\\([0-9a-fA-F]{2})', lambda match: chr(int(match.group(1), 16)), dn))
+        for dn in matches
+    )
+
+
+def project(attributes, attrlist):
+    if not attrlist or '+' in attrlist or '*' in attrlist:
+        return dict(attributes)
+    wanted = set(attrlist)
+    return dict((name, value) for name, value in attributes.items() if name in wanted)
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+"""
+Drive the push pipeline against a local HTTP stand-in for a push
+endpoint, which is taken down for part of the run, and report what
+reached it: how many records, in how many batches, whether any were
+lost or sent twice, and how long the backlog took to drain.
+
+    python3 -m benchmarks.push --records 2000 --outage 2 --spool /tmp/push.spool
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep
+
+from openldap_opencensus_stats.push_pipeline import HttpSender, PushPipeline
+
+
+class Endpoint:
+    """
+    An HTTP stand-in which keeps the records it is sent, or answers
+    with errors while it is down.
+    """
+    def __init__(self):
+        self.up = True
+        self.records = []
+        self.batches = 0
+        self.refused = 0
+        self._lock = threading.Lock()
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                with endpoint._lock:
+                    if not endpoint.up:
+                        endpoint.refused += 1
+                        self.send_response(503)
+                        self.end_headers()
+                        return
+                    if self.headers.get('Content-Encoding') == 'gzip':
+                        body = gzip.decompress(body)
+                    endpoint.records.extend(body.decode().splitlines())
+                    endpoint.batches += 1
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description='Benchmark the push pipeline.')
+    parser.add_argument('--records', type=int, default=2000, help='Records to push')
+    parser.add_argument('--rate', type=float, default=1000, help='Records queued a second')
+    parser.add_argument('--outage', type=float, default=1, help='Seconds the endpoint is down, from a third of the run')
+    parser.add_argument('--queue-size', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--batch-interval', type=float, default=0.1)
+    parser.add_argument('--spool', help='Spool file to keep the batches in while the endpoint is down')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line()
+    logging.getLogger().setLevel(logging.ERROR)
+    if args.spool and os.path.exists(args.spool):
+        os.remove(args.spool)
+    endpoint = Endpoint()
+    pipeline = PushPipeline(
+        HttpSender(endpoint.url(), timeout=5),
+        queue_size=args.queue_size,
+        batch_size=args.batch_size,
+        batch_interval=args.batch_interval,
+        backoff=0.1,
+        max_backoff=1,
+        spool_file=args.spool
+    )
+
+    start = monotonic()
+    outage_from = args.records // 3
+    outage_until = None
+    for index in range(args.records):
+        if index == outage_from:
+            endpoint.up = False
+            outage_until = monotonic() + args.outage
+        if outage_until is not None and monotonic() >= outage_until:
+            endpoint.up = True
+            outage_until = None
+        pipeline.put(f"record {index}\n".encode())
+        sleep(1 / args.rate)
+    endpoint.up = True
+    queued = monotonic()
+    while pipeline.backlog() != (0, 0) and monotonic() - queued < 30:
+        sleep(0.01)
+    pipeline.close()
+    drained = monotonic()
+
+    received = [int(record.split()[1]) for record in endpoint.records if record]
+    json.dump({
+        'records': args.records,
+        'received': len(received),
+        'lost': args.records - len(set(received)),
+        'duplicated': len(received) - len(set(received)),
+        'in_order': received == sorted(received),
+        'batches': endpoint.batches,
+        'refused': endpoint.refused,
+        'queue_seconds': queued - start,
+        'drain_seconds': drained - queued,
+    }, sys.stdout, indent=2)
+    print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+"""
+Compare the cost of a scrape served by the OpenCensus Prometheus
+exporter, which builds every metric family for each scrape, with the
+payload the PrometheusText exporter renders once a collection cycle.
+
+    python3 -m benchmarks.scrape --series 100 1000 10000
+"""
+import argparse
+import gzip
+import timeit
+
+from opencensus.ext.prometheus import stats_exporter
+from opencensus.stats import aggregation, measure, stats, view
+from opencensus.tags import tag_key, tag_map, tag_value
+from prometheus_client import CollectorRegistry, generate_latest
+
+from openldap_opencensus_stats import instrumentation
+from openldap_opencensus_stats.text_exporter import PrometheusTextExporter
+
+# Make up for broken code in the Prometheus exporter, as the configuration does
+import opencensus.stats.aggregation_data
+opencensus.stats.aggregation_data.SumAggregationDataFloat = opencensus.stats.aggregation_data.SumAggregationData
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description='Benchmark the Prometheus scrapes.')
+    parser.add_argument('--series', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='Numbers of series to export')
+    parser.add_argument('--databases', type=int, default=4, help='Number of database tags of each view')
+    parser.add_argument('--scrapes', type=int, default=20, help='Scrapes to time')
+    return parser.parse_args()
+
+
+def record_views(views, series, databases):
+    """
+    Register and record views until there are enough to make up
+    `series` series.  The views stay registered, so each size adds to
+    the views of the last.
+    """
+    for index in range(len(views), max(series // databases, 1)):
+        name = f"benchmark/{index}/value"
+        stat_view = view.View(
+            name=name,
+            description='A benchmark statistic',
+            columns=['database'],
+            aggregation=aggregation.LastValueAggregation(),
+            measure=measure.MeasureFloat(name=name, description='A benchmark statistic', unit='1')
+        )
+        stats.stats.view_manager.register_view(stat_view)
+        views.append(stat_view)
+    for database in range(databases):
+        mmap = stats.stats.stats_recorder.new_measurement_map()
+        for index, stat_view in enumerate(views):
+            mmap.measure_float_put(stat_view.measure, index * 1.5)
+        tmap = tag_map.TagMap()
+        tmap.insert(tag_key.TagKey('database'), tag_value.TagValue(f'ldap{database}'))
+        instrumentation.record_measurements(mmap, tmap)
+
+
+def opencensus_scrape(views, compress):
+    registry = CollectorRegistry()
+    collector = stats_exporter.new_collector(stats_exporter.Options(namespace='openldap', registry=registry))
+    registry.register(collector)
+    for stat_view in views:
+        collector.add_view_data(stats.stats.view_manager.get_view(stat_view.name))
+
+    def scrape():
+        payload = generate_latest(registry)
+        return gzip.compress(payload) if compress else payload
+    return scrape
+
+
+def main():
+    args = parse_command_line()
+    print(f"{'series':>8}{'exporter':>28}{'scrape us':>12}{'scrapes/s':>12}{'bytes':>10}")
+    views = []
+    for series in sorted(args.series):
+        record_views(views, series, args.databases)
+        exporter = PrometheusTextExporter()
+        render = min(timeit.repeat(exporter.render, number=1, repeat=3))
+        timings = {
+            'OpenCensus': opencensus_scrape(views, False),
+            'OpenCensus gzip': opencensus_scrape(views, True),
+            'PrometheusText': lambda: exporter.payload()[0],
+            'PrometheusText gzip': lambda: exporter.payload('gzip')[0],
+        }
+        for name, scrape in timings.items():
+            seconds = min(timeit.repeat(scrape, number=1, repeat=args.scrapes))
+            print(f"{series:>8}{name:>28}{seconds * 1e6:>12.1f}{1 / seconds:>12.0f}{len(scrape()):>10}")
+        print(f"{series:>8}{'PrometheusText render':>28}{render * 1e6:>12.1f}{'':>12}{'':>10}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+"""
+Measure how start up scales with the number of children the
+configuration expands, and report the results as JSON.
+
+    python3 -m benchmarks.startup --databases 10 100 1000 --output startup.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import tracemalloc
+from time import perf_counter
+
+import ldap.ldapobject
+import yaml
+
+from benchmarks.collection import benchmark_configuration
+from benchmarks.fake_ldap import FakeLDAPObject, monitor_tree
+from openldap_opencensus_stats.configuration import Configuration
+from openldap_opencensus_stats.ldap_server import LdapServerPool
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description='Benchmark the start up.')
+    parser.add_argument('--databases', type=int, nargs='+', default=[10, 100, 1000, 5000],
+                        help='Numbers of database children in the synthetic monitor trees')
+    parser.add_argument('--servers', type=int, default=2, help='Number of LDAP servers')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds before each reply is ready')
+    parser.add_argument('--output', help='File to write the JSON results to, instead of standard output')
+    return parser.parse_args()
+
+
+def run(databases, args, config_file_name):
+    tree = monitor_tree(entries=0, databases=databases)
+    LdapServerPool._ldap_servers.clear()
+    ldap.ldapobject.ReconnectLDAPObject = lambda uri: FakeLDAPObject(uri, tree=tree, latency=args.latency)
+
+    tracemalloc.start()
+    start = perf_counter()
+    # The configuration chain reports its progress on standard output
+    with contextlib.redirect_stdout(sys.stderr):
+        configuration = Configuration(config_file_name)
+    startup = perf_counter() - start
+    current_memory, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'databases': databases,
+        'entries': len(tree),
+        'servers': args.servers,
+        'latency': args.latency,
+        'metric_sets': len(configuration.metric_sets()),
+        'startup_seconds': startup,
+        'peak_memory_bytes': peak_memory,
+    }
+
+
+def main():
+    args = parse_command_line()
+    with tempfile.NamedTemporaryFile('w', suffix='.yml', delete=False) as config_file:
+        yaml.safe_dump(benchmark_configuration(args.servers), config_file)
+    try:
+        results = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'results': [run(databases, args, config_file.name) for databases in args.databases],
+        }
+    finally:
+        os.unlink(config_file.name)
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
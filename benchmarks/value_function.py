@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+"""
+Compare the compiled value functions with evaluating the expression
+string for every sample, as LdapStatistic used to.
+
+    python3 -m benchmarks.value_function
+"""
+import argparse
+import timeit
+
+from openldap_opencensus_stats.value_function import VALUE_FUNCTION_NAMES, compile_value_function
+
+EXPRESSIONS = ['value', 'value * 64', 'max(value / MiB, 0) + 1']
+
+
+def parse_command_line():
+    parser = argparse.ArgumentParser(description='Benchmark the value functions.')
+    parser.add_argument('--samples', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    return parser.parse_args()
+
+
+def benchmark(expression, samples, repeat):
+    values = [float(index) for index in range(samples)]
+    # The unit constants are given to eval, as the old code had none
+    namespace = dict(VALUE_FUNCTION_NAMES)
+    eval_function = lambda value: eval(expression, namespace, {'value': value})  # noqa: E731
+    compiled_function = compile_value_function(expression)
+    timings = {
+        'eval': lambda: [eval_function(value) for value in values],
+        'compiled': lambda: [compiled_function(value) for value in values],
+        'batch': lambda: compiled_function.apply_many(values),
+    }
+    return dict(
+        (name, min(timeit.repeat(timing, number=1, repeat=repeat)) / samples * 1e9)
+        for name, timing in timings.items()
+    )
+
+
+def main():
+    args = parse_command_line()
+    print(f"{'expression':<28}{'eval ns':>10}{'compiled ns':>14}{'batch ns':>10}")
+    for expression in EXPRESSIONS:
+        result = benchmark(expression, args.samples, args.repeat)
+        print(f"{expression:<28}{result['eval']:>10.1f}{result['compiled']:>14.1f}{result['batch']:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+import logging
+
+from opencensus.stats import aggregation
+
+AGGREGATORS = ['LastValue', 'Count', 'Sum', 'Distribution']
+
+
+def create_aggregation(aggregator=None, buckets=None):
+    """
+    Create the aggregation named by the `aggregator` of a statistic.  A
+    distribution takes its bucket boundaries from `buckets`.
+    """
+    aggregator = aggregator or 'LastValue'
+    if aggregator == 'LastValue':
+        return aggregation.LastValueAggregation()
+    if aggregator == 'Count':
+        return aggregation.CountAggregation()
+    if aggregator == 'Sum':
+        return aggregation.SumAggregation()
+    if aggregator == 'Distribution':
+        if not isinstance(buckets, list) or not buckets:
+            logging.error('A Distribution aggregator needs a list of bucket boundaries in buckets')
+            raise ValueError('A Distribution aggregator needs a list of bucket boundaries in buckets')
+        boundaries = [float(boundary) for boundary in buckets]
+        if boundaries[0] <= 0 or any(low >= high for low, high in zip(boundaries, boundaries[1:])):
+            logging.error(f"Bucket boundaries must be positive and increasing, not {buckets}")
+            raise ValueError(f"Bucket boundaries must be positive and increasing, not {buckets}")
+        return aggregation.DistributionAggregation(boundaries)
+    logging.error(f"Unknown aggregator {aggregator}, choose from: {', '.join(AGGREGATORS)}")
+    raise ValueError(f"Unknown aggregator {aggregator}, choose from: {', '.join(AGGREGATORS)}")
+
+
+def same_aggregation(first, second):
+    return (
+        type(first) is type(second) and
+        getattr(first, '_boundaries', None) == getattr(second, '_boundaries', None)
+    )
@@ -0,0 +1,82 @@
+import logging
+import threading
+from time import monotonic
+
+
+class CircuitBreaker:
+    """
+    Stops an unreachable LDAP server from costing a timeout on every
+    collection.
+
+    After `failure_threshold` consecutive failures the circuit opens,
+    and requests are refused without touching the server for `backoff`
+    seconds.  Then a single trial request is let through: if it
+    succeeds the circuit closes, and if it fails the circuit opens
+    again for twice as long, up to `max_backoff` seconds.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=2, backoff=1, max_backoff=300):
+        if failure_threshold is None or failure_threshold < 1:
+            logging.error(f"The failure threshold must be at least 1, not {failure_threshold}")
+            raise ValueError(f"The failure threshold must be at least 1, not {failure_threshold}")
+        if backoff is None or backoff <= 0 or max_backoff is None or max_backoff < backoff:
+            logging.error(f"The backoff must be positive and at most the maximum backoff, "
+                          f"not {backoff} and {max_backoff}")
+            raise ValueError(f"The backoff must be positive and at most the maximum backoff, "
+                             f"not {backoff} and {max_backoff}")
+        self._failure_threshold = failure_threshold
+        self._initial_backoff = backoff
+        self._max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._backoff = backoff
+        self._open_until = 0
+
+    def state(self):
+        return self._state
+
+    def allow(self):
+        """
+        Whether a request may be sent to the server now.
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if monotonic() >= self._open_until:
+                # Only this request is let through until it has an outcome,
+                # or until another backoff passes without one
+                self._state = self.HALF_OPEN
+                self._open_until = monotonic() + self._backoff
+                return True
+            return False
+
+    def succeeded(self):
+        """
+        Record a successful request, and return whether the circuit was
+        failing until now.
+        """
+        with self._lock:
+            recovered = self._failures > 0
+            self._state = self.CLOSED
+            self._failures = 0
+            self._backoff = self._initial_backoff
+            return recovered
+
+    def failed(self):
+        """
+        Record a failed request, and return the seconds the circuit is
+        now open for, or None if it is still closed.
+        """
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN:
+                self._backoff = min(self._backoff * 2, self._max_backoff)
+            elif self._failures < self._failure_threshold:
+                return None
+            self._state = self.OPEN
+            self._open_until = monotonic() + self._backoff
+            return self._backoff
@@ -0,0 +1,153 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import monotonic
+
+
+class CollectionEngine:
+    """
+    Collects metric sets concurrently.
+
+    Metric sets are grouped by the LDAP server they query, and each
+    group is handed to one worker of a bounded thread pool.  A slow
+    or dead LDAP server therefore only delays the metric sets which
+    depend on it.
+
+    A collection cycle waits at most `deadline` seconds.  Groups that
+    are still running at that point are reported, and are skipped in
+    the following cycles until their outstanding collection finishes,
+    so a hung server never has more than one collection queued.
+
+    `on_collected` is called at the end of each cycle, once the metric
+    sets have been collected or have missed the deadline.
+
+    `dispatch` starts a cycle without waiting for it, for the scheduler,
+    so a hung server does not hold up the metric sets due after it.
+    """
+    def __init__(self, max_workers=8, on_collected=None):
+        if not max_workers or max_workers < 1:
+            logging.error(f"The collection engine requires at least one worker, not {max_workers}")
+            raise ValueError(f"The collection engine requires at least one worker, not {max_workers}")
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='collector')
+        # The running collection of each group, until it finishes
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self._on_collected = on_collected
+        self._collected_lock = threading.Lock()
+        # The due time, deadline and group of each dispatched collection
+        self._deadlines = {}
+
+    def collect(self, metric_sets, deadline=None):
+        """
+        Collect the metric sets, and return those which were skipped or
+        did not finish within the deadline.
+        """
+        futures, late = self.submit(metric_sets)
+        if not futures:
+            return late
+        done, not_done = wait(futures, timeout=deadline)
+        for future in not_done:
+            logging.warning(f"Collection for {display_names(futures[future])} missed the {deadline}s deadline")
+            late.extend(futures[future])
+        self.collected()
+        return late
+
+    def dispatch(self, metric_sets, deadline=None):
+        """
+        Start collecting the metric sets without waiting for them, and
+        return those which were skipped.  `on_collected` is called once
+        they have all been collected, and those still running after
+        `deadline` seconds are returned by `overdue`.
+        """
+        futures, late = self.submit(metric_sets)
+        if not futures:
+            return late
+        lock = threading.Lock()
+        remaining = len(futures)
+
+        def finish(future):
+            nonlocal remaining
+            with lock:
+                remaining -= 1
+                if remaining:
+                    return
+            self.collected()
+
+        for future, group in futures.items():
+            if deadline is not None:
+                self._deadlines[future] = (monotonic() + deadline, deadline, group)
+            future.add_done_callback(finish)
+        return late
+
+    def overdue(self):
+        """
+        Return the metric sets started by `dispatch` which are still
+        running past their deadline.  Each is only returned once.
+        """
+        now = monotonic()
+        late = []
+        for future, (due, deadline, group) in list(self._deadlines.items()):
+            if not future.done() and now < due:
+                continue
+            del self._deadlines[future]
+            if not future.done():
+                logging.warning(f"Collection for {display_names(group)} missed the {deadline}s deadline")
+                late.extend(group)
+        return late
+
+    def submit(self, metric_sets):
+        """
+        Hand each group of metric sets to a worker, unless its previous
+        collection is still running.  Return the futures, with the group
+        of each, and the metric sets which were skipped.
+        """
+        groups = {}
+        for metric_set in metric_sets:
+            groups.setdefault(metric_set.collection_key(), []).append(metric_set)
+
+        futures = {}
+        late = []
+        for key, group in groups.items():
+            future = None
+            with self._in_flight_lock:
+                running = self._in_flight.get(key)
+                if running is None or running.done():
+                    future = self._in_flight[key] = self._executor.submit(self.collect_group, group)
+            if future is None:
+                logging.warning(f"Skipping collection for {display_names(group)}: "
+                                f"the previous collection has not finished")
+                late.extend(group)
+                continue
+            future.add_done_callback(lambda done, key=key: self.finished(key, done))
+            futures[future] = group
+        return futures, late
+
+    def finished(self, key, future):
+        # Forgotten once finished, so the groups retired by a reload do not linger
+        with self._in_flight_lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def collected(self):
+        if self._on_collected is None:
+            return
+        # Cycles finishing on different workers take turns
+        with self._collected_lock:
+            try:
+                self._on_collected()
+            except Exception as error:
+                logging.error('Failed to finish the collection cycle:')
+                logging.exception(error)
+
+    @staticmethod
+    def collect_group(metric_sets):
+        for metric_set in metric_sets:
+            try:
+                metric_set.collect()
+            except Exception as error:
+                logging.error(f"Failed to collect {metric_set.display_name()}:")
+                logging.exception(error)
+
+
+def display_names(metric_sets):
+    return ', '.join(metric_set.display_name() for metric_set in metric_sets)
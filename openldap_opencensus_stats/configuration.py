@@ -1,117 +1,398 @@
 import copy
 import logging
 import logging.config
+import threading
+import zlib
+from time import sleep
 
+import ldap
 import yaml
-from time import sleep
 
+from openldap_opencensus_stats import instrumentation
+from openldap_opencensus_stats.discovery import DiscoveryCache
 from openldap_opencensus_stats.config_transformers.base import ConfigurationTransformationChainSingleton
-from openldap_opencensus_stats.ldap_metric_set import MetricSet
 from openldap_opencensus_stats.sync_metric_set import SyncMetricSet
 from openldap_opencensus_stats.ldap_server import LdapServerPool
 from openldap_opencensus_stats.ldap_statistic import LdapStatistic
+from openldap_opencensus_stats.ldap_summary_statistic import LdapSummaryStatistic
+from openldap_opencensus_stats.push_exporter import PushExporter
+from openldap_opencensus_stats.scrape_trigger import ScrapeTrigger
+from openldap_opencensus_stats.server_metric_sets import ServerMetricSets
+from openldap_opencensus_stats.statistic_definitions import StatisticCompiler
+from openldap_opencensus_stats.text_exporter import PrometheusTextExporter
 
+import google.auth
+from google.api_core.gapic_v1 import client_info
+from google.cloud import monitoring_v3
+from opencensus.metrics import transport
 from opencensus.stats import stats
 from opencensus.ext.prometheus import stats_exporter
+from prometheus_client import REGISTRY
 import opencensus.ext.stackdriver.stats_exporter
 
 # Make up for broken code in the Prometheus exporter
 import opencensus.stats.aggregation_data
 opencensus.stats.aggregation_data.SumAggregationDataFloat = opencensus.stats.aggregation_data.SumAggregationData
 
-SUPPORTED_EXPORTERS = ['Prometheus', 'Stackdriver']
+SUPPORTED_EXPORTERS = ['Prometheus', 'PrometheusText', 'Push', 'Stackdriver']
+# The exporters which serve the statistics for Prometheus to scrape
+PULL_EXPORTERS = ['Prometheus', 'PrometheusText']
 
 
 class Configuration:
-    def __init__(self, config_file_name):
+    """
+    The running configuration.
+
+    `reconfigure()` may be called again to reload the configuration
+    file.  The new configuration is compared with the running one, and
+    only the metric sets of the LDAP servers and sync entries whose
+    configuration changed are rebuilt.  The others, their connections
+    and their registered views are kept.  The exporters, `pull`,
+    `workers` and `shards` are only read once, and changes to them need
+    a restart.
+
+    With a `shard`, the index of this process and the number of shards,
+    only the LDAP servers and sync entries which hash to the shard are
+    collected, and the exporters are left to the supervisor.
+    """
+    def __init__(self, config_file_name, shard=None):
         if config_file_name is None:
             raise ValueError("Config file name must be supplied")
         self._config_file_name = config_file_name
+        self._shard = shard
         self._configuration_dict = {}
+        self._normalized_configuration = None
         self._sleep_time = 5
+        self._max_workers = 8
+        self._deadline = None
+        self._jitter = True
+        self._watch_interval = 5
+        self._scrape_trigger = None
+        # The exporters which render the statistics themselves, once a collection cycle
+        self._rendering_exporters = []
+        self._discovery_cache = None
         self._metric_sets = []
+        # The configuration and metric sets of each LDAP server and sync entry
+        self._server_configs = {}
+        self._server_metric_sets = {}
+        self._sync_configs = {}
+        self._sync_metric_sets = {}
         self._ldap_metrics = {}
+        self._rediscovery_interval = 300
+        self._lock = threading.Lock()
+        self._rediscovery_lock = threading.Lock()
 
         self.reconfigure()
 
     def reconfigure(self):
-        self._configuration_dict = read_yaml_file(self._config_file_name)
+        configuration_dict = read_yaml_file(self._config_file_name)
         normalized_configuration = ConfigurationTransformationChainSingleton().transform_configuration(
-            self._configuration_dict
+            configuration_dict
         )
+        first_load = self._normalized_configuration is None
 
-        self._sleep_time = normalized_configuration.get('period', 5)
         log_config = normalized_configuration.get('log_config')
         if log_config and isinstance(log_config, dict):
             log_config['version'] = log_config.get('version', 1)
             logging.config.dictConfig(log_config)
-        for exporter_config in normalized_configuration.get('exporters', []):
-            exporter = create_exporter(exporter_config)
-            stats.stats.view_manager.register_exporter(exporter)
+        if first_load:
+            self._max_workers = normalized_configuration.get('workers', 8)
+            if self._shard is None:
+                self.configure_exporters(normalized_configuration)
+            else:
+                instrumentation.register_views()
+        else:
+            for name in ['workers', 'pull', 'exporters', 'shards']:
+                if normalized_configuration.get(name) != self._normalized_configuration.get(name):
+                    logging.warning(f"The {name} configuration has changed, restart to apply the change")
 
+        discovery_cache = DiscoveryCache(normalized_configuration.get('discovery_cache_file'))
+        server_configs, server_metric_sets = self.diff_servers(normalized_configuration, discovery_cache)
+        discovery_cache.save()
+        discovery_cache.revalidate_in_background(on_changed=self.apply_discovery_changes)
+        sync_configs, sync_metric_sets = self.diff_syncs(normalized_configuration)
+
+        retired_sync_metric_sets = [
+            metric_set
+            for metric_set in self._sync_metric_sets.values()
+            if metric_set not in sync_metric_sets.values()
+        ]
+        with self._lock:
+            self._configuration_dict = configuration_dict
+            self._normalized_configuration = normalized_configuration
+            self._sleep_time = normalized_configuration.get('period', 5)
+            self._deadline = normalized_configuration.get('deadline')
+            self._jitter = normalized_configuration.get('jitter', True)
+            self._watch_interval = normalized_configuration.get('watch_interval', 5)
+            self._rediscovery_interval = normalized_configuration.get('rediscovery_interval', 300)
+            self._discovery_cache = discovery_cache
+            self._server_configs = server_configs
+            self._server_metric_sets = server_metric_sets
+            self._sync_configs = sync_configs
+            self._sync_metric_sets = sync_metric_sets
+            self.update_metric_sets()
+            if self._scrape_trigger is not None:
+                self._scrape_trigger.set_deadline(self.pull_deadline())
+        for metric_set in retired_sync_metric_sets:
+            metric_set.stop()
+
+    def diff_servers(self, normalized_configuration, discovery_cache):
+        """
+        Return the configuration and metric sets of each LDAP server,
+        keeping the metric sets of those whose configuration is unchanged.
+        """
+        server_configs = {}
+        server_metric_sets = {}
         for ldap_server_config in normalized_configuration.get('ldap_servers', []):
-            if not ldap_server_config.get('sync_only', False):
-                metric_set = self.generate_metric_set(ldap_server_config)
-                self._metric_sets.append(metric_set)
+            if ldap_server_config.get('sync_only', False):
+                continue
+            database = ldap_server_config.get('database')
+            if not self.in_shard(database):
+                continue
+            server_config = (ldap_server_config, normalized_configuration.get('object'))
+            server_configs[database] = server_config
+            if self._server_configs.get(database) == server_config:
+                server_metric_sets[database] = self._server_metric_sets[database]
+            else:
+                logging.info(f"Building the metric sets for {database}")
+                server_metric_sets[database] = self.generate_metric_sets(
+                    *server_config,
+                    discovery_cache=discovery_cache
+                )
+        return server_configs, server_metric_sets
 
+    def diff_syncs(self, normalized_configuration):
+        """
+        Return the configuration and metric set of each sync entry,
+        keeping the metric sets of those whose configuration is unchanged.
+        """
+        sync_configs = {}
+        sync_metric_sets = {}
         for base_dn, sync_config in normalized_configuration.get('sync', {}).items():
+            if not self.in_shard(base_dn):
+                continue
             ldap_server_names = sync_config.get('cluster_servers', [])
-            ldap_servers = [
-                LdapServerPool().get_ldap_server(**server)
+            cluster_server_configs = [
+                server
                 for server in normalized_configuration.get('ldap_servers', [])
                 if server['database'] in ldap_server_names
             ]
-            report_servers = sync_config.get('report_servers', [])
-            sync_metric_set = SyncMetricSet(
+            # The global period is part of it, as sub-samples are spread over the period
+            period = sync_config.get('period', normalized_configuration.get('period', 5))
+            sync_configs[base_dn] = (sync_config, cluster_server_configs, period)
+            if self._sync_configs.get(base_dn) == sync_configs[base_dn]:
+                sync_metric_sets[base_dn] = self._sync_metric_sets[base_dn]
+                continue
+            logging.info(f"Building the sync metric set for {base_dn}")
+            sync_metric_sets[base_dn] = SyncMetricSet(
                 base_dn=base_dn,
-                ldap_servers=ldap_servers,
-                report_servers=report_servers
+                ldap_servers=[get_ldap_server(server) for server in cluster_server_configs],
+                report_servers=sync_config.get('report_servers', []),
+                period=period,
+                stream=sync_config.get('stream', False),
+                history=sync_config.get('history', 30),
+                aggregator=sync_config.get('aggregator'),
+                buckets=sync_config.get('buckets'),
+                subsamples=sync_config.get('subsamples', 1)
             )
-            self._metric_sets.append(sync_metric_set)
-
-    def generate_metric_set(self, ldap_server_config):
-        args = copy.deepcopy(ldap_server_config.get('connection', {}))
-        args['database'] = ldap_server_config.get('database')
-        ldap_server = LdapServerPool().get_ldap_server(**args)
-        metric_set = MetricSet(ldap_server=ldap_server)
-        configs = [ldap_server_config.get('object')]
-        while configs:
-            config = configs.pop()
-            if isinstance(config, list):
-                for item in config:
-                    configs.insert(0, item)
-            elif isinstance(config, dict):
-                dn = config.get('computed_dn')
-                name = config.get('metric_name')
-                attribute = config.get('attribute')
-                unit = config.get('unit')
-                description = config.get('description', '')
-                value_function = config.get('func', 'value')
-                query_dn = config.get('query_dn')
-                if dn and name and attribute and unit and query_dn:
-                    stat = self._ldap_metrics.get(name)
-                    if not stat:
-                        stat = LdapStatistic(
-                            dn=dn,
-                            name=name,
-                            attribute=attribute,
-                            description=description,
-                            unit=unit,
-                            value_function=value_function,
-                            query_dn=query_dn,
-                            tag_keys=['database']
-                        )
-                        self._ldap_metrics[name] = stat
-                    metric_set.add_statistic(stat)
-                for key, value in config.items():
-                    configs.insert(0, value)
-        return metric_set
+        return sync_configs, sync_metric_sets
+
+    def in_shard(self, key):
+        return self._shard is None or shard_of(key, self._shard[1]) == self._shard[0]
+
+    def configure_exporters(self, normalized_configuration):
+        instrumentation.register_views()
+        pull_config = normalized_configuration.get('pull')
+        if pull_config is not None:
+            exporter_names = [exporter.get('name') for exporter in normalized_configuration.get('exporters', [])]
+            if not any(name in PULL_EXPORTERS for name in exporter_names):
+                logging.error("Pull mode requires the Prometheus or PrometheusText exporter.")
+                raise ValueError("Pull mode requires the Prometheus or PrometheusText exporter.")
+            if not isinstance(pull_config, dict):
+                pull_config = {}
+            self._scrape_trigger = ScrapeTrigger(ttl=pull_config.get('ttl', normalized_configuration.get('period', 5)))
+            if 'Prometheus' in exporter_names:
+                # Registered ahead of the exporter, so a scrape collects before it reads
+                REGISTRY.register(self._scrape_trigger)
+        for exporter_config in normalized_configuration.get('exporters', []):
+            exporter = create_exporter(exporter_config)
+            if isinstance(exporter, PrometheusTextExporter):
+                exporter.scrape_trigger = self._scrape_trigger
+            if isinstance(exporter, (PrometheusTextExporter, PushExporter)):
+                # They read the views themselves, rather than being sent every recording
+                self._rendering_exporters.append(exporter)
+                continue
+            stats.stats.view_manager.register_exporter(exporter)
+
+    def generate_metric_sets(self, ldap_server_config, object_config, discovery_cache=None):
+        """
+        Generate the metric sets for one LDAP server: one for the server's
+        period, plus one for each other period given to its statistics.
+        """
+        ldap_server = get_ldap_server(ldap_server_config)
+        compiler = StatisticCompiler(ldap_server, discovery_cache=discovery_cache)
+        server_metric_sets = ServerMetricSets(ldap_server, compiler, self.get_statistic)
+        server_metric_sets.add(compiler.compile(object_config, period=ldap_server_config.get('period')))
+        return server_metric_sets
+
+    def get_statistic(self, definition):
+        # The children tagged by name share a name, and are told apart by their tags
+        key = (definition.name, tuple(sorted(definition.tags.items())))
+        stat = self._ldap_metrics.get(key)
+        if definition.summarize and (not isinstance(stat, LdapSummaryStatistic) or not stat.matches(definition)):
+            stat = LdapSummaryStatistic(
+                dn=definition.dn,
+                name=definition.name,
+                attribute=definition.attribute,
+                child_pattern=definition.child_pattern,
+                summarize=definition.summarize,
+                top=definition.top,
+                description=definition.description,
+                unit=definition.unit,
+                value_function=definition.value_function,
+                tag_keys=['database'] + sorted(definition.tags),
+                aggregator=definition.aggregator,
+                buckets=definition.buckets,
+                tags=definition.tags
+            )
+            self._ldap_metrics[key] = stat
+        elif not definition.summarize and (not isinstance(stat, LdapStatistic) or not stat.matches(definition)):
+            stat = LdapStatistic(
+                dn=definition.dn,
+                name=definition.name,
+                attribute=definition.attribute,
+                description=definition.description,
+                unit=definition.unit,
+                value_function=definition.value_function,
+                query_dn=definition.query_dn,
+                tag_keys=['database'] + sorted(definition.tags),
+                derive=definition.derive,
+                rate_window=definition.rate_window,
+                aggregator=definition.aggregator,
+                buckets=definition.buckets,
+                tags=definition.tags
+            )
+            self._ldap_metrics[key] = stat
+        return stat
+
+    def render_exporters(self):
+        for exporter in self._rendering_exporters:
+            exporter.render()
+
+    def rediscover(self):
+        """
+        Search again for the children of the `children` definitions of
+        every LDAP server, and add or retire their statistics.
+        """
+        # The periodic rediscovery and the discovery cache may both ask for one
+        with self._rediscovery_lock:
+            with self._lock:
+                server_metric_sets = list(self._server_metric_sets.values())
+            changes = []
+            for metric_sets in server_metric_sets:
+                try:
+                    added, removed = metric_sets.rediscover()
+                except Exception as error:
+                    logging.error('Could not rediscover the child objects:')
+                    logging.exception(error)
+                    continue
+                if added or removed:
+                    changes.append((metric_sets, added, removed))
+            if changes:
+                self.apply_rediscovery(changes)
+
+    def apply_rediscovery(self, changes):
+        with self._lock:
+            for metric_sets, added, removed in changes:
+                # Those rebuilt by a reload during the searches were discovered afresh
+                if metric_sets in self._server_metric_sets.values():
+                    metric_sets.apply(added, removed)
+            self.update_metric_sets()
+
+    def apply_discovery_changes(self, changed):
+        """
+        Apply the changes found by revalidating the discovery cache: the
+        children are searched again, and their statistics added or
+        retired.  Statistics named after attributes keep their names
+        until the configuration is reloaded.
+        """
+        if any(scope == ldap.SCOPE_BASE for database, scope, dn in changed):
+            logging.warning("Attributes interpolated into statistic names have changed since they were cached, "
+                            "reload the configuration to rename the statistics")
+        if any(scope != ldap.SCOPE_BASE for database, scope, dn in changed):
+            self.rediscover()
+
+    def rediscover_periodically(self):
+        while True:
+            sleep(self._rediscovery_interval)
+            self.rediscover()
+
+    def start_rediscovery(self):
+        if not self._rediscovery_interval:
+            return
+        threading.Thread(target=self.rediscover_periodically, name='rediscovery', daemon=True).start()
+
+    def update_metric_sets(self):
+        self._metric_sets = [
+            metric_set
+            for metric_sets in self._server_metric_sets.values()
+            for metric_set in metric_sets.metric_sets()
+        ] + list(self._sync_metric_sets.values())
+        if self._scrape_trigger is not None:
+            self._scrape_trigger.set_metric_sets(self._metric_sets)
 
     def metric_sets(self):
         return self._metric_sets
 
-    def sleep(self):
-        sleep(self._sleep_time)
+    def max_workers(self):
+        return self._max_workers
+
+    def deadline(self):
+        return self._deadline
+
+    def pull_deadline(self):
+        """
+        The deadline of a collection made for a scrape, which defaults to
+        the period, so a hung server cannot hold up the scrapes for ever.
+        """
+        return self._sleep_time if self._deadline is None else self._deadline
+
+    def period(self):
+        return self._sleep_time
+
+    def jitter(self):
+        return self._jitter
+
+    def watch_interval(self):
+        return self._watch_interval
+
+    def scrape_trigger(self):
+        return self._scrape_trigger
+
+
+def get_ldap_server(ldap_server_config):
+    args = copy.deepcopy(ldap_server_config.get('connection', {}))
+    args['database'] = ldap_server_config.get('database')
+    return LdapServerPool().get_ldap_server(**args)
+
+
+def shard_of(key, shards):
+    """
+    The shard a database or base DN is collected by.  The hash is
+    stable across processes and restarts, unlike `hash()`.
+    """
+    return zlib.crc32(str(key).encode('utf-8')) % shards
+
+
+def read_shards(config_file_name):
+    normalized_configuration = ConfigurationTransformationChainSingleton().transform_configuration(
+        read_yaml_file(config_file_name)
+    )
+    shards = normalized_configuration.get('shards', 1)
+    if not isinstance(shards, int) or shards < 1:
+        logging.error(f"The number of shards must be at least 1, not {shards}")
+        raise ValueError(f"The number of shards must be at least 1, not {shards}")
+    return shards
 
 
 def read_yaml_file(file_name):
@@ -141,12 +422,69 @@ def create_exporter(exporter_configuration=None):
             raise ValueError("The Prometheus exporter requires options configuration.")
         final_options = {'namespace': 'openldap', 'port': 8000, 'address': '0.0.0.0'}
         final_options.update(options)
-        exporter = stats_exporter.new_stats_exporter(
-            stats_exporter.Options(**final_options)
-        )
+        exporter = new_prometheus_exporter(stats_exporter.Options(**final_options))
+
+    elif "PrometheusText" == name:
+        final_options = {'namespace': 'openldap', 'port': 8000, 'address': '0.0.0.0', 'compress': True}
+        final_options.update(options)
+        exporter = PrometheusTextExporter(**final_options)
+        exporter.serve_http()
+
+    elif "Push" == name:
+        if not options.get('url'):
+            logging.error("The Push exporter requires the url of its endpoint in its options.")
+            raise ValueError("The Push exporter requires the url of its endpoint in its options.")
+        exporter = PushExporter(**options)
 
     elif "Stackdriver" == name:
-        exporter = opencensus.ext.stackdriver.stats_exporter.new_stats_exporter(interval=5)
+        exporter = new_stackdriver_exporter(interval=options.get('interval', 5))
         print(f"Exporting stats to this project {exporter.options.project_id}")
 
     return exporter
+
+
+class LockedPrometheusCollector(stats_exporter.Collector):
+    """
+    The collector of the Prometheus exporter, reading the views under the
+    record lock, as collector threads record into them during a scrape.
+    """
+    def describe(self):
+        # The registry describes a collector as it is registered, which
+        # happens within a recording, holding the lock already
+        return []
+
+    def collect(self):
+        with instrumentation.record_lock:
+            return list(super().collect())
+
+
+def new_prometheus_exporter(options):
+    """
+    Create a Prometheus exporter as OpenCensus does, but with its
+    collector reading the views under the record lock.
+    """
+    if options.namespace == "":
+        logging.error("The Prometheus exporter requires a namespace.")
+        raise ValueError("The Prometheus exporter requires a namespace.")
+    return stats_exporter.PrometheusStatsExporter(
+        options=options,
+        gatherer=options.registry,
+        collector=LockedPrometheusCollector(options=options)
+    )
+
+
+def new_stackdriver_exporter(interval):
+    """
+    Create a Stackdriver exporter as OpenCensus does, but with its
+    thread reading the views under the record lock.
+    """
+    _, project_id = google.auth.default()
+    client = monitoring_v3.MetricServiceClient(client_info=client_info.ClientInfo(
+        client_library_version=opencensus.ext.stackdriver.stats_exporter.get_user_agent_slug()
+    ))
+    exporter = opencensus.ext.stackdriver.stats_exporter.StackdriverStatsExporter(
+        client=client,
+        options=opencensus.ext.stackdriver.stats_exporter.Options(project_id=project_id)
+    )
+    transport.get_exporter_thread([instrumentation.metric_producer], exporter, interval=interval)
+    return exporter
@@ -0,0 +1,77 @@
+from array import array
+
+# The statistics which may be derived from a counter
+DERIVATIONS = ['rate', 'delta', 'resets']
+
+
+class CounterHistory:
+    """
+    The last `size` samples of a counter, kept in a pair of fixed size
+    arrays used as a ring buffer.
+
+    A sample lower than the one before it means the counter was reset,
+    as when slapd restarts, and the counter is taken to have counted up
+    from zero since.
+    """
+    def __init__(self, size=2):
+        if size is None or size < 2:
+            raise ValueError(f"A counter history needs at least 2 samples, not {size}")
+        self._times = array('d', [0.0] * size)
+        self._values = array('d', [0.0] * size)
+        self._size = size
+        self._count = 0
+        self._next = 0
+
+    def add(self, time, value):
+        """
+        Add a sample, and return whether the counter was reset since the
+        previous one.
+        """
+        reset = self._count > 0 and value < self._values[self._next - 1]
+        self._times[self._next] = time
+        self._values[self._next] = value
+        self._next = (self._next + 1) % self._size
+        self._count = min(self._count + 1, self._size)
+        return reset
+
+    def samples(self):
+        start = (self._next - self._count) % self._size
+        for index in range(start, start + self._count):
+            yield self._times[index % self._size], self._values[index % self._size]
+
+    def increase(self):
+        """
+        The increase of the counter over the history, and the time it
+        took, or None until there are two samples.
+        """
+        if self._count < 2:
+            return None
+        total = 0.0
+        first_time = previous = None
+        for time, value in self.samples():
+            if previous is None:
+                first_time = time
+            else:
+                total += value - previous if value >= previous else value
+            previous = value
+            last_time = time
+        return total, last_time - first_time
+
+    def delta(self):
+        """
+        The increase of the counter since the previous sample.
+        """
+        if self._count < 2:
+            return None
+        previous = self._values[self._next - 2]
+        value = self._values[self._next - 1]
+        return value - previous if value >= previous else value
+
+    def rate(self):
+        """
+        The increase of the counter per second over the history.
+        """
+        increase = self.increase()
+        if increase is None or increase[1] <= 0:
+            return None
+        return increase[0] / increase[1]
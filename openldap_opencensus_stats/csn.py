@@ -0,0 +1,100 @@
+import logging
+from collections import deque, namedtuple
+from functools import lru_cache
+
+
+class Csn(namedtuple('Csn', ['time', 'count', 'sid', 'modifier'])):
+    """
+    A change sequence number, such as
+    `20230101120000.123456Z#000000#001#000000`: the time of the change
+    in integer microseconds since the epoch, the count of changes made
+    within that microsecond, the ID of the server which made the change
+    and a modifier.  CSNs compare in the order of their changes.
+    """
+    __slots__ = ()
+
+    @property
+    def rid(self):
+        return str(self.sid)
+
+
+@lru_cache(maxsize=4096)
+def parse_csn(value):
+    """
+    Parse a CSN, as a string or as bytes.  Most contextCSN values are
+    unchanged from one collection to the next, so they are cached.
+    """
+    if isinstance(value, bytes):
+        value = value.decode('ascii')
+    try:
+        timestamp, count, sid, modifier = value.split('#')
+        seconds, _, fraction = timestamp.rstrip('Z').partition('.')
+        if len(seconds) != 14:
+            raise ValueError(value)
+        # YYYYmmddHHMMSS is read as one number and split arithmetically
+        date, time = divmod(int(seconds), 1000000)
+        date, day = divmod(date, 100)
+        year, month = divmod(date, 100)
+        time, second = divmod(time, 100)
+        hour, minute = divmod(time, 100)
+        if not is_valid_time(year, month, day, hour, minute, second):
+            raise ValueError(value)
+        time = ((days_from_civil(year, month, day) * 24 + hour) * 60 + minute) * 60 + second
+        microseconds = int(fraction[:6].ljust(6, '0')) if fraction else 0
+        return Csn(time * 1000000 + microseconds, int(count, 16), int(sid, 16), int(modifier, 16))
+    except ValueError:
+        logging.error(f"Invalid CSN: {value}")
+        raise ValueError(f"Invalid CSN: {value}")
+
+
+def is_valid_time(year, month, day, hour, minute, second):
+    """
+    Whether the fields of a CSN's timestamp make a real time, allowing
+    for a leap second.
+    """
+    if not 1 <= month <= 12:
+        return False
+    # The days of the month are those up to the first of the next month
+    days_in_month = days_from_civil(year + month // 12, month % 12 + 1, 1) - days_from_civil(year, month, 1)
+    return 1 <= day <= days_in_month and hour < 24 and minute < 60 and second <= 60
+
+
+def days_from_civil(year, month, day):
+    """
+    The days from 1970-01-01 to a date of the proleptic Gregorian calendar.
+    """
+    year -= month <= 2
+    era = year // 400
+    year_of_era = year - era * 400
+    day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+
+class WatermarkHistory:
+    """
+    The last `size` watermarks of one rid on one server, each with the
+    time it was sampled and its offset from the most recent change of
+    the cluster.
+    """
+    def __init__(self, size=30):
+        self._entries = deque(maxlen=size)
+
+    def add(self, sampled_at, watermark, offset):
+        self._entries.append((sampled_at, watermark, offset))
+
+    def offset_rate(self):
+        """
+        The rate the offset changes at, in seconds per second, fitted by
+        least squares: negative while the server catches up, positive
+        while it falls behind.  None until samples at two different
+        times are known.
+        """
+        if len(self._entries) < 2:
+            return None
+        mean_time = sum(entry[0] for entry in self._entries) / len(self._entries)
+        mean_offset = sum(entry[2] for entry in self._entries) / len(self._entries)
+        variance = sum((entry[0] - mean_time) ** 2 for entry in self._entries)
+        if not variance:
+            return None
+        return sum((entry[0] - mean_time) * (entry[2] - mean_offset) for entry in self._entries) / variance
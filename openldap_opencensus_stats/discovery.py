@@ -0,0 +1,149 @@
+import json
+import logging
+import os
+import threading
+
+import ldap
+
+
+class DiscoveryCache:
+    """
+    Remembers the searches made while compiling the configuration:
+    the children of the `children` definitions, and the attributes
+    interpolated into metric names.
+
+    Each search fetches every attribute the configuration needs from
+    the entries it returns, and is made once per run.  When a cache
+    file is configured, the results are also kept there, so a restart
+    compiles the configuration without waiting for the LDAP servers.
+    Results read from the file are then searched again in the
+    background, the file is updated, and the changes are handed back
+    to be applied.
+    """
+    def __init__(self, file_name=None):
+        self._file_name = file_name
+        self._lock = threading.Lock()
+        self._results = {}
+        # Results read from the cache file which have not been searched again
+        self._loaded = set()
+        self._stale = {}
+        if file_name:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self._file_name, 'r') as file:
+                self._results = json.load(file)
+            self._loaded = set(
+                (database, key)
+                for database, results in self._results.items()
+                for key in results
+            )
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as error:
+            logging.warning(f"Ignoring the discovery cache {self._file_name}: {error}")
+            self._results = {}
+
+    def save(self):
+        if not self._file_name:
+            return
+        with self._lock:
+            content = json.dumps(self._results, sort_keys=True)
+        temporary_file_name = f"{self._file_name}.tmp"
+        try:
+            with open(temporary_file_name, 'w') as file:
+                file.write(content)
+            os.replace(temporary_file_name, self._file_name)
+        except OSError as error:
+            logging.warning(f"Could not write the discovery cache {self._file_name}: {error}")
+
+    def search(self, ldap_server, dn, scope=ldap.SCOPE_ONELEVEL, attributes=None):
+        """
+        Return the entries found by the search, as a mapping of DN to a
+        mapping of the requested attribute names to their string values.
+        """
+        attributes = set(attributes or [])
+        key = search_key(dn, scope)
+        with self._lock:
+            cached = self._results.get(ldap_server.database, {}).get(key)
+            if cached is not None and attributes.issubset(cached['attributes']):
+                if (ldap_server.database, key) in self._loaded:
+                    self._stale[(ldap_server.database, key)] = ldap_server
+                return cached['entries']
+            if cached is not None:
+                attributes.update(cached['attributes'])
+        return self.refresh(ldap_server, dn, scope, attributes)
+
+    def refresh(self, ldap_server, dn, scope, attributes):
+        ldap_result = ldap_server.query(dn=dn, scope=scope, attr_list=sorted(attributes) or ['1.1'])
+        entries = dict(
+            (result_dn, dict(
+                (name, [decode(value) for value in values])
+                for name, values in result_attributes.items()
+            ))
+            for result_dn, result_attributes in ldap_result
+            if result_dn
+        )
+        # An empty result may only mean that the server could not be reached
+        if entries:
+            with self._lock:
+                self._results.setdefault(ldap_server.database, {})[search_key(dn, scope)] = {
+                    'attributes': sorted(attributes),
+                    'entries': entries,
+                }
+                self._loaded.discard((ldap_server.database, search_key(dn, scope)))
+                self._stale.pop((ldap_server.database, search_key(dn, scope)), None)
+        return entries
+
+    def revalidate_in_background(self, on_changed=None):
+        """
+        Search again, in a background thread, for the results which were
+        read from the cache file, then update the file.  The searches
+        whose results changed are handed to `on_changed`, as a list of
+        the database, scope and DN of each.
+        """
+        with self._lock:
+            stale = self._stale
+            self._stale = {}
+            self._loaded.difference_update(stale)
+        if not stale:
+            return
+        threading.Thread(
+            target=self.revalidate,
+            args=(stale, on_changed),
+            name='discovery',
+            daemon=True
+        ).start()
+
+    def revalidate(self, stale, on_changed=None):
+        changed = []
+        for (database, key), ldap_server in stale.items():
+            scope, dn = parse_search_key(key)
+            with self._lock:
+                cached = self._results[database][key]
+            entries = self.refresh(ldap_server, dn, scope, cached['attributes'])
+            if entries and entries != cached['entries']:
+                changed.append((database, scope, dn))
+        self.save()
+        if not changed:
+            return
+        logging.warning(f"The discovered objects have changed since they were cached: "
+                        f"{', '.join(f'{database}:{dn}' for database, scope, dn in changed)}")
+        if on_changed is not None:
+            on_changed(changed)
+
+
+def search_key(dn, scope):
+    return f"{scope}:{dn}"
+
+
+def parse_search_key(key):
+    scope, dn = key.split(':', 1)
+    return int(scope), dn
+
+
+def decode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return str(value)
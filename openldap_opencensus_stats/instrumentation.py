@@ -0,0 +1,332 @@
+import threading
+from contextlib import contextmanager
+from time import monotonic
+
+from opencensus.metrics.export.metric_producer import MetricProducer
+from opencensus.stats import measure, view, aggregation, stats
+from opencensus.tags import tag_map, tag_key, tag_value
+
+# Statistics about the exporter itself, so that a degrading exporter
+# can be noticed before the metrics it produces go stale.
+
+DATABASE = tag_key.TagKey('database')
+QUERY_DN = tag_key.TagKey('query_dn')
+ERROR = tag_key.TagKey('error')
+METRIC_SET = tag_key.TagKey('metric_set')
+EXPORTER = tag_key.TagKey('exporter')
+SHARD = tag_key.TagKey('shard')
+
+DURATION_BOUNDARIES = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+SIZE_BOUNDARIES = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000, 10000, 50000]
+
+COLLECTION_DURATION = measure.MeasureFloat(
+    name='exporter/collection_duration',
+    description='Time taken to collect a metric set',
+    unit='s'
+)
+SEARCH_DURATION = measure.MeasureFloat(
+    name='exporter/search_duration',
+    description='Time taken by one LDAP search',
+    unit='s'
+)
+SEARCH_ENTRIES = measure.MeasureInt(
+    name='exporter/search_entries',
+    description='Entries returned by one LDAP search',
+    unit='1'
+)
+SEARCH_ATTRIBUTES = measure.MeasureInt(
+    name='exporter/search_attributes',
+    description='Attribute values returned by one LDAP search',
+    unit='1'
+)
+BINDS = measure.MeasureInt(
+    name='exporter/binds',
+    description='Binds to the LDAP server',
+    unit='1'
+)
+REBINDS = measure.MeasureInt(
+    name='exporter/rebinds',
+    description='Binds to the LDAP server after the connection was lost',
+    unit='1'
+)
+ERRORS = measure.MeasureInt(
+    name='exporter/errors',
+    description='LDAP errors, by exception class',
+    unit='1'
+)
+TRANSFORM_DURATION = measure.MeasureFloat(
+    name='exporter/transform_duration',
+    description='Time taken to apply the value functions of a metric set',
+    unit='s'
+)
+OVERRUNS = measure.MeasureInt(
+    name='exporter/overruns',
+    description='Collections skipped because a collection overran its period or deadline',
+    unit='1'
+)
+POOL_CONNECTIONS = measure.MeasureInt(
+    name='exporter/pool_connections',
+    description='Connections open to the LDAP server',
+    unit='1'
+)
+POOL_IN_USE = measure.MeasureInt(
+    name='exporter/pool_in_use',
+    description='Connections to the LDAP server in use',
+    unit='1'
+)
+POOL_WAIT = measure.MeasureFloat(
+    name='exporter/pool_wait',
+    description='Time spent waiting for a connection to the LDAP server',
+    unit='s'
+)
+CIRCUIT_OPEN = measure.MeasureInt(
+    name='exporter/circuit_open',
+    description='Whether requests to the LDAP server are refused after repeated failures',
+    unit='1'
+)
+CIRCUIT_SKIPS = measure.MeasureInt(
+    name='exporter/circuit_skips',
+    description='Requests refused because the LDAP server is failing',
+    unit='1'
+)
+PUSH_QUEUE = measure.MeasureInt(
+    name='exporter/push_queue',
+    description='Records waiting to be pushed',
+    unit='1'
+)
+PUSH_BATCHES = measure.MeasureInt(
+    name='exporter/push_batches',
+    description='Batches pushed',
+    unit='1'
+)
+PUSH_FAILURES = measure.MeasureInt(
+    name='exporter/push_failures',
+    description='Failed attempts to push a batch',
+    unit='1'
+)
+PUSH_DROPPED = measure.MeasureInt(
+    name='exporter/push_dropped',
+    description='Records or batches dropped because the push queue or spool was full, or the endpoint rejected them',
+    unit='1'
+)
+PUSH_SPOOL = measure.MeasureInt(
+    name='exporter/push_spool',
+    description='Bytes of batches spooled to disk until the push endpoint recovers',
+    unit='By'
+)
+SHARD_RESTARTS = measure.MeasureInt(
+    name='exporter/shard_restarts',
+    description='Shard worker processes restarted after they stopped',
+    unit='1'
+)
+
+VIEWS = [
+    view.View(
+        name=COLLECTION_DURATION.name,
+        description=COLLECTION_DURATION.description,
+        columns=[DATABASE],
+        aggregation=aggregation.DistributionAggregation(DURATION_BOUNDARIES),
+        measure=COLLECTION_DURATION
+    ),
+    view.View(
+        name=SEARCH_DURATION.name,
+        description=SEARCH_DURATION.description,
+        columns=[DATABASE, QUERY_DN],
+        aggregation=aggregation.DistributionAggregation(DURATION_BOUNDARIES),
+        measure=SEARCH_DURATION
+    ),
+    view.View(
+        name=SEARCH_ENTRIES.name,
+        description=SEARCH_ENTRIES.description,
+        columns=[DATABASE, QUERY_DN],
+        aggregation=aggregation.DistributionAggregation(SIZE_BOUNDARIES),
+        measure=SEARCH_ENTRIES
+    ),
+    view.View(
+        name=SEARCH_ATTRIBUTES.name,
+        description=SEARCH_ATTRIBUTES.description,
+        columns=[DATABASE, QUERY_DN],
+        aggregation=aggregation.DistributionAggregation(SIZE_BOUNDARIES),
+        measure=SEARCH_ATTRIBUTES
+    ),
+    view.View(
+        name=BINDS.name,
+        description=BINDS.description,
+        columns=[DATABASE],
+        aggregation=aggregation.CountAggregation(),
+        measure=BINDS
+    ),
+    view.View(
+        name=REBINDS.name,
+        description=REBINDS.description,
+        columns=[DATABASE],
+        aggregation=aggregation.CountAggregation(),
+        measure=REBINDS
+    ),
+    view.View(
+        name=ERRORS.name,
+        description=ERRORS.description,
+        columns=[DATABASE, ERROR],
+        aggregation=aggregation.CountAggregation(),
+        measure=ERRORS
+    ),
+    view.View(
+        name=TRANSFORM_DURATION.name,
+        description=TRANSFORM_DURATION.description,
+        columns=[DATABASE],
+        aggregation=aggregation.DistributionAggregation(DURATION_BOUNDARIES),
+        measure=TRANSFORM_DURATION
+    ),
+    view.View(
+        name=OVERRUNS.name,
+        description=OVERRUNS.description,
+        columns=[METRIC_SET],
+        aggregation=aggregation.CountAggregation(),
+        measure=OVERRUNS
+    ),
+    view.View(
+        name=POOL_CONNECTIONS.name,
+        description=POOL_CONNECTIONS.description,
+        columns=[DATABASE],
+        aggregation=aggregation.LastValueAggregation(),
+        measure=POOL_CONNECTIONS
+    ),
+    view.View(
+        name=POOL_IN_USE.name,
+        description=POOL_IN_USE.description,
+        columns=[DATABASE],
+        aggregation=aggregation.LastValueAggregation(),
+        measure=POOL_IN_USE
+    ),
+    view.View(
+        name=POOL_WAIT.name,
+        description=POOL_WAIT.description,
+        columns=[DATABASE],
+        aggregation=aggregation.DistributionAggregation(DURATION_BOUNDARIES),
+        measure=POOL_WAIT
+    ),
+    view.View(
+        name=CIRCUIT_OPEN.name,
+        description=CIRCUIT_OPEN.description,
+        columns=[DATABASE],
+        aggregation=aggregation.LastValueAggregation(),
+        measure=CIRCUIT_OPEN
+    ),
+    view.View(
+        name=CIRCUIT_SKIPS.name,
+        description=CIRCUIT_SKIPS.description,
+        columns=[DATABASE],
+        aggregation=aggregation.CountAggregation(),
+        measure=CIRCUIT_SKIPS
+    ),
+    view.View(
+        name=PUSH_QUEUE.name,
+        description=PUSH_QUEUE.description,
+        columns=[EXPORTER],
+        aggregation=aggregation.LastValueAggregation(),
+        measure=PUSH_QUEUE
+    ),
+    view.View(
+        name=PUSH_BATCHES.name,
+        description=PUSH_BATCHES.description,
+        columns=[EXPORTER],
+        aggregation=aggregation.CountAggregation(),
+        measure=PUSH_BATCHES
+    ),
+    view.View(
+        name=PUSH_FAILURES.name,
+        description=PUSH_FAILURES.description,
+        columns=[EXPORTER],
+        aggregation=aggregation.CountAggregation(),
+        measure=PUSH_FAILURES
+    ),
+    view.View(
+        name=PUSH_DROPPED.name,
+        description=PUSH_DROPPED.description,
+        columns=[EXPORTER],
+        aggregation=aggregation.SumAggregation(),
+        measure=PUSH_DROPPED
+    ),
+    view.View(
+        name=PUSH_SPOOL.name,
+        description=PUSH_SPOOL.description,
+        columns=[EXPORTER],
+        aggregation=aggregation.LastValueAggregation(),
+        measure=PUSH_SPOOL
+    ),
+    view.View(
+        name=SHARD_RESTARTS.name,
+        description=SHARD_RESTARTS.description,
+        columns=[SHARD],
+        aggregation=aggregation.CountAggregation(),
+        measure=SHARD_RESTARTS
+    ),
+]
+
+_registered = False
+
+# OpenCensus does not lock its view data, and exporting a view while
+# another thread records into it fails, so recording is serialized,
+# and anything reading the view data holds the lock too
+record_lock = threading.Lock()
+
+
+class LockedMetricProducer(MetricProducer):
+    """
+    Produce the metrics of every view, converted while holding the
+    record lock, for the exporters which poll for them on a thread of
+    their own.
+    """
+    def get_metrics(self):
+        with record_lock:
+            return list(stats.stats.get_metrics())
+
+
+# The exporter threads hold weak references, so this one is kept here
+metric_producer = LockedMetricProducer()
+
+
+def register_views():
+    global _registered
+    if _registered:
+        return
+    for exporter_view in VIEWS:
+        stats.stats.view_manager.register_view(exporter_view)
+    _registered = True
+
+
+def record(stat_measure, value, **tags):
+    """
+    Record one measurement of the exporter's own statistics, tagged by
+    the tag keys above, given by name.
+    """
+    mmap = stats.stats.stats_recorder.new_measurement_map()
+    if isinstance(stat_measure, measure.MeasureInt):
+        mmap.measure_int_put(stat_measure, value)
+    else:
+        mmap.measure_float_put(stat_measure, value)
+    tmap = tag_map.TagMap()
+    for name, tag in tags.items():
+        tmap.insert(tag_key.TagKey(name), tag_value.TagValue(str(tag)))
+    record_measurements(mmap, tmap)
+
+
+def record_measurements(mmap, tmap):
+    """
+    Record a measurement map; this is safe from any collector thread.
+    """
+    with record_lock:
+        mmap.record(tmap)
+
+
+def record_error(error, database):
+    record(ERRORS, 1, database=database, error=type(error).__name__)
+
+
+@contextmanager
+def timed(stat_measure, **tags):
+    start = monotonic()
+    try:
+        yield
+    finally:
+        record(stat_measure, monotonic() - start, **tags)
@@ -1,45 +1,169 @@
 import copy
+import logging
+import threading
 
 from opencensus.stats import stats
 from opencensus.tags import tag_map, tag_value, tag_key
 
+from openldap_opencensus_stats import instrumentation
+from openldap_opencensus_stats.ldap_summary_statistic import LdapSummaryStatistic
+from openldap_opencensus_stats.query_planner import QueryPlanner, normalize_dn
+
 
 class MetricSet:
-    def __init__(self, ldap_server=None, ldap_statistics=None):
+    def __init__(self, ldap_server=None, ldap_statistics=None, period=None):
         self._ldap_server = ldap_server
+        self.period = period
         if not ldap_statistics or not isinstance(ldap_statistics, list):
             ldap_statistics = []
         self._ldap_statistics = copy.deepcopy(ldap_statistics)
-        self._query_dns = set()
+        self._query_planner = QueryPlanner()
+        # Statistics may be added or removed while a collection runs, so
+        # a collection works from the list and plan current at its start
+        self._lock = threading.Lock()
+        for ldap_statistic in self._ldap_statistics:
+            self.register_query(ldap_statistic)
 
     def set_ldap_server(self, ldap_server):
         self._ldap_server = ldap_server
 
+    def collection_key(self):
+        return self._ldap_server
+
+    def display_name(self):
+        return self._ldap_server.database
+
     def add_statistic(self, ldap_statistic):
-        self._ldap_statistics.append(ldap_statistic)
-        self._query_dns.add(ldap_statistic.query_dn)
+        with self._lock:
+            self._ldap_statistics = self._ldap_statistics + [ldap_statistic]
+            self.register_query(ldap_statistic)
+
+    def remove_statistic(self, ldap_statistic):
+        with self._lock:
+            if ldap_statistic not in self._ldap_statistics:
+                return
+            self._ldap_statistics = [
+                statistic
+                for statistic in self._ldap_statistics
+                if statistic is not ldap_statistic
+            ]
+            if isinstance(ldap_statistic, LdapSummaryStatistic):
+                self._query_planner.remove_children(dn=ldap_statistic.dn, attribute=ldap_statistic.attribute)
+                return
+            self._query_planner.remove(
+                query_dn=ldap_statistic.query_dn,
+                dn=ldap_statistic.dn,
+                attribute=ldap_statistic.attribute
+            )
+
+    def statistics(self):
+        return self._ldap_statistics
+
+    def register_query(self, ldap_statistic):
+        if isinstance(ldap_statistic, LdapSummaryStatistic):
+            self._query_planner.add_children(dn=ldap_statistic.dn, attribute=ldap_statistic.attribute)
+            return
+        self._query_planner.add(
+            query_dn=ldap_statistic.query_dn,
+            dn=ldap_statistic.dn,
+            attribute=ldap_statistic.attribute
+        )
+
+    def queries(self):
+        with self._lock:
+            return self._query_planner.plan()
 
     def collect(self):
-        tag_keys = [tag_key.TagKey('database')]
+        with instrumentation.timed(instrumentation.COLLECTION_DURATION, database=self._ldap_server.database):
+            self.collect_statistics()
+
+    def collect_statistics(self):
+        with self._lock:
+            statistics = self._ldap_statistics
+            queries = self._query_planner.plan()
+        # The attributes read from each entry, and the summaries of the
+        # children of each DN, so that each entry is dropped once it is read
+        wanted = {}
+        summaries = {}
+        for server_statistic in statistics:
+            if isinstance(server_statistic, LdapSummaryStatistic):
+                summaries.setdefault(normalize_dn(server_statistic.dn), []).append(
+                    (server_statistic, server_statistic.new_summary())
+                )
+            else:
+                wanted.setdefault(normalize_dn(server_statistic.dn), set()).add(server_statistic.attribute)
         results = {}
-        for query_dn in self._query_dns:
-            results[query_dn] = dict([
-                (result_dn, result_attributes)
-                for result_dn, result_attributes in self._ldap_server.query(dn=query_dn)
-            ])
-        mmap = stats.stats.stats_recorder.new_measurement_map()
-        for server_statistic in self._ldap_statistics:
-            ldap_value = results.get(
-                server_statistic.query_dn, {}
-            ).get(
-                server_statistic.dn, {}
-            ).get(
-                server_statistic.attribute
+        received = False
+
+        def on_entry(index, entry_dn, entry_attributes):
+            nonlocal received
+            received = True
+            self.dispatch_entry(queries[index], entry_dn, entry_attributes, wanted, summaries, results)
+
+        self._ldap_server.stream_many(queries, on_entry)
+        if statistics and not received:
+            # The server is failing, and has logged why
+            logging.warning(f"Collected nothing from {self._ldap_server.database}")
+            return
+        self.record_statistics(statistics, results, summaries)
+
+    @staticmethod
+    def dispatch_entry(query, entry_dn, entry_attributes, wanted, summaries, results):
+        """
+        Add an entry read by a query to the summaries of its parent, or
+        keep the attributes wanted from it in `results`.
+        """
+        if 'children_of' in query:
+            for summary_statistic, summary in summaries.get(query['children_of'], []):
+                summary_statistic.add_child(summary, entry_dn, entry_attributes)
+            return
+        dn = normalize_dn(entry_dn)
+        for attribute in wanted.get(dn, ()):
+            if attribute in entry_attributes:
+                results.setdefault(dn, {})[attribute] = entry_attributes[attribute]
+
+    def record_statistics(self, statistics, results, summaries):
+        """
+        Collect the statistics from the results and summaries, and record
+        them.
+        """
+        # Statistics tagged by child share their measures, so each set of tags is recorded apart
+        mmaps = {}
+
+        def measurement_map(tags):
+            tags = tuple(sorted(tags.items()))
+            mmap = mmaps.get(tags)
+            if mmap is None:
+                mmap = mmaps[tags] = stats.stats.stats_recorder.new_measurement_map()
+            return mmap
+
+        with instrumentation.timed(instrumentation.TRANSFORM_DURATION, database=self._ldap_server.database):
+            for summary_list in summaries.values():
+                for summary_statistic, summary in summary_list:
+                    summary_statistic.collect(
+                        ldap_server=self._ldap_server,
+                        measurement_maps=measurement_map,
+                        summary=summary
+                    )
+            for server_statistic in statistics:
+                if isinstance(server_statistic, LdapSummaryStatistic):
+                    continue
+                ldap_value = results.get(
+                    normalize_dn(server_statistic.dn), {}
+                ).get(
+                    server_statistic.attribute
+                )
+                server_statistic.collect(
+                    ldap_server=self._ldap_server,
+                    measurement_map=measurement_map(server_statistic.tags),
+                    ldap_value=ldap_value
+                )
+        for tags, mmap in mmaps.items():
+            tmap = tag_map.TagMap()
+            tmap.insert(
+                tag_key.TagKey('database'),
+                tag_value.TagValue(self._ldap_server.database)
             )
-            server_statistic.collect(ldap_server=self._ldap_server, measurement_map=mmap, ldap_value=ldap_value)
-        tmap = tag_map.TagMap()
-        tmap.insert(
-            tag_keys[0],
-            tag_value.TagValue(self._ldap_server.database)
-        )
-        mmap.record(tmap)
+            for key, value in tags:
+                tmap.insert(tag_key.TagKey(key), tag_value.TagValue(value))
+            instrumentation.record_measurements(mmap, tmap)
@@ -1,10 +1,25 @@
 import logging
+import threading
+from contextlib import contextmanager
+from time import monotonic
 
 import ldap
+import ldap.controls
+import ldap.filter
+
+from openldap_opencensus_stats import instrumentation
+from openldap_opencensus_stats.circuit_breaker import CircuitBreaker
+
+# Errors which mean the server, rather than the request, has failed
+CONNECTION_ERRORS = (ldap.SERVER_DOWN, ldap.TIMEOUT)
+
+# Seconds during which the same error from one server is logged once
+ERROR_LOG_INTERVAL = 60
 
 
 class LdapServerPool:
     _ldap_servers = {}
+    _ldap_server_args = {}
 
     def __new__(cls, *args, **kwargs):
         if not hasattr(cls, 'instance'):
@@ -12,13 +27,123 @@ class LdapServerPool:
         return cls.instance
 
     def get_ldap_server(self, **kwargs):
-        if not self._ldap_servers.get(kwargs['database']):
-            self._ldap_servers[kwargs['database']] = LdapServer(**kwargs)
-            logging.critical(f"Registered LDAP Server: {kwargs['database']}")
-        return self._ldap_servers[kwargs['database']]
+        database = kwargs['database']
+        if self._ldap_servers.get(database) and self._ldap_server_args.get(database) != kwargs:
+            logging.critical(f"The connection to LDAP Server {database} has changed, reconnecting")
+            self._ldap_servers.pop(database).close()
+        if not self._ldap_servers.get(database):
+            self._ldap_servers[database] = LdapServer(**kwargs)
+            self._ldap_server_args[database] = kwargs
+            logging.critical(f"Registered LDAP Server: {database}")
+        return self._ldap_servers[database]
+
+
+class LdapConnection:
+    """
+    One connection to an LDAP server, bound on first use.
+    """
+    def __init__(self, server_uri, start_tls=False, ca_file=None, cert_file=None, key_file=None, timeout=-1,
+                 ldap_class=None):
+        self.connection = (ldap_class or ldap.ldapobject.ReconnectLDAPObject)(server_uri)
+        self.connection.timeout = timeout
+        self.bound = False
+        self.last_used = monotonic()
+
+        if ca_file:
+            self.connection.set_option(ldap.OPT_X_TLS_CACERTFILE, ca_file)
+        if cert_file:
+            self.connection.set_option(ldap.OPT_X_TLS_CERTFILE, cert_file)
+            self.connection.set_option(ldap.OPT_X_TLS_KEYFILE, key_file)
+        if ca_file or cert_file:
+            self.connection.set_option(ldap.OPT_X_TLS_NEWCTX, 0)
+
+        if start_tls:
+            self.connection.protocol_version = ldap.VERSION3
+            self.connection.set_option(ldap.OPT_X_TLS_NEWCTX, 0)
+            self.connection.start_tls_s()
+
+    def bind(self, user_dn=None, user_password=None, sasl_mech=None):
+        """
+        Bind the connection if it is not bound yet, and return whether
+        it was bound now.
+        """
+        if self.bound:
+            return False
+        if sasl_mech:
+            if sasl_mech == 'EXTERNAL':
+                self.connection.sasl_external_bind_s()
+            else:
+                logging.error(f"INTERNAL ERROR: Unsupported SASL mechanism {sasl_mech}")
+                raise ValueError(f"Unsupported SASL mechanism {sasl_mech}")
+        else:
+            self.connection.simple_bind_s(user_dn, user_password)
+        self.bound = True
+        return True
+
+    def is_alive(self):
+        try:
+            self.connection.whoami_s()
+            return True
+        except CONNECTION_ERRORS:
+            return False
+
+    def close(self):
+        try:
+            self.connection.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+
+class ErrorLog:
+    """
+    Logs the errors of one LDAP server without flooding the log while
+    it is down.  The first error of each kind is logged with its
+    traceback; the same error again within `interval` seconds is only
+    counted, and the count is logged with the next message let through.
+    """
+    def __init__(self, interval=ERROR_LOG_INTERVAL):
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._errors = {}
+
+    def error(self, message, error):
+        kind = type(error).__name__
+        with self._lock:
+            logged_at, suppressed = self._errors.get(kind, (None, 0))
+            if logged_at is not None and monotonic() - logged_at < self._interval:
+                self._errors[kind] = (logged_at, suppressed + 1)
+                return
+            self._errors[kind] = (monotonic(), 0)
+        if logged_at is None:
+            logging.error(message)
+            logging.exception(error)
+        else:
+            logging.error(f"{message} {error} (repeated {suppressed} times since it was last logged)")
+
+    def reset(self):
+        with self._lock:
+            self._errors = {}
 
 
 class LdapServer:
+    """
+    An LDAP server, reached through a pool of up to `pool_size`
+    connections, so that collections running in parallel each use
+    their own connection.
+
+    Connections are opened when they are first needed, and one which
+    has been idle for `idle_check` seconds is checked with a WhoAmI
+    request before it is used, as pipelined searches are not retried
+    on a connection the server has dropped.  A connection which fails
+    is closed, and replaced on the next request.
+
+    Failing requests trip a circuit breaker, so that while the server
+    is down requests are refused at once instead of each waiting for
+    the timeout, and retried after an exponential backoff.
+
+    Searches below their base are read `page_size` entries at a time
+    with the Simple Paged Results control, or all at once if it is 0.
+    """
     def __init__(self,
                  server_uri,
                  user_dn=None,
@@ -29,50 +154,195 @@ class LdapServer:
                  cert_file=None,
                  key_file=None,
                  sasl_mech=None,
-                 timeout=-1):
+                 timeout=-1,
+                 pool_size=2,
+                 idle_check=60,
+                 failure_threshold=2,
+                 backoff=1,
+                 max_backoff=300,
+                 page_size=500):
         if database is None:
             database = server_uri
 
-        self.connection = None
-        self.bound = False
         self.database = database
         self.user_dn = user_dn
         self.user_password = user_password
         self.sasl_mech = sasl_mech
+        self.timeout = timeout
+        self.page_size = page_size
 
-        self.connect_to_ldap(
-            server_uri=server_uri,
-            start_tls=start_tls,
-            ca_file=ca_file,
-            cert_file=cert_file,
-            key_file=key_file,
-            timeout=timeout
-        )
-
-    def connect_to_ldap(self, server_uri, start_tls=False, ca_file=None, cert_file=None, key_file=None, timeout=-1):
         if server_uri is None:
             logging.error(f"Failing to configure LDAP server {self.database} because no URI was supplied.")
             raise ValueError(f"An LDAP server URI must be defined for {self.database}")
+        if cert_file and not key_file:
+            logging.error(f"Certificate file specified, but no key file specified for {self.database}")
+            raise ValueError(f"Certificate file specified, but no key file specified for {self.database}")
+        if pool_size is None or pool_size < 1:
+            logging.error(f"The connection pool of {self.database} needs at least one connection, not {pool_size}")
+            raise ValueError(f"The connection pool of {self.database} needs at least one connection, not {pool_size}")
+        if page_size is None or page_size < 0:
+            logging.error(f"The page size of {self.database} must not be negative, not {page_size}")
+            raise ValueError(f"The page size of {self.database} must not be negative, not {page_size}")
+        if start_tls:
+            logging.info(f"Using StartTLS for {self.database}")
 
-        self.connection = ldap.ldapobject.ReconnectLDAPObject(server_uri)
-        self.connection.timeout = timeout
+        self._connection_args = {
+            'server_uri': server_uri,
+            'start_tls': start_tls,
+            'ca_file': ca_file,
+            'cert_file': cert_file,
+            'key_file': key_file,
+            'timeout': timeout,
+        }
+        self._pool_size = pool_size
+        self._idle_check = idle_check
+        self._pool_lock = threading.Condition()
+        self._idle = []
+        self._open = 0
+        # Connections lost since the last bind, to count the rebinds
+        self._lost = 0
+        self._closed = False
+        self._breaker = CircuitBreaker(
+            failure_threshold=failure_threshold,
+            backoff=backoff,
+            max_backoff=max_backoff
+        )
+        self._error_log = ErrorLog()
 
-        if ca_file:
-            self.connection.set_option(ldap.OPT_X_TLS_CACERTFILE, ca_file)
-        if cert_file:
-            if not key_file:
-                logging.error(f"Certificate file specified, but no key file specified for {self.database}")
-                raise ValueError(f"Certificate file specified, but no key file specified for {self.database}")
-            self.connection.set_option(ldap.OPT_X_TLS_CERTFILE, cert_file)
-            self.connection.set_option(ldap.OPT_X_TLS_KEYFILE, key_file)
-        if ca_file or cert_file:
-            self.connection.set_option(ldap.OPT_X_TLS_NEWCTX, 0)
+    @contextmanager
+    def connection(self):
+        """
+        Check a connection out of the pool for the duration of the
+        block.  A connection which fails with a connection error is
+        closed instead of being returned to the pool.
+        """
+        connection = self.checkout()
+        broken = False
+        try:
+            yield connection
+        except CONNECTION_ERRORS:
+            broken = True
+            raise
+        finally:
+            self.checkin(connection, broken)
 
-        if start_tls:
-            logging.info(f"Using StartTLS for {self.database}")
-            self.connection.protocol_version = ldap.VERSION3
-            self.connection.set_option(ldap.OPT_X_TLS_NEWCTX, 0)
-            self.connection.start_tls_s()
+    def checkout(self):
+        start = monotonic()
+        with self._pool_lock:
+            while not self._idle and self._open >= self._pool_size:
+                if not self._pool_lock.wait(self.timeout if self.timeout and self.timeout > 0 else None):
+                    raise ldap.TIMEOUT({'desc': f"No connection to {self.database} became free"})
+            connection = self._idle.pop() if self._idle else None
+            if connection is None:
+                self._open += 1
+        instrumentation.record(instrumentation.POOL_WAIT, monotonic() - start, database=self.database)
+
+        if connection is not None and monotonic() - connection.last_used >= self._idle_check:
+            if not connection.is_alive():
+                logging.info(f"An idle connection to {self.database} was lost, reconnecting")
+                connection.close()
+                connection = None
+                with self._pool_lock:
+                    self._lost += 1
+        if connection is None:
+            try:
+                connection = LdapConnection(**self._connection_args)
+            except BaseException:
+                with self._pool_lock:
+                    self._open -= 1
+                    self._pool_lock.notify()
+                raise
+        self.record_pool()
+        return connection
+
+    def checkin(self, connection, broken=False):
+        connection.last_used = monotonic()
+        with self._pool_lock:
+            if broken or self._closed:
+                self._open -= 1
+                if broken:
+                    self._lost += 1
+            else:
+                self._idle.append(connection)
+            self._pool_lock.notify()
+        if broken or self._closed:
+            connection.close()
+        self.record_pool()
+
+    def close(self):
+        """
+        Close the idle connections, and those in use once they are
+        returned.
+        """
+        with self._pool_lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for connection in idle:
+            connection.close()
+
+    def open_connection(self, ldap_class=None):
+        """
+        Open and bind a connection outside the pool, for a long-lived
+        session which would otherwise hold a pooled connection forever.
+        The caller closes it.
+        """
+        connection = LdapConnection(ldap_class=ldap_class, **self._connection_args)
+        try:
+            self.bind(connection)
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    def record_pool(self):
+        with self._pool_lock:
+            open_connections = self._open
+            in_use = self._open - len(self._idle)
+        instrumentation.record(instrumentation.POOL_CONNECTIONS, open_connections, database=self.database)
+        instrumentation.record(instrumentation.POOL_IN_USE, in_use, database=self.database)
+
+    def bind(self, connection):
+        if not connection.bind(self.user_dn, self.user_password, self.sasl_mech):
+            return
+        instrumentation.record(instrumentation.BINDS, 1, database=self.database)
+        with self._pool_lock:
+            rebind = self._lost > 0
+            if rebind:
+                self._lost -= 1
+        if rebind:
+            instrumentation.record(instrumentation.REBINDS, 1, database=self.database)
+
+    def available(self):
+        """
+        Whether a request may be sent to the server.  While the server
+        is failing, requests are refused until its backoff has passed.
+        """
+        if self._breaker.allow():
+            return True
+        logging.debug(f"Skipping a request to {self.database}, which is failing")
+        instrumentation.record(instrumentation.CIRCUIT_SKIPS, 1, database=self.database)
+        return False
+
+    def succeeded(self):
+        if self._breaker.succeeded():
+            logging.warning(f"LDAP server {self.database} is answering again")
+            self._error_log.reset()
+            instrumentation.record(instrumentation.CIRCUIT_OPEN, 0, database=self.database)
+
+    def failed(self, error, message):
+        self.report_error(error, message)
+        self.trip()
+
+    def trip(self):
+        backoff = self._breaker.failed()
+        if backoff is not None:
+            logging.warning(f"LDAP server {self.database} is failing, skipping it for {backoff}s")
+            instrumentation.record(instrumentation.CIRCUIT_OPEN, 1, database=self.database)
+
+    def report_error(self, error, message):
+        instrumentation.record_error(error, self.database)
+        self._error_log.error(message, error)
 
     def query(self, dn=None, scope=ldap.SCOPE_SUBTREE, attr_list=None):
         logging.debug(f"Querying {self.database} for {dn}")
@@ -81,24 +351,182 @@ class LdapServer:
         if dn is None:
             logging.error("INTERNAL ERROR: Could not run a query because no DN was supplied")
             raise ValueError('Must specify a DN to query')
+        if not self.available():
+            return []
 
         try:
-            if not self.bound:
-                if self.sasl_mech:
-                    if self.sasl_mech == 'EXTERNAL':
-                        self.connection.sasl_external_bind_s()
-                    else:
-                        logging.error(f"INTERNAL ERROR: Unsupported SASL mechanism {self.sasl_mech}")
-                        raise ValueError(f"Unsupported SASL mechanism {self.sasl_mech}")
-                else:
-                    self.connection.simple_bind_s(self.user_dn, self.user_password)
-                self.bound = True
-            return self.connection.search_s(dn, scope=scope, attrlist=attr_list)
-        except (ldap.SERVER_DOWN, ldap.NO_SUCH_OBJECT, ldap.TIMEOUT) as error:
-            self.bound = False
-            logging.error('Could not query LDAP:')
-            logging.exception(error)
+            with self.connection() as connection:
+                self.bind(connection)
+                result = connection.connection.search_s(dn, scope=scope, attrlist=attr_list)
+        except ldap.NO_SUCH_OBJECT as error:
+            self.succeeded()
+            self.report_error(error, f"Could not query LDAP server {self.database} for {dn}:")
+            return []
+        except CONNECTION_ERRORS as error:
+            self.failed(error, f"Could not query LDAP server {self.database}:")
             return []
+        self.succeeded()
+        return result
+
+    def query_many(self, queries):
+        """
+        Run several searches over one connection at once, as
+        `stream_many()` does, and keep their results.  Each query is a
+        mapping of the arguments accepted by `query()`, plus an optional
+        `filter_str`.  The results are returned in the same order as the
+        queries, with an empty list for each search that failed.
+        """
+        results = [[] for _ in queries]
+        completed = self.stream_many(
+            queries,
+            lambda index, entry_dn, entry_attributes: results[index].append((entry_dn, entry_attributes))
+        )
+        return [result if done else [] for result, done in zip(results, completed)]
+
+    def stream_many(self, queries, on_entry):
+        """
+        Run several searches over one connection at once, and hand each
+        entry to `on_entry(index, dn, attributes)`, with the index of its
+        query, as it arrives rather than keeping the results.
+
+        Every search of a single entry is sent before any reply is read,
+        so the round trips overlap and the whole batch costs roughly one
+        round trip instead of one per search.  Searches below their base
+        are read a page at a time, the next page being asked for once the
+        last is read, so neither end holds a whole subtree at once.  As a
+        server keeps the paging state of one search per connection, each
+        is only sent once the one before it has been read.  The control
+        is not critical, so a server which cannot page sends every entry
+        at once instead.  Returns whether each search
+        completed; the entries of one which failed part way have been
+        handed over already.
+        """
+        queries = normalize_queries(queries)
+        completed = [False for _ in queries]
+        if not self.available():
+            return completed
+        try:
+            with self.connection() as connection:
+                self.bind(connection)
+                # The paged searches are sent in turn, as they are read
+                msgids = [None if self.paged(query) else self.search(connection, query) for query in queries]
+                timed_out = self.read_searches(connection, queries, msgids, on_entry, completed)
+        except CONNECTION_ERRORS as error:
+            self.failed(error, f"Could not query LDAP server {self.database}:")
+            return completed
+        if timed_out:
+            self.trip()
+        else:
+            self.succeeded()
+        return completed
+
+    def read_searches(self, connection, queries, msgids, on_entry, completed):
+        """
+        Read the searches sent for the queries in turn, marking those
+        which complete, and return whether any timed out.
+        """
+        start = monotonic()
+        timed_out = False
+        deadline = None
+        if self.timeout is not None and self.timeout >= 0:
+            deadline = start + self.timeout
+        for index, msgid in enumerate(msgids):
+            try:
+                entries, attributes = self.read_search(
+                    connection, queries[index], msgid, deadline,
+                    lambda entry_dn, entry_attributes: on_entry(index, entry_dn, entry_attributes)
+                )
+                completed[index] = True
+                self.record_search(queries[index]['dn'], monotonic() - start, entries, attributes)
+            except ldap.NO_SUCH_OBJECT as error:
+                self.report_error(error, f"Could not query LDAP server {self.database} "
+                                         f"for {queries[index]['dn']}:")
+            except ldap.TIMEOUT as error:
+                timed_out = True
+                self.report_error(error, f"Could not query LDAP server {self.database} "
+                                         f"for {queries[index]['dn']}:")
+            except ldap.SERVER_DOWN:
+                raise
+            except Exception:
+                # Leave no search running on a connection going back to the pool
+                for pending in msgids[index + 1:]:
+                    if pending is not None:
+                        connection.connection.abandon(pending)
+                raise
+        return timed_out
+
+    def read_search(self, connection, query, msgid, deadline, on_entry):
+        """
+        Read the entries of a search, a page at a time, and hand each to
+        `on_entry(dn, attributes)`, sending it first if `msgid` is None.
+        Returns the number of entries and of attribute values read.  A
+        search which times out or fails on this end is abandoned.
+        """
+        if msgid is None:
+            msgid = self.search(connection, query)
+        entries = attributes = 0
+        try:
+            while msgid is not None:
+                result_type, result_data, result_controls = self.read_result(connection, msgid, deadline)
+                if result_type == ldap.RES_SEARCH_ENTRY:
+                    for entry_dn, entry_attributes in result_data:
+                        entries += 1
+                        attributes += sum(len(values) for values in entry_attributes.values())
+                        on_entry(entry_dn, entry_attributes)
+                elif result_type == ldap.RES_SEARCH_RESULT:
+                    cookie = page_cookie(result_controls)
+                    msgid = self.search(connection, query, cookie) if cookie else None
+        except (ldap.NO_SUCH_OBJECT, ldap.SERVER_DOWN):
+            raise
+        except Exception:
+            connection.connection.abandon(msgid)
+            raise
+        return entries, attributes
+
+    def read_result(self, connection, msgid, deadline):
+        """
+        Wait until the deadline, if there is one, for the next reply to a
+        search, and return its type, data and controls.
+        """
+        timeout = -1 if deadline is None else max(deadline - monotonic(), 0)
+        result_type, result_data, result_msgid, result_controls = connection.connection.result3(
+            msgid, all=0, timeout=timeout
+        )
+        if result_type is None:
+            # Polling once the deadline has passed returns nothing rather than raising
+            raise ldap.TIMEOUT({'desc': f"No reply from {self.database} in time"})
+        return result_type, result_data, result_controls
+
+    def search(self, connection, query, cookie=''):
+        """
+        Send a search, asking for the page after `cookie` if it is
+        below its base, and return its message ID.
+        """
+        logging.debug(f"Querying {self.database} for {query['dn']}")
+        server_controls = None
+        if self.paged(query):
+            server_controls = [
+                ldap.controls.SimplePagedResultsControl(criticality=False, size=self.page_size, cookie=cookie)
+            ]
+        return connection.connection.search_ext(
+            query['dn'],
+            query['scope'],
+            filterstr=query['filter_str'],
+            attrlist=query['attr_list'],
+            serverctrls=server_controls
+        )
+
+    def paged(self, query):
+        return bool(self.page_size) and query['scope'] != ldap.SCOPE_BASE
+
+    def record_search(self, dn, duration, entries, attributes):
+        """
+        Record the cost of one search.  Searches of a batch overlap, so
+        the duration runs from the start of the batch.
+        """
+        instrumentation.record(instrumentation.SEARCH_DURATION, duration, database=self.database, query_dn=dn)
+        instrumentation.record(instrumentation.SEARCH_ENTRIES, entries, database=self.database, query_dn=dn)
+        instrumentation.record(instrumentation.SEARCH_ATTRIBUTES, attributes, database=self.database, query_dn=dn)
 
     def query_dn_and_attribute(self, dn, attribute):
         results = self.query(dn, scope=ldap.SCOPE_BASE, attr_list=[attribute])
@@ -109,3 +537,45 @@ class LdapServer:
         if attribute not in result_attributes:
             return None
         return result_attributes.get(attribute)
+
+
+def normalize_queries(queries):
+    """
+    Fill in the defaults of each query of a batch, and check each has a DN.
+    """
+    queries = [
+        {
+            'dn': query.get('dn'),
+            'scope': query.get('scope', ldap.SCOPE_SUBTREE),
+            'attr_list': query.get('attr_list') or ['+'],
+            'filter_str': query.get('filter_str', '(objectClass=*)'),
+        }
+        for query in queries
+    ]
+    if any(query['dn'] is None for query in queries):
+        logging.error("INTERNAL ERROR: Could not run a query because no DN was supplied")
+        raise ValueError('Must specify a DN to query')
+    return queries
+
+
+def page_cookie(controls):
+    """
+    The cookie asking for the next page of a search, which is empty
+    once the last page has been sent.
+    """
+    for control in controls or []:
+        if control.controlType == ldap.controls.SimplePagedResultsControl.controlType:
+            return control.cookie
+    return None
+
+
+def dn_filter(dns):
+    """
+    Build a search filter that only matches the entries with the given DNs.
+    """
+    terms = [f"(entryDN={ldap.filter.escape_filter_chars(dn)})" for dn in sorted(dns)]
+    if not terms:
+        return '(objectClass=*)'
+    if len(terms) == 1:
+        return terms[0]
+    return f"(|{''.join(terms)})"
@@ -14,9 +14,46 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import logging
+import threading
+from time import monotonic
 
 from opencensus.stats import measure, view, aggregation, stats
 
+from openldap_opencensus_stats.aggregations import create_aggregation, same_aggregation
+from openldap_opencensus_stats.counter_history import CounterHistory, DERIVATIONS
+from openldap_opencensus_stats.value_function import compile_value_function
+
+# The views registered for statistics, by name, so that a statistic
+# rebuilt by a reload records into the view already registered
+_views = {}
+
+
+def get_view(name, description, unit, tag_keys, view_aggregation):
+    """
+    Return the view registered under the name, registering it first if
+    there is none.
+    """
+    registered_view = _views.get(name)
+    if registered_view is None:
+        registered_view = view.View(
+            name=name,
+            description=description,
+            columns=tag_keys,
+            aggregation=view_aggregation,
+            measure=measure.MeasureFloat(
+                name=name,
+                description=description,
+                unit=unit
+            )
+        )
+        stats.stats.view_manager.register_view(registered_view)
+        _views[name] = registered_view
+    elif (registered_view.measure.unit != unit or
+          registered_view.description != description or
+          not same_aggregation(registered_view.aggregation, view_aggregation)):
+        logging.warning(f"The unit, description or aggregator of {name} has changed, restart to apply the change")
+    return registered_view
+
 
 class LdapStatistic:
 
@@ -33,7 +70,12 @@ class LdapStatistic:
                  unit='By',
                  value_function='value',
                  query_dn=None,
-                 tag_keys=None):
+                 tag_keys=None,
+                 derive=None,
+                 rate_window=2,
+                 aggregator=None,
+                 buckets=None,
+                 tags=None):
         if tag_keys is None:
             tag_keys = []
         if dn is None:
@@ -48,24 +90,72 @@ class LdapStatistic:
         self.attribute = attribute
         self.dn = dn
         self.query_dn = query_dn
-        self.measure = measure.MeasureFloat(
-            name=name,
-            description=description,
-            unit=unit
-        )
+        self.unit = unit
+        self.description = description
+        self._value_function = compile_value_function(value_function)
+        self.derive = sorted(derive or [])
+        for derivation in self.derive:
+            if derivation not in DERIVATIONS:
+                self.log_and_raise(f"Cannot derive {derivation} from {name}, choose from: {', '.join(DERIVATIONS)}")
+        if self.derive and (rate_window is None or rate_window < 2):
+            self.log_and_raise(f"The rate window of {name} must be at least 2 samples, not {rate_window}")
+        self.rate_window = rate_window
+        self.aggregator = aggregator
+        self.buckets = buckets
+        # The values of the tags other than the database, for children tagged by name
+        self.tags = dict(tags or {})
 
-        self.view = view.View(
-            name=name,
-            description=description,
-            columns=tag_keys,
-            aggregation=aggregation.LastValueAggregation(),
-            measure=self.measure
-        )
-        stats.stats.view_manager.register_view(self.view)
-        self._value_function = lambda value: eval(value_function)
+        self.view = get_view(name, description, unit, tag_keys, create_aggregation(aggregator, buckets))
+        self.measure = self.view.measure
+
+        # The statistics derived from the counter, and its history on each server
+        self._derived_measures = self.derive_measures(name, tag_keys)
+        self._histories = {}
+        self._histories_lock = threading.Lock()
+
+    def derive_measures(self, name, tag_keys):
+        """
+        Return the measure of each statistic derived from the counter.
+        """
+        derived_measures = {}
+        if 'rate' in self.derive:
+            derived_measures['rate'] = get_view(
+                f"{name}/rate", f"{self.description} (per second)", f"{self.unit}/s",
+                tag_keys, aggregation.LastValueAggregation()
+            ).measure
+        if 'delta' in self.derive:
+            derived_measures['delta'] = get_view(
+                f"{name}/delta", f"{self.description} (increase since the last collection)", self.unit,
+                tag_keys, aggregation.LastValueAggregation()
+            ).measure
+        if 'resets' in self.derive:
+            derived_measures['resets'] = get_view(
+                f"{name}/resets", f"{self.description} (resets)", '1',
+                tag_keys, aggregation.CountAggregation()
+            ).measure
+        return derived_measures
 
     def display_name(self):
-        return f"{self.measure.name}:{self.attribute}"
+        tags = ''.join(f"{{{key}={value}}}" for key, value in sorted(self.tags.items()))
+        return f"{self.measure.name}{tags}:{self.attribute}"
+
+    def matches(self, definition):
+        """
+        Whether this statistic collects what the statistic definition describes.
+        """
+        return (
+            self.dn == definition.dn and
+            self.attribute == definition.attribute and
+            self.query_dn == definition.query_dn and
+            self.unit == definition.unit and
+            self.description == definition.description and
+            self._value_function.expression == definition.value_function and
+            self.derive == sorted(definition.derive or []) and
+            self.rate_window == definition.rate_window and
+            self.aggregator == definition.aggregator and
+            self.buckets == definition.buckets and
+            self.tags == definition.tags
+        )
 
     def collect(self, ldap_server=None, measurement_map=None, ldap_value=None):
         def display_name(server, statistic):
@@ -89,3 +179,25 @@ class LdapStatistic:
         if ldap_value_float != value:
             logging.debug(f"  Transformed into: {value}")
         measurement_map.measure_float_put(self.measure, value)
+        if self.derive:
+            self.collect_derived(ldap_server, measurement_map, value)
+
+    def collect_derived(self, ldap_server, measurement_map, value):
+        # Statistics are shared by the servers, which are collected at once
+        with self._histories_lock:
+            history = self._histories.get(ldap_server.database)
+            if history is None:
+                history = self._histories[ldap_server.database] = CounterHistory(self.rate_window)
+        if history.add(monotonic(), value):
+            logging.info(f"{ldap_server.database}:{self.display_name()} was reset")
+            if 'resets' in self._derived_measures:
+                measurement_map.measure_float_put(self._derived_measures['resets'], 1)
+        derived = {}
+        if 'rate' in self._derived_measures:
+            derived['rate'] = history.rate()
+        if 'delta' in self._derived_measures:
+            derived['delta'] = history.delta()
+        for derivation, derived_value in derived.items():
+            # A negative value would make OpenCensus drop the whole measurement map
+            if derived_value is not None and derived_value >= 0:
+                measurement_map.measure_float_put(self._derived_measures[derivation], derived_value)
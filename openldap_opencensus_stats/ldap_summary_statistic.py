@@ -0,0 +1,222 @@
+import heapq
+import logging
+import re
+
+from opencensus.stats import aggregation
+
+from openldap_opencensus_stats.aggregations import create_aggregation
+from openldap_opencensus_stats.ldap_statistic import get_view
+from openldap_opencensus_stats.value_function import compile_value_function
+
+# The summaries which may be computed over the children of a `children` definition
+SUMMARIES = ['count', 'sum', 'min', 'max', 'top']
+# The values of children queued to go through the value function at once
+SAMPLE_BATCH = 256
+
+
+class LdapSummaryStatistic:
+    """
+    An attribute of every child of a DN whose RDN matches a pattern,
+    summarized as it is collected instead of being recorded for each
+    child.  Each summary is a view of its own, `{name}/count` and so
+    on, and `{name}/top` records the `top` largest values with a `rank`
+    tag, so neither memory nor the exported series grow with the number
+    of children.
+    """
+
+    @staticmethod
+    def log_and_raise(message=''):
+        logging.error(message)
+        raise ValueError(message)
+
+    def __init__(self,
+                 dn=None,
+                 name=None,
+                 attribute=None,
+                 child_pattern=None,
+                 summarize=None,
+                 top=5,
+                 description='Unspecified',
+                 unit='By',
+                 value_function='value',
+                 tag_keys=None,
+                 aggregator=None,
+                 buckets=None,
+                 tags=None):
+        if tag_keys is None:
+            tag_keys = []
+        if dn is None:
+            self.log_and_raise('Statistics definition must include the dn attribute')
+        if name is None:
+            self.log_and_raise('Statistics definition must include a name for the statistic')
+        if attribute is None:
+            self.log_and_raise('Statistics definition must include the attribute to query')
+        if not child_pattern:
+            self.log_and_raise(f"The summaries of {name} need an 'rdn' to match the children against")
+        self.summarize = sorted(summarize or [])
+        self.check_summaries(name, top)
+
+        self.dn = dn
+        self.query_dn = dn
+        self.attribute = attribute
+        self.child_pattern = child_pattern
+        self._child_pattern = re.compile(child_pattern)
+        self.top = top
+        self.unit = unit
+        self.description = description
+        self._value_function = compile_value_function(value_function)
+        self.aggregator = aggregator
+        self.buckets = buckets
+        self.tags = dict(tags or {})
+        self.name = name
+
+        self._measures = self.summary_measures(name, tag_keys)
+
+    def check_summaries(self, name, top):
+        """
+        Check the summaries asked for, and the number of top values.
+        """
+        if not self.summarize:
+            self.log_and_raise(f"Nothing to summarize for {name}, choose from: {', '.join(SUMMARIES)}")
+        for summary in self.summarize:
+            if summary not in SUMMARIES:
+                self.log_and_raise(f"Cannot summarize {name} by {summary}, choose from: {', '.join(SUMMARIES)}")
+        if 'top' in self.summarize and (not isinstance(top, int) or top < 1):
+            self.log_and_raise(f"The top of {name} must be at least 1 value, not {top}")
+
+    def summary_measures(self, name, tag_keys):
+        """
+        Return the measure of each summary, registering its view.
+        """
+        measures = {}
+        if 'count' in self.summarize:
+            measures['count'] = get_view(
+                f"{name}/count", f"{self.description} (children)", '1',
+                tag_keys, aggregation.LastValueAggregation()
+            ).measure
+        for summary, summary_description in [('sum', 'total'), ('min', 'smallest'), ('max', 'largest')]:
+            if summary in self.summarize:
+                measures[summary] = get_view(
+                    f"{name}/{summary}", f"{self.description} ({summary_description} of the children)", self.unit,
+                    tag_keys, create_aggregation(self.aggregator, self.buckets)
+                ).measure
+        if 'top' in self.summarize:
+            measures['top'] = get_view(
+                f"{name}/top", f"{self.description} (largest of the children, by rank)", self.unit,
+                tag_keys + ['rank'], create_aggregation(self.aggregator, self.buckets)
+            ).measure
+        return measures
+
+    def display_name(self):
+        tags = ''.join(f"{{{key}={value}}}" for key, value in sorted(self.tags.items()))
+        return f"{self.name}{tags}:{self.attribute}"
+
+    def matches(self, definition):
+        """
+        Whether this statistic collects what the statistic definition describes.
+        """
+        return (
+            self.dn == definition.dn and
+            self.attribute == definition.attribute and
+            self.child_pattern == definition.child_pattern and
+            self.summarize == sorted(definition.summarize or []) and
+            self.top == definition.top and
+            self.unit == definition.unit and
+            self.description == definition.description and
+            self._value_function.expression == definition.value_function and
+            self.aggregator == definition.aggregator and
+            self.buckets == definition.buckets and
+            self.tags == definition.tags
+        )
+
+    def new_summary(self):
+        return ChildrenSummary(self.top if 'top' in self._measures else 0, self._value_function)
+
+    def add_child(self, summary, child_dn, attributes):
+        """
+        Add a child to a summary, if its RDN matches and it has the attribute.
+        """
+        ldap_value = attributes.get(self.attribute)
+        if not ldap_value or not self._child_pattern.match(re.sub(r',.*', '', child_dn)):
+            return
+        summary.add_sample(float(ldap_value[0]))
+
+    def collect(self, ldap_server=None, measurement_maps=None, children=None, summary=None):
+        """
+        Record the summaries of the attribute over the entries of a one
+        level search of the DN: either `children`, or a `summary` they
+        were added to as they arrived.  `measurement_maps` returns the
+        measurement map for a set of tags, as the ranks of the top values
+        are recorded apart.
+        """
+        if ldap_server is None:
+            self.log_and_raise(f"INTERNAL ERROR: Failing to collect statistic {self.display_name()} "
+                               f"because no LDAP server supplied.")
+        if measurement_maps is None:
+            self.log_and_raise(f"INTERNAL ERROR: Failing to collect statistic {self.display_name()} "
+                               f"because no measurement map was supplied.")
+
+        if summary is None:
+            summary = self.new_summary()
+            for child_dn, attributes in children or []:
+                self.add_child(summary, child_dn, attributes)
+        summary.flush()
+        logging.debug(f"Summarized {summary.count} children for {ldap_server.database}:{self.display_name()}")
+
+        measurement_map = measurement_maps(self.tags)
+        summaries = {'count': summary.count, 'sum': summary.total, 'min': summary.smallest, 'max': summary.largest}
+        for name, value in summaries.items():
+            # OpenCensus drops the whole measurement map for a negative value
+            if name in self._measures and value is not None and value >= 0:
+                measurement_map.measure_float_put(self._measures[name], value)
+        if 'top' in self._measures:
+            for rank, value in enumerate(sorted(summary.values, reverse=True), start=1):
+                if value >= 0:
+                    measurement_maps(dict(self.tags, rank=str(rank))).measure_float_put(self._measures['top'], value)
+
+
+class ChildrenSummary:
+    """
+    The count, sum, smallest, largest and `top` largest of the values
+    of the children seen so far.  The collected samples are queued, and
+    go through the value function `SAMPLE_BATCH` at a time; `flush()`
+    applies it to those still queued.
+    """
+    def __init__(self, top=0, value_function=None):
+        self.top = top
+        self.count = 0
+        self.total = 0.0
+        self.smallest = None
+        self.largest = None
+        # A heap of the largest values seen so far, never longer than the top
+        self.values = []
+        self._value_function = value_function
+        self._samples = []
+
+    def add_sample(self, sample):
+        if self._value_function is None:
+            self.add_many([sample])
+            return
+        self._samples.append(sample)
+        if len(self._samples) >= SAMPLE_BATCH:
+            self.flush()
+
+    def flush(self):
+        if self._samples:
+            samples, self._samples = self._samples, []
+            self.add_many(self._value_function.apply_many(samples))
+
+    def add_many(self, values):
+        if not values:
+            return
+        self.count += len(values)
+        self.total += sum(values)
+        self.smallest = min(values) if self.smallest is None else min(self.smallest, min(values))
+        self.largest = max(values) if self.largest is None else max(self.largest, max(values))
+        if not self.top:
+            return
+        for value in values:
+            if len(self.values) < self.top:
+                heapq.heappush(self.values, value)
+            elif value > self.values[0]:
+                heapq.heapreplace(self.values, value)
@@ -15,7 +15,8 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import logging
 
-from opencensus.stats import measure, view, aggregation, stats
+from openldap_opencensus_stats.aggregations import create_aggregation
+from openldap_opencensus_stats.ldap_statistic import get_view
 
 
 class LdapSyncStatistic:
@@ -30,34 +31,18 @@ class LdapSyncStatistic:
                  description='Undescribed',
                  unit='ms',
                  tag_keys=None,
-                 report=False):
+                 report=False,
+                 aggregator=None,
+                 buckets=None):
         if name is None:
             self.log_and_raise('Statistics definition must include a name for the statistic')
         self.name = name
         self.report = report
         tag_keys = tag_keys or ['BaseDN', 'rid']
 
-        self.measure = self.generate_measure(description, name, unit)
-        self.view = self.generate_view(description, name, tag_keys, self.measure)
-        stats.stats.view_manager.register_view(self.view)
-
-    @staticmethod
-    def generate_view(description, name, tag_keys, stat_measure):
-        return view.View(
-            name=name,
-            description=description,
-            columns=tag_keys,
-            aggregation=aggregation.LastValueAggregation(),
-            measure=stat_measure
-        )
-
-    @staticmethod
-    def generate_measure(description, name, unit):
-        return measure.MeasureFloat(
-            name=name,
-            description=description,
-            unit=unit
-        )
+        # A sync metric set rebuilt by a reload records into the view already registered
+        self.view = get_view(name, description, unit, tag_keys, create_aggregation(aggregator, buckets))
+        self.measure = self.view.measure
 
     def display_name(self,
                      ldap_server=None):
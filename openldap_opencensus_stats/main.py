@@ -17,7 +17,12 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
-from openldap_opencensus_stats.configuration import Configuration
+
+from openldap_opencensus_stats.collector import CollectionEngine
+from openldap_opencensus_stats.configuration import Configuration, read_shards
+from openldap_opencensus_stats.reloader import ConfigurationReloader
+from openldap_opencensus_stats.scheduler import Scheduler
+from openldap_opencensus_stats.supervisor import Supervisor
 
 
 def parse_command_line():
@@ -29,12 +34,48 @@ def parse_command_line():
 
 def monitor():
     args = parse_command_line()
-    configuration = Configuration(args.config_file)
+    shards = read_shards(args.config_file)
+    if shards > 1:
+        Supervisor(args.config_file, shards).run()
+        return
+    run(args.config_file, Configuration(args.config_file))
+
+
+def run(config_file_name, configuration, on_collected=None):
+    configuration.start_rediscovery()
+    reloader = ConfigurationReloader(
+        configuration,
+        config_file_name,
+        watch_interval=configuration.watch_interval()
+    )
+    engine = CollectionEngine(
+        max_workers=configuration.max_workers(),
+        on_collected=on_collected or configuration.render_exporters
+    )
+    scrape_trigger = configuration.scrape_trigger()
+    if scrape_trigger is not None:
+        # Collection is driven by the Prometheus scrapes
+        scrape_trigger.start(engine, configuration.metric_sets(), deadline=configuration.pull_deadline())
+        while True:
+            reloader.wait()
+            reloader.reload_if_requested()
+
+    scheduler = Scheduler(
+        engine,
+        period=configuration.period(),
+        deadline=configuration.deadline(),
+        jitter=configuration.jitter()
+    )
     while True:
-        metric_sets = configuration.metric_sets()
-        for metric_set in metric_sets:
-            metric_set.collect()
-        configuration.sleep()
+        scheduler.run_once(configuration.metric_sets())
+        reloader.wait(scheduler.delay(configuration.metric_sets()))
+        if reloader.reload_if_requested():
+            scheduler.configure(
+                period=configuration.period(),
+                deadline=configuration.deadline(),
+                jitter=configuration.jitter()
+            )
+            scheduler.forget(configuration.metric_sets())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,38 @@
+import atexit
+from time import time
+
+from openldap_opencensus_stats.push_pipeline import HttpSender, PushPipeline
+from openldap_opencensus_stats.text_exporter import merge_text, render_text
+
+
+class PushExporter:
+    """
+    Pushes the statistics in the Prometheus text format to an HTTP
+    endpoint, such as the import API of a Prometheus compatible
+    database, through a push pipeline.
+
+    The statistics are rendered once each collection cycle, with every
+    sample stamped with the time, so the cycles held back while the
+    endpoint is down keep their times when they are sent.  The cycles
+    in a batch are merged, so each metric is described once.
+    """
+    def __init__(self, url=None, namespace='openldap', name='push', timeout=10, **pipeline_options):
+        self.namespace = namespace
+        # Where the statistics are taken from, if not the views of this process
+        self.families = None
+        self.pipeline = PushPipeline(
+            HttpSender(url, timeout=timeout, compressed=pipeline_options.get('compress', True)),
+            name=name,
+            join=merge_text,
+            **pipeline_options
+        )
+        atexit.register(self.pipeline.close)
+
+    def render(self):
+        payload = render_text(
+            self.namespace,
+            timestamp=int(time() * 1000),
+            families=self.families() if self.families else None
+        )
+        if payload:
+            self.pipeline.put(payload)
@@ -0,0 +1,314 @@
+import gzip
+import logging
+import os
+import shutil
+import struct
+import threading
+import urllib.error
+import urllib.request
+from collections import deque
+from time import monotonic
+
+from openldap_opencensus_stats import instrumentation
+from openldap_opencensus_stats.circuit_breaker import CircuitBreaker
+
+# Each spooled batch is prefixed with its length
+BATCH_HEADER = struct.Struct('>I')
+# The client errors which may pass when the batch is sent again
+TRANSIENT_HTTP_ERRORS = [408, 425, 429]
+
+
+class RejectedBatch(Exception):
+    """
+    Raised by a sender when the endpoint refuses a batch for good, so
+    sending it again cannot help.
+    """
+
+
+class HttpSender:
+    """
+    Sends a batch to an HTTP endpoint in a POST request, and raises if
+    the endpoint does not accept it: `RejectedBatch` for a client error,
+    as the batch itself is at fault, or the error otherwise.
+    """
+    def __init__(self, url, timeout=10, content_type='text/plain; version=0.0.4', compressed=True, headers=None):
+        if not url:
+            logging.error('A push endpoint needs a URL')
+            raise ValueError('A push endpoint needs a URL')
+        self.url = url
+        self.timeout = timeout
+        self.headers = {'Content-Type': content_type}
+        if compressed:
+            self.headers['Content-Encoding'] = 'gzip'
+        self.headers.update(headers or {})
+
+    def __call__(self, batch):
+        request = urllib.request.Request(self.url, data=batch, headers=self.headers, method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+        except urllib.error.HTTPError as error:
+            if 400 <= error.code < 500 and error.code not in TRANSIENT_HTTP_ERRORS:
+                raise RejectedBatch(f"{self.url} rejected the batch: HTTP {error.code} {error.reason}") from error
+            raise
+
+
+class Spool:
+    """
+    An append-only file of the batches which could not be pushed.  They
+    are replayed oldest first once the endpoint recovers, and the file
+    is then cut down to those not yet sent, so no batch is sent twice.
+    A batch which would grow the file past `max_bytes` is dropped.
+    """
+    def __init__(self, path, max_bytes=64 * 1024 * 1024):
+        if not max_bytes or max_bytes < 1:
+            logging.error(f"The spool needs room for at least 1 byte, not {max_bytes}")
+            raise ValueError(f"The spool needs room for at least 1 byte, not {max_bytes}")
+        self.path = path
+        self.max_bytes = max_bytes
+        self._size = os.path.getsize(path) if os.path.exists(path) else 0
+        if self._size:
+            logging.info(f"{self._size} bytes are spooled in {path}, to be pushed")
+
+    def size(self):
+        return self._size
+
+    def append(self, batch):
+        """
+        Append a batch, and return whether there was room for it.
+        """
+        if self._size + BATCH_HEADER.size + len(batch) > self.max_bytes:
+            return False
+        with open(self.path, 'ab') as spool:
+            spool.write(BATCH_HEADER.pack(len(batch)) + batch)
+        self._size += BATCH_HEADER.size + len(batch)
+        return True
+
+    def replay(self, send, rejected=None):
+        """
+        Send the spooled batches, oldest first.  A failure is raised, and
+        the batches sent until then are removed from the file.  Batches
+        the endpoint rejects are handed to `rejected` and passed over.
+        """
+        if not self._size:
+            return
+        with open(self.path, 'rb') as spool:
+            sent_up_to = 0
+            try:
+                for batch in read_batches(spool):
+                    try:
+                        send(batch)
+                    except RejectedBatch as error:
+                        if rejected is None:
+                            raise
+                        rejected(error)
+                    sent_up_to = spool.tell()
+            except Exception:
+                if sent_up_to:
+                    self.compact(spool, sent_up_to)
+                raise
+        os.remove(self.path)
+        self._size = 0
+
+    def compact(self, spool, offset):
+        spool.seek(offset)
+        with open(f"{self.path}.tmp", 'wb') as rest:
+            shutil.copyfileobj(spool, rest)
+        os.replace(f"{self.path}.tmp", self.path)
+        self._size = os.path.getsize(self.path)
+
+
+def read_batches(spool):
+    while True:
+        header = spool.read(BATCH_HEADER.size)
+        if len(header) < BATCH_HEADER.size:
+            return
+        length, = BATCH_HEADER.unpack(header)
+        batch = spool.read(length)
+        if len(batch) < length:
+            # Cut short, as when the process stopped while writing it
+            logging.warning(f"Dropping a partial batch at the end of {spool.name}")
+            return
+        yield batch
+
+
+class PushPipeline:
+    """
+    Pushes records to an endpoint from a thread of its own, so a slow or
+    failing endpoint never holds up a collection.
+
+    Records wait in a queue of at most `queue_size`, the oldest being
+    dropped when it is full.  They are sent in batches of up to
+    `batch_size` records, or of what has been queued `batch_interval`
+    seconds after the first, joined by `join`, and compressed with gzip
+    if `compress`.
+    A batch the endpoint rejects, raising `RejectedBatch`, is dropped.
+    After any other failure, the endpoint is left alone for `backoff` seconds,
+    doubled with each failure up to `max_backoff`.  With a `spool_file`,
+    the batches which cannot be sent meanwhile are appended to it, and
+    are sent before anything else once the endpoint recovers; without
+    one, the failed batch is retried while the queue fills behind it.
+    """
+    def __init__(self,
+                 send,
+                 name='push',
+                 queue_size=1000,
+                 batch_size=100,
+                 batch_interval=5,
+                 compress=True,
+                 join=b''.join,
+                 backoff=1,
+                 max_backoff=300,
+                 spool_file=None,
+                 spool_max_bytes=64 * 1024 * 1024):
+        if queue_size is None or batch_size is None or queue_size < 1 or batch_size < 1:
+            logging.error(f"The push queue and batches need room for at least 1 record, "
+                          f"not {queue_size} and {batch_size}")
+            raise ValueError(f"The push queue and batches need room for at least 1 record, "
+                             f"not {queue_size} and {batch_size}")
+        if batch_interval is None or batch_interval < 0:
+            logging.error(f"The push batch interval must not be negative, not {batch_interval}")
+            raise ValueError(f"The push batch interval must not be negative, not {batch_interval}")
+        self.name = name
+        self._send = send
+        self._queue_size = queue_size
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._compress = compress
+        self._join = join
+        self._breaker = CircuitBreaker(failure_threshold=1, backoff=backoff, max_backoff=max_backoff)
+        self._spool = Spool(spool_file, spool_max_bytes) if spool_file else None
+        # The records waiting, each with the time it was queued
+        self._queue = deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        # Whether records are being dropped, so that it is only logged when it starts
+        self._dropping = False
+        self._thread = threading.Thread(target=self.run, name=f"{name}-pipeline", daemon=True)
+        self._thread.start()
+
+    def put(self, record):
+        dropped = 0
+        with self._condition:
+            if len(self._queue) >= self._queue_size:
+                self._queue.popleft()
+                dropped = 1
+                if not self._dropping:
+                    logging.warning(f"The {self.name} queue is full, dropping its oldest records")
+                self._dropping = True
+            self._queue.append((monotonic(), record))
+            queued = len(self._queue)
+            # Wakes the pipeline to start the batch interval, or to send a full batch
+            self._condition.notify()
+        if dropped:
+            instrumentation.record(instrumentation.PUSH_DROPPED, dropped, exporter=self.name)
+        instrumentation.record(instrumentation.PUSH_QUEUE, queued, exporter=self.name)
+
+    def backlog(self):
+        """
+        The records queued, and the bytes spooled.
+        """
+        with self._condition:
+            queued = len(self._queue)
+        return queued, self._spool.size() if self._spool is not None else 0
+
+    def next_batch(self):
+        """
+        Wait for a batch, and return it encoded, or None once the
+        pipeline is closed.  While batches are spooled, an empty batch is
+        returned after `batch_interval`, so they are sent even when
+        nothing new is queued.
+        """
+        with self._condition:
+            while not self._queue and not self._closed:
+                if self._spool is not None and self._spool.size():
+                    self._condition.wait(self._batch_interval or 1)
+                    if not self._queue and not self._closed:
+                        return b''
+                else:
+                    self._condition.wait()
+            if not self._queue:
+                return None
+            due = self._queue[0][0] + self._batch_interval
+            while len(self._queue) < self._batch_size and not self._closed and monotonic() < due:
+                self._condition.wait(due - monotonic())
+            records = [self._queue.popleft()[1] for _ in range(min(self._batch_size, len(self._queue)))]
+            queued = len(self._queue)
+            self._dropping = False
+        instrumentation.record(instrumentation.PUSH_QUEUE, queued, exporter=self.name)
+        payload = self._join(records)
+        return gzip.compress(payload) if self._compress else payload
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            try:
+                self.deliver(batch)
+            except Exception as error:
+                logging.error(f"Failed to deliver a batch to {self.name}:")
+                logging.exception(error)
+
+    def deliver(self, batch):
+        while not self.attempt(batch):
+            if self._spool is not None:
+                if batch:
+                    self.spool(batch)
+                return
+            with self._condition:
+                if self._closed:
+                    logging.warning(f"Dropping a batch {self.name} could not take before closing")
+                    return
+                # Woken early only by closing; the circuit breaker decides when to retry
+                self._condition.wait(1)
+
+    def attempt(self, batch):
+        """
+        Send the spooled batches, then the batch, unless the circuit
+        breaker holds off, and return whether they were all sent.
+        """
+        if not self._breaker.allow():
+            return False
+        try:
+            if self._spool is not None:
+                self._spool.replay(self._send, rejected=self.reject)
+            if batch:
+                self._send(batch)
+                instrumentation.record(instrumentation.PUSH_BATCHES, 1, exporter=self.name)
+        except RejectedBatch as error:
+            # The endpoint is up, and only the batch is at fault
+            self.reject(error)
+        except Exception as error:
+            backoff = self._breaker.failed()
+            logging.warning(f"Failed to push to {self.name}, retrying in {backoff}s: {error}")
+            instrumentation.record(instrumentation.PUSH_FAILURES, 1, exporter=self.name)
+            return False
+        if self._breaker.succeeded():
+            logging.info(f"Pushing to {self.name} has recovered")
+        self.record_spool()
+        return True
+
+    def reject(self, error):
+        logging.warning(f"Dropping a batch {self.name} rejected: {error}")
+        instrumentation.record(instrumentation.PUSH_DROPPED, 1, exporter=self.name)
+
+    def spool(self, batch):
+        if not self._spool.append(batch):
+            logging.warning(f"The {self.name} spool is full, dropping a batch")
+            instrumentation.record(instrumentation.PUSH_DROPPED, 1, exporter=self.name)
+        self.record_spool()
+
+    def record_spool(self):
+        if self._spool is not None:
+            instrumentation.record(instrumentation.PUSH_SPOOL, self._spool.size(), exporter=self.name)
+
+    def close(self, timeout=5):
+        """
+        Stop waiting to fill batches, and give the pipeline `timeout`
+        seconds to send or spool what is queued.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join(timeout)
@@ -0,0 +1,157 @@
+import logging
+
+import ldap
+import ldap.dn
+
+from openldap_opencensus_stats.ldap_server import dn_filter
+
+SCOPE_NAMES = {
+    ldap.SCOPE_BASE: 'base',
+    ldap.SCOPE_ONELEVEL: 'one',
+    ldap.SCOPE_SUBTREE: 'sub',
+}
+
+
+class QueryPlanner:
+    """
+    Plans the searches needed to collect a set of statistics.
+
+    Each statistic names the DN it is read from and the query DN that
+    was configured for it.  Query DNs nested inside another query DN
+    are folded into the outermost one, so each part of the tree is
+    searched once.  Each remaining search is then re-rooted at the
+    closest common ancestor of its target DNs, and given the narrowest
+    scope which still reaches all of them:
+    * base, when the only target is the search root
+    * one level, when every target is an immediate child of the root
+    * subtree, otherwise
+
+    The children of a DN which are summarized get a one-level search of
+    their own, marked with `children_of`, so that their entries can be
+    told apart from the others.
+
+    The plan is computed once, and recomputed only when statistics are
+    added or removed.
+    """
+    def __init__(self):
+        self._targets = {}
+        self._children = {}
+        self._plan = None
+
+    def add(self, query_dn, dn, attribute):
+        # Attributes are counted, as several statistics may read the same one
+        attributes = self._targets.setdefault(normalize_dn(query_dn), {}).setdefault(normalize_dn(dn), {})
+        attributes[attribute] = attributes.get(attribute, 0) + 1
+        self._plan = None
+
+    def remove(self, query_dn, dn, attribute):
+        query_dn = normalize_dn(query_dn)
+        dn = normalize_dn(dn)
+        attributes = self._targets.get(query_dn, {}).get(dn, {})
+        if attribute not in attributes:
+            return
+        attributes[attribute] -= 1
+        if not attributes[attribute]:
+            del attributes[attribute]
+        if not attributes:
+            del self._targets[query_dn][dn]
+        if not self._targets[query_dn]:
+            del self._targets[query_dn]
+        self._plan = None
+
+    def add_children(self, dn, attribute):
+        attributes = self._children.setdefault(normalize_dn(dn), {})
+        attributes[attribute] = attributes.get(attribute, 0) + 1
+        self._plan = None
+
+    def remove_children(self, dn, attribute):
+        dn = normalize_dn(dn)
+        attributes = self._children.get(dn, {})
+        if attribute not in attributes:
+            return
+        attributes[attribute] -= 1
+        if not attributes[attribute]:
+            del attributes[attribute]
+        if not attributes:
+            del self._children[dn]
+        self._plan = None
+
+    def plan(self):
+        if self._plan is None:
+            self._plan = self.build_plan()
+            logging.debug(f"Query plan:\n{self.describe()}")
+        return self._plan
+
+    def build_plan(self):
+        roots = {}
+        for query_dn in sorted(self._targets, key=len):
+            root = next((root for root in roots if is_descendant(query_dn, root)), query_dn)
+            targets = roots.setdefault(root, {})
+            for dn, attributes in self._targets[query_dn].items():
+                targets.setdefault(dn, set()).update(attributes)
+
+        plan = []
+        for root in sorted(roots):
+            targets = roots[root]
+            search_dn = common_ancestor(targets)
+            attr_list = sorted(set().union(*targets.values()))
+            if set(targets) == {search_dn}:
+                scope = ldap.SCOPE_BASE
+                filter_str = '(objectClass=*)'
+            elif all(parent_dn(dn) == search_dn for dn in targets):
+                scope = ldap.SCOPE_ONELEVEL
+                filter_str = dn_filter(targets)
+            else:
+                scope = ldap.SCOPE_SUBTREE
+                filter_str = dn_filter(targets)
+            plan.append({
+                'dn': search_dn,
+                'scope': scope,
+                'attr_list': attr_list,
+                'filter_str': filter_str,
+            })
+        for dn in sorted(self._children):
+            plan.append({
+                'dn': dn,
+                'scope': ldap.SCOPE_ONELEVEL,
+                'attr_list': sorted(self._children[dn]),
+                'filter_str': '(objectClass=*)',
+                'children_of': dn,
+            })
+        return plan
+
+    def describe(self):
+        return '\n'.join(
+            f"  {SCOPE_NAMES[query['scope']]} {query['dn']} {query['filter_str']} {','.join(query['attr_list'])}"
+            for query in self.plan()
+        )
+
+
+def normalize_dn(dn):
+    """
+    Return a canonical form of the DN, so that DNs which differ only in
+    case or spacing compare equal.
+    """
+    try:
+        return ldap.dn.dn2str(ldap.dn.str2dn(dn)).lower()
+    except ldap.DECODING_ERROR:
+        return dn.lower()
+
+
+def is_descendant(dn, ancestor_dn):
+    return dn == ancestor_dn or not ancestor_dn or dn.endswith(',' + ancestor_dn)
+
+
+def parent_dn(dn):
+    rdns = ldap.dn.explode_dn(dn)
+    return ','.join(rdns[1:])
+
+
+def common_ancestor(dns):
+    exploded = [list(reversed(ldap.dn.explode_dn(dn))) for dn in dns]
+    common = []
+    for rdns in zip(*exploded):
+        if any(rdn != rdns[0] for rdn in rdns):
+            break
+        common.append(rdns[0])
+    return ','.join(reversed(common))
@@ -0,0 +1,71 @@
+import logging
+import os
+import signal
+import threading
+from time import monotonic
+
+
+class ConfigurationReloader:
+    """
+    Reloads the configuration on SIGHUP, or when the configuration file
+    is modified.
+
+    The signal handler only records the request; the configuration is
+    reloaded by the main loop, between collections, when it calls
+    `reload_if_requested()`.  A configuration which fails to load is
+    logged, and the running configuration is kept.
+    """
+    def __init__(self, configuration, config_file_name, watch_interval=5):
+        self._configuration = configuration
+        self._config_file_name = config_file_name
+        self._watch_interval = watch_interval
+        self._requested = threading.Event()
+        self._modified = self.modification_time()
+        self._checked = monotonic()
+        signal.signal(signal.SIGHUP, self.request)
+
+    def request(self, signum=None, frame=None):
+        self._requested.set()
+
+    def modification_time(self):
+        try:
+            return os.stat(self._config_file_name).st_mtime_ns
+        except OSError:
+            return None
+
+    def check_file(self):
+        if not self._watch_interval or monotonic() - self._checked < self._watch_interval:
+            return
+        self._checked = monotonic()
+        modified = self.modification_time()
+        if modified is not None and modified != self._modified:
+            self._modified = modified
+            logging.info(f"The configuration file {self._config_file_name} has changed")
+            self._requested.set()
+
+    def wait(self, timeout=None):
+        """
+        Wait up to `timeout` seconds, or until a reload is requested.
+        """
+        if self._watch_interval and (timeout is None or timeout > self._watch_interval):
+            timeout = self._watch_interval
+        self._requested.wait(timeout)
+
+    def reload_if_requested(self):
+        """
+        Reload the configuration if it was requested, and return whether
+        it was reloaded.
+        """
+        self.check_file()
+        if not self._requested.is_set():
+            return False
+        self._requested.clear()
+        logging.warning(f"Reloading the configuration from {self._config_file_name}")
+        try:
+            self._configuration.reconfigure()
+        except Exception as error:
+            logging.error('Could not reload the configuration, keeping the running configuration:')
+            logging.exception(error)
+            return False
+        self._watch_interval = self._configuration.watch_interval()
+        return True
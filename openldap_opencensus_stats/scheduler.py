@@ -0,0 +1,101 @@
+import logging
+import random
+from time import monotonic
+
+from openldap_opencensus_stats import instrumentation
+
+
+class Scheduler:
+    """
+    Runs the collection of each metric set on its own period.
+
+    Collection times are fixed points on a grid anchored at start up,
+    rather than a pause after each collection, so the time spent
+    collecting does not make the interval drift.  Each metric set
+    starts at a random offset within its first period, so servers
+    sharing a period are not all queried at the same instant.
+
+    Collections are started without waiting for them to finish, so a
+    hung server only delays its own metric sets.  When a collection is
+    still running at the next collection time of its metric set, or
+    runs past the deadline, the missed collection is skipped rather
+    than queued, and is counted as an overrun.
+    """
+    def __init__(self, engine, period=5, deadline=None, jitter=True):
+        self._engine = engine
+        self.configure(period=period, deadline=deadline, jitter=jitter)
+        self._next_due = {}
+        self.overruns = {}
+
+    def period(self, metric_set):
+        return metric_set.period or self._period
+
+    def schedule(self, metric_sets):
+        now = monotonic()
+        for metric_set in metric_sets:
+            if metric_set not in self._next_due:
+                offset = random.uniform(0, self.period(metric_set)) if self._jitter else 0
+                self._next_due[metric_set] = now + offset
+                self.overruns[metric_set] = 0
+
+    def run_once(self, metric_sets):
+        """
+        Start collecting the metric sets which are due, without waiting
+        for them, and advance the schedule of each.
+        """
+        self.schedule(metric_sets)
+        for metric_set in self._engine.overdue():
+            self.count_overruns(metric_set, 1)
+        now = monotonic()
+        due = [metric_set for metric_set in metric_sets if self._next_due[metric_set] <= now]
+        if not due:
+            return
+        deadline = self._deadline
+        if deadline is None:
+            deadline = min(self.period(metric_set) for metric_set in due)
+        # Skipped as their previous collection is still running
+        for metric_set in self._engine.dispatch(due, deadline=deadline):
+            self.count_overruns(metric_set, 1)
+
+        for metric_set in due:
+            period = self.period(metric_set)
+            next_due = self._next_due[metric_set] + period
+            if next_due <= now:
+                missed = int((now - next_due) // period) + 1
+                next_due += missed * period
+                self.count_overruns(metric_set, missed)
+                logging.warning(f"Collection for {metric_set.display_name()} fell {missed} period(s) of "
+                                f"{period}s behind its schedule, skipping them")
+            self._next_due[metric_set] = next_due
+
+    def count_overruns(self, metric_set, overruns):
+        # A collection which overran may belong to a metric set retired since
+        if metric_set in self.overruns:
+            self.overruns[metric_set] += overruns
+        instrumentation.record(instrumentation.OVERRUNS, overruns, metric_set=metric_set.display_name())
+
+    def configure(self, period=5, deadline=None, jitter=True):
+        if not period or period <= 0:
+            logging.error(f"The collection period must be positive, not {period}")
+            raise ValueError(f"The collection period must be positive, not {period}")
+        self._period = period
+        self._deadline = deadline
+        self._jitter = jitter
+
+    def forget(self, metric_sets):
+        """
+        Drop the schedule of metric sets which are no longer collected.
+        """
+        for metric_set in set(self._next_due) - set(metric_sets):
+            del self._next_due[metric_set]
+            del self.overruns[metric_set]
+
+    def delay(self, metric_sets):
+        """
+        Return the number of seconds until the next metric set is due.
+        """
+        self.schedule(metric_sets)
+        if not metric_sets:
+            return self._period
+        next_due = min(self._next_due[metric_set] for metric_set in metric_sets)
+        return max(next_due - monotonic(), 0)
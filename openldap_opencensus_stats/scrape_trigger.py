@@ -0,0 +1,56 @@
+import logging
+import threading
+from time import monotonic
+
+
+class ScrapeTrigger:
+    """
+    Collects the metric sets when the Prometheus exporter is scraped.
+
+    It is registered as a collector with the Prometheus registry ahead
+    of the OpenCensus exporter, so every scrape first refreshes the
+    statistics, then reads them.  A collection is reused for `ttl`
+    seconds, and scrapes which arrive while a collection is running
+    wait for it rather than starting another, so a pair of Prometheus
+    servers scraping at once costs one round of LDAP queries.  Those
+    scrapes wait no longer than the `deadline` of the collection.
+    """
+    def __init__(self, ttl=5):
+        if ttl is None or ttl < 0:
+            logging.error(f"The scrape cache TTL must not be negative, not {ttl}")
+            raise ValueError(f"The scrape cache TTL must not be negative, not {ttl}")
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._collected_at = None
+        self._engine = None
+        self._metric_sets = []
+        self._deadline = None
+
+    def start(self, engine, metric_sets, deadline=None):
+        self._engine = engine
+        self._metric_sets = metric_sets
+        self._deadline = deadline
+
+    def set_metric_sets(self, metric_sets):
+        self._metric_sets = metric_sets
+
+    def set_deadline(self, deadline):
+        self._deadline = deadline
+
+    def describe(self):
+        # Nothing is exported from here; this also stops the registry
+        # from collecting when the trigger is registered
+        return []
+
+    def collect(self):
+        self.refresh()
+        return []
+
+    def refresh(self):
+        if self._engine is None:
+            return
+        with self._lock:
+            if self._collected_at is not None and monotonic() - self._collected_at < self._ttl:
+                return
+            self._collected_at = monotonic()
+            self._engine.collect(self._metric_sets, deadline=self._deadline)
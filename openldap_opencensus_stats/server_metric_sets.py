@@ -0,0 +1,47 @@
+from openldap_opencensus_stats.ldap_metric_set import MetricSet
+
+
+class ServerMetricSets:
+    """
+    The metric sets of one LDAP server: one for each period given to
+    its statistics.  Statistics are added and retired as the children
+    of its `children` definitions come and go.
+    """
+    def __init__(self, ldap_server, compiler, statistic_factory):
+        self._ldap_server = ldap_server
+        self._compiler = compiler
+        self._statistic_factory = statistic_factory
+        self._metric_sets = {}
+        # The statistic collected for each definition
+        self._statistics = {}
+
+    def add(self, definitions):
+        for definition in definitions:
+            statistic = self._statistic_factory(definition)
+            if definition.period not in self._metric_sets:
+                self._metric_sets[definition.period] = MetricSet(
+                    ldap_server=self._ldap_server,
+                    period=definition.period
+                )
+            self._metric_sets[definition.period].add_statistic(statistic)
+            self._statistics[definition] = statistic
+
+    def remove(self, definitions):
+        for definition in definitions:
+            statistic = self._statistics.pop(definition, None)
+            if statistic is not None:
+                self._metric_sets[definition.period].remove_statistic(statistic)
+
+    def rediscover(self):
+        """
+        Search again for the children of the `children` definitions.
+        Return the definitions to add and those to retire, for `apply`.
+        """
+        return self._compiler.rediscover()
+
+    def apply(self, added, removed):
+        self.remove(removed)
+        self.add(added)
+
+    def metric_sets(self):
+        return list(self._metric_sets.values())
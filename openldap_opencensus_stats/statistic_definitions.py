@@ -0,0 +1,296 @@
+import logging
+import re
+
+import ldap
+
+from openldap_opencensus_stats.discovery import DiscoveryCache
+
+
+class StatisticDefinition:
+    """
+    A fully resolved statistic from the `object` configuration: the
+    entry and attribute to read, and how to name and record it.
+    """
+    def __init__(self,
+                 dn,
+                 name,
+                 attribute,
+                 unit,
+                 query_dn,
+                 description='',
+                 value_function='value',
+                 period=None,
+                 derive=None,
+                 rate_window=2,
+                 aggregator=None,
+                 buckets=None,
+                 tags=None,
+                 child_pattern=None,
+                 summarize=None,
+                 top=5):
+        self.dn = dn
+        self.name = name
+        self.attribute = attribute
+        self.unit = unit
+        self.query_dn = query_dn
+        self.description = description
+        self.value_function = value_function
+        self.period = period
+        self.derive = derive or []
+        self.rate_window = rate_window
+        self.aggregator = aggregator
+        self.buckets = buckets
+        self.tags = tags or {}
+        # The pattern of the children whose attribute is summarized, and how
+        self.child_pattern = child_pattern
+        self.summarize = summarize
+        self.top = top
+
+    def __repr__(self):
+        return f"StatisticDefinition({self.name}: {self.dn} {self.attribute})"
+
+
+class ChildrenExpansion:
+    """
+    A `children` definition as it was expanded: where it sits in the
+    configuration, and the statistic definitions compiled for each
+    child which matched.
+    """
+    def __init__(self, config, dn, metric_name, query_dn, period, tags):
+        self.config = config
+        self.dn = dn
+        self.metric_name = metric_name
+        self.query_dn = query_dn
+        self.period = period
+        self.tags = tags
+        self.children = {}
+
+
+class StatisticCompiler:
+    """
+    Compiles the `object` configuration for one LDAP server into a flat
+    list of statistic definitions.
+
+    The configuration is walked once.  On the way down, each object
+    definition resolves its DN from its `rdn` and its parent's DN, its
+    metric name from its parent's name and its own `name` or key, and
+    the DN to query from the outermost object above it.  `children`
+    definitions are expanded from a one-level search of the parent DN,
+    and `{rdn.N}` and `{attr.X}` in names are interpolated for each
+    child.  The one-level search also fetches the attributes the names
+    need, and the searches go through the discovery cache.
+
+    A `children` definition with a `tag` leaves the interpolated name
+    out of the metric names, and gives it as the value of that tag
+    instead, so all the children share one metric of each name.  One
+    with `summarize` is not expanded at all: each of its metrics becomes
+    a single definition, summarized over the children as it is collected.
+    """
+    def __init__(self, ldap_server, discovery_cache=None):
+        self._ldap_server = ldap_server
+        self._discovery_cache = discovery_cache or DiscoveryCache()
+        self.expansions = []
+
+    def compile(self, object_config, period=None):
+        definitions = []
+        if isinstance(object_config, dict):
+            self.compile_objects(object_config, definitions, dn='', metric_name='', query_dn=None, period=period,
+                                 tags={})
+        return definitions
+
+    def compile_objects(self, objects, definitions, dn, metric_name, query_dn, period, tags):
+        for key, config in objects.items():
+            if not isinstance(config, dict):
+                continue
+            if key == 'children':
+                self.compile_children(config, definitions, dn, metric_name, query_dn, period, tags)
+            elif config.get('rdn'):
+                child_dn = join_dn(config['rdn'], dn)
+                self.compile_object(config, definitions, key, child_dn, config['rdn'], metric_name, query_dn, period,
+                                    tags)
+            elif config.get('attribute'):
+                self.compile_metric(config, definitions, key, dn, metric_name, query_dn, period, tags)
+
+    def compile_children(self, config, definitions, dn, metric_name, query_dn, period, tags):
+        pattern = config.get('rdn')
+        if not pattern:
+            logging.error(f"The children of {dn} need an 'rdn' to match them against")
+            raise ValueError(f"The children of {dn} need an 'rdn' to match them against")
+        tag = config.get('tag')
+        if tag is not None and (
+                not re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', str(tag)) or tag in ['database', 'rank'] or tag in tags):
+            logging.error(f"The children of {dn} cannot be tagged with '{tag}'")
+            raise ValueError(f"The children of {dn} cannot be tagged with '{tag}'")
+        if config.get('summarize'):
+            self.compile_summaries(config, definitions, dn, metric_name, period, tags)
+            return
+        expansion = ChildrenExpansion(config, dn, metric_name, query_dn, period, tags)
+        self.expansions.append(expansion)
+        children = self.get_children(dn, name_attributes(config.get('name', '')))
+        for child_dn, attributes in children.items():
+            if re.match(pattern, re.sub(r',.*', '', child_dn)):
+                definitions.extend(self.compile_child(expansion, child_dn, attributes))
+
+    def compile_summaries(self, config, definitions, dn, metric_name, period, tags):
+        if config.get('tag') or isinstance(config.get('object'), dict):
+            logging.error(f"The summarized children of {dn} cannot have a tag or objects of their own")
+            raise ValueError(f"The summarized children of {dn} cannot have a tag or objects of their own")
+        period = config.get('period', period)
+        for metric_key, metric_config in (config.get('metric') or {}).items():
+            if isinstance(metric_config, dict) and metric_config.get('attribute'):
+                if metric_config.get('derive'):
+                    logging.warning(f"Nothing is derived from {metric_key}, as the children of {dn} are summarized")
+                self.compile_metric(metric_config, definitions, metric_key, dn, metric_name, dn, period, tags,
+                                    child_pattern=config['rdn'], summarize=as_list(config['summarize']),
+                                    top=config.get('top', 5))
+
+    def compile_child(self, expansion, child_dn, attributes):
+        rdn = re.sub(r',.*', '', child_dn)
+        key = re.sub(r',.*', '', re.sub(r'^[^=]*=', '', child_dn))
+        definitions = []
+        self.compile_object(expansion.config, definitions, key, child_dn, rdn, expansion.metric_name,
+                            expansion.query_dn, expansion.period, expansion.tags, attributes=attributes,
+                            tag=expansion.config.get('tag'))
+        expansion.children[child_dn] = definitions
+        return definitions
+
+    def rediscover(self):
+        """
+        Search again for the children of every `children` definition, and
+        return the statistic definitions of the children which appeared
+        and of those which disappeared.  Only the children which changed
+        are compiled.
+        """
+        added = []
+        removed = []
+        for expansion in list(self.expansions):
+            if expansion not in self.expansions:
+                # Retired along with a child it was expanded under
+                continue
+            pattern = expansion.config.get('rdn')
+            children = self._discovery_cache.refresh(
+                self._ldap_server,
+                expansion.dn,
+                ldap.SCOPE_ONELEVEL,
+                name_attributes(expansion.config.get('name', ''))
+            )
+            if not children:
+                # The server may be unreachable; keep what was discovered
+                continue
+            children = dict(
+                (child_dn, attributes)
+                for child_dn, attributes in children.items()
+                if re.match(pattern, re.sub(r',.*', '', child_dn))
+            )
+            for child_dn in set(expansion.children) - set(children):
+                logging.info(f"{child_dn} has gone from LDAP database {self._ldap_server.database}")
+                removed.extend(expansion.children.pop(child_dn))
+                self.expansions = [
+                    other for other in self.expansions
+                    if not other.dn.lower().endswith(child_dn.lower())
+                ]
+            for child_dn in set(children) - set(expansion.children):
+                logging.info(f"{child_dn} has appeared on LDAP database {self._ldap_server.database}")
+                added.extend(self.compile_child(expansion, child_dn, children[child_dn]))
+        return added, removed
+
+    def compile_object(self, config, definitions, key, dn, rdn, metric_name, query_dn, period, tags,
+                       attributes=None, tag=None):
+        query_dn = query_dn or config.get('query_dn') or dn
+        period = config.get('period', period)
+        name = key
+        if 'name' in config:
+            if attributes is None and name_attributes(config['name']):
+                attributes = self.get_attributes(dn, name_attributes(config['name']))
+            name = self.interpolate_name(config['name'], config.get('rdn'), rdn, attributes or {})
+        if tag:
+            tags = dict(tags, **{tag: name})
+        else:
+            metric_name = join_name(metric_name, name)
+
+        for metric_key, metric_config in (config.get('metric') or {}).items():
+            if isinstance(metric_config, dict) and metric_config.get('attribute'):
+                self.compile_metric(metric_config, definitions, metric_key, dn, metric_name, query_dn, period, tags)
+        if isinstance(config.get('object'), dict):
+            self.compile_objects(config['object'], definitions, dn, metric_name, query_dn, period, tags)
+
+    def compile_metric(self, config, definitions, key, dn, metric_name, query_dn, period, tags,
+                       child_pattern=None, summarize=None, top=5):
+        # Named metrics are lowercased, as object names are
+        name = join_name(metric_name, config['name'].lower() if 'name' in config else key)
+        if not config.get('unit'):
+            logging.warning(f"Skipping the statistic {name} because it has no unit")
+            return
+        definitions.append(StatisticDefinition(
+            dn=dn,
+            name=name,
+            attribute=config['attribute'],
+            unit=config['unit'],
+            query_dn=query_dn or config.get('query_dn') or dn,
+            description=config.get('description', ''),
+            value_function=config.get('func', 'value'),
+            period=config.get('period', period),
+            derive=as_list(config.get('derive')),
+            rate_window=config.get('rate_window', 2),
+            aggregator=config.get('aggregator'),
+            buckets=config.get('buckets'),
+            tags=tags,
+            child_pattern=child_pattern,
+            summarize=summarize,
+            top=top
+        ))
+
+    def get_children(self, dn, attributes):
+        children = self._discovery_cache.search(self._ldap_server, dn, ldap.SCOPE_ONELEVEL, attributes)
+        if not children:
+            logging.warning(f"Found no child objects for {dn} on LDAP database {self._ldap_server.database}!")
+        return children
+
+    def get_attributes(self, dn, attributes):
+        entries = self._discovery_cache.search(self._ldap_server, dn, ldap.SCOPE_BASE, attributes)
+        return next(iter(entries.values()), {})
+
+    @staticmethod
+    def interpolate_name(name, pattern, rdn, attributes):
+        attributes = dict((attribute.lower(), values) for attribute, values in attributes.items())
+
+        def repl_func(matches):
+            groups = matches.groups()
+            if 'rdn' == groups[0]:
+                rdn_matches = re.match(pattern or '', rdn or '')
+                if rdn_matches:
+                    return rdn_matches.group(int(groups[1]))
+            elif 'attr' == groups[0]:
+                values = attributes.get(groups[1].lower())
+                if values:
+                    return values[0]
+            else:
+                logging.error(f"Unknown interpolation requested in name: {groups[0]}.{groups[1]}")
+            return ''
+
+        return re.sub(
+            '{([^\\.}]+)\\.([^}]+)}',
+            repl_func,
+            name
+        ).lower()
+
+
+def name_attributes(name):
+    """
+    Return the attributes interpolated into a name by `{attr.X}`.
+    """
+    return re.findall(r'{attr\.([^}]+)}', name or '')
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+def join_dn(rdn, dn):
+    return f"{rdn},{dn}" if dn else rdn
+
+
+def join_name(prefix, name, separator='/'):
+    return f"{prefix}{separator}{name}" if prefix else name
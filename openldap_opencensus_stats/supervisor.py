@@ -0,0 +1,202 @@
+import logging
+import logging.config
+import multiprocessing
+import os
+import signal
+import threading
+from time import monotonic, sleep
+
+from openldap_opencensus_stats import instrumentation
+from openldap_opencensus_stats.config_transformers.base import ConfigurationTransformationChainSingleton
+from openldap_opencensus_stats.configuration import Configuration, create_exporter, read_yaml_file
+from openldap_opencensus_stats.text_exporter import snapshot
+
+SHARD_EXPORTERS = ['PrometheusText', 'Push']
+
+
+class Supervisor:
+    """
+    Splits the collection across `shards` worker processes, each
+    collecting the LDAP servers and sync entries which hash to it, and
+    restarts those which stop, waiting `restart_backoff` seconds,
+    doubled with each restart in a row up to `max_restart_backoff`.
+
+    Each worker sends a snapshot of its views over a pipe at the end of
+    its collection cycles.  The supervisor merges the latest snapshot of
+    each worker with its own views, and renders them to its exporters,
+    so the shards are served from a single endpoint.  A worker's
+    snapshot is dropped when it stops, rather than served stale.
+
+    SIGHUP is passed on to the workers, so they reload the configuration.
+    """
+    def __init__(self, config_file_name, shards, restart_backoff=1, max_restart_backoff=60):
+        normalized_configuration = ConfigurationTransformationChainSingleton().transform_configuration(
+            read_yaml_file(config_file_name)
+        )
+        log_config = normalized_configuration.get('log_config')
+        if log_config and isinstance(log_config, dict):
+            log_config['version'] = log_config.get('version', 1)
+            logging.config.dictConfig(log_config)
+        if normalized_configuration.get('pull') is not None:
+            logging.error("Pull mode cannot be used with shards.")
+            raise ValueError("Pull mode cannot be used with shards.")
+
+        instrumentation.register_views()
+        self._exporters = []
+        for exporter_configuration in normalized_configuration.get('exporters', []):
+            name = exporter_configuration.get('name')
+            if name not in SHARD_EXPORTERS:
+                logging.error(f"The {name} exporter cannot be used with shards.  Choose from: "
+                              f"{', '.join(SHARD_EXPORTERS)}")
+                raise ValueError(f"The {name} exporter cannot be used with shards.  Choose from: "
+                                 f"{', '.join(SHARD_EXPORTERS)}")
+            exporter = create_exporter(exporter_configuration)
+            exporter.families = self.families
+            self._exporters.append(exporter)
+
+        self._config_file_name = config_file_name
+        self._shards = shards
+        self._restart_backoff = restart_backoff
+        self._max_restart_backoff = max_restart_backoff
+        self._context = multiprocessing.get_context('spawn')
+        self._workers = [None] * shards
+        self._started_at = [0] * shards
+        self._restart_at = [None] * shards
+        self._backoff = [restart_backoff] * shards
+        # The latest snapshot of each running worker
+        self._snapshots = {}
+        self._lock = threading.Lock()
+        self._changed = False
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self.forward_reload)
+        for shard in range(self._shards):
+            self.start(shard)
+        while True:
+            sleep(1)
+            self.check_workers()
+            with self._lock:
+                changed, self._changed = self._changed, False
+            if changed:
+                self.render_exporters()
+
+    def forward_reload(self, signum=None, frame=None):
+        """
+        Pass a reload on to the workers, which each reload the
+        configuration of their shard.
+        """
+        for shard, worker in enumerate(self._workers):
+            if worker is None or not worker.is_alive():
+                continue
+            try:
+                os.kill(worker.pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+            logging.info(f"Reloading shard {shard}")
+
+    def start(self, shard):
+        receiver, sender = self._context.Pipe(duplex=False)
+        worker = self._context.Process(
+            target=run_shard,
+            args=(self._config_file_name, shard, self._shards, sender),
+            name=f"shard-{shard}",
+            daemon=True
+        )
+        worker.start()
+        # Only the worker writes to the pipe, so the receiver sees it close when the worker stops
+        sender.close()
+        self._workers[shard] = worker
+        self._started_at[shard] = monotonic()
+        self._restart_at[shard] = None
+        threading.Thread(
+            target=self.receive,
+            args=(shard, receiver),
+            name=f"shard-{shard}-receiver",
+            daemon=True
+        ).start()
+        logging.info(f"Started shard {shard} of {self._shards}, process {worker.pid}")
+
+    def receive(self, shard, receiver):
+        while True:
+            try:
+                families = receiver.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                self._snapshots[shard] = families
+                self._changed = True
+        receiver.close()
+        with self._lock:
+            self._snapshots.pop(shard, None)
+            self._changed = True
+
+    def check_workers(self):
+        now = monotonic()
+        for shard, worker in enumerate(self._workers):
+            if worker.is_alive():
+                continue
+            if self._restart_at[shard] is None:
+                if now - self._started_at[shard] > self._max_restart_backoff:
+                    # It ran for a good while, so this is not a restart loop
+                    self._backoff[shard] = self._restart_backoff
+                self._restart_at[shard] = now + self._backoff[shard]
+                logging.error(f"Shard {shard} stopped with exit code {worker.exitcode}, "
+                              f"restarting it in {self._backoff[shard]}s")
+                self._backoff[shard] = min(self._backoff[shard] * 2, self._max_restart_backoff)
+            elif now >= self._restart_at[shard]:
+                instrumentation.record(instrumentation.SHARD_RESTARTS, 1, shard=shard)
+                self.start(shard)
+
+    def render_exporters(self):
+        for exporter in self._exporters:
+            try:
+                exporter.render()
+            except Exception as error:
+                logging.error('Failed to render the shards:')
+                logging.exception(error)
+
+    def families(self):
+        """
+        Merge the snapshots of the workers and of this process.  A
+        series found in more than one, as the connection pool statistics
+        of a server both shards query, is taken from the first.
+        """
+        own = snapshot()
+        with self._lock:
+            snapshots = [own] + [self._snapshots[shard] for shard in sorted(self._snapshots)]
+        merged = {}
+        seen = {}
+        for families in snapshots:
+            for view_name, description, metric_type, columns, series in families:
+                family = merged.get(view_name)
+                if family is None:
+                    family = merged[view_name] = (view_name, description, metric_type, columns, [])
+                    seen[view_name] = set()
+                elif family[2] != metric_type or family[3] != columns:
+                    logging.warning(f"Skipping a shard's {view_name}, which does not match the other shards")
+                    continue
+                for tag_values, values in series:
+                    if tag_values not in seen[view_name]:
+                        seen[view_name].add(tag_values)
+                        family[4].append((tag_values, values))
+        return list(merged.values())
+
+
+def run_shard(config_file_name, shard, shards, sender):
+    """
+    Run the collection of one shard, in a worker process.
+    """
+    # Imported here, as the main module starts the supervisor
+    from openldap_opencensus_stats.main import run
+
+    # A reload before the configuration is loaded has nothing to do, and must not stop the worker
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    def send_snapshot():
+        try:
+            sender.send(snapshot())
+        except (BrokenPipeError, OSError):
+            logging.error(f"Shard {shard} lost its supervisor, stopping")
+            os._exit(1)
+
+    run(config_file_name, Configuration(config_file_name, shard=(shard, shards)), on_collected=send_snapshot)
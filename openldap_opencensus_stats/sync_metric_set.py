@@ -1,10 +1,15 @@
 import logging
-from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
 
 from opencensus.stats import stats
 from opencensus.tags import tag_map, tag_key, tag_value
 
+from openldap_opencensus_stats import instrumentation
+from openldap_opencensus_stats.csn import WatermarkHistory, parse_csn
 from openldap_opencensus_stats.ldap_sync_statistic import LdapSyncStatistic
+from openldap_opencensus_stats.sync_stream import SyncStream
 
 
 class SyncMetricSet:
@@ -22,11 +27,41 @@ class SyncMetricSet:
     * Have floating point values representing the number of seconds
       that the latest timestamp of their tree differs from the
       timestamp of the most recent change among the entire cluster
+
+    The servers are sampled concurrently, and each request is timed.
+    A server sampled later than another may already hold changes made
+    after the other was sampled, which would show as lag, so each
+    offset is reduced by how much later the server holding the most
+    recent change was sampled.  The duration of each sample, and the
+    spread of the sampling times across the cluster, are recorded as
+    'sync/{servername}/sample_duration' and 'sync/skew'.
+
+    The last `history` watermarks of each rid on each reported server
+    are kept, and the trend of its offset is fitted to them.  It is
+    recorded as 'sync/{servername}/catch_up_rate' while the offset
+    shrinks and 'sync/{servername}/lag_growth_rate' while it grows, in
+    seconds per second, with 'sync/{servername}/time_to_converge' while
+    the server catches up.
+
+    With `subsamples`, the offsets are sampled that many times a period,
+    so that a distribution aggregator records the lag between
+    collections too.
+
+    With `stream`, each server's contextCSN is followed over a
+    syncrepl session instead of being polled, and the offsets are
+    recorded as soon as a change reaches each server.  Collections
+    then only record the offsets again from the latest watermarks.
     """
     def __init__(self,
                  base_dn=None,
                  ldap_servers=None,
-                 report_servers=None):
+                 report_servers=None,
+                 period=None,
+                 stream=False,
+                 history=30,
+                 aggregator=None,
+                 buckets=None,
+                 subsamples=1):
         if not base_dn:
             logging.error('INTERNAL: Sync metric set created without the base DN')
             raise ValueError('INTERNAL: Sync metric set created without the base DN')
@@ -37,7 +72,20 @@ class SyncMetricSet:
         if not report_servers:
             logging.error('INTERNAL: Sync metric set created without any reporting LDAP servers')
             raise ValueError('INTERNAL: Sync metric set created without any reporting LDAP servers')
+        if history is None or history < 2:
+            logging.error(f"The sync history needs at least 2 watermarks, not {history}")
+            raise ValueError(f"The sync history needs at least 2 watermarks, not {history}")
+        if subsamples is None or subsamples < 1:
+            logging.error(f"The sync offsets need at least 1 sample a period, not {subsamples}")
+            raise ValueError(f"The sync offsets need at least 1 sample a period, not {subsamples}")
+        if subsamples > 1 and (stream or not period):
+            logging.error('Sub-sampling the sync offsets needs a period, and does not apply to a stream')
+            raise ValueError('Sub-sampling the sync offsets needs a period, and does not apply to a stream')
         self.timestamp_attribute = 'contextCSN'
+        self.period = period
+        self.stream = stream
+        self.subsamples = subsamples
+        self._subsample_timers = []
 
         self._statistics = {}
         for ldap_server in ldap_servers:
@@ -46,46 +94,212 @@ class SyncMetricSet:
                 name=f'sync/{ldap_server.database}/offset',
                 description='Offset in seconds from the most recent update',
                 unit='s',
-                report=report
+                report=report,
+                aggregator=aggregator,
+                buckets=buckets
             )
 
+        self._trend_statistics = dict(
+            (ldap_server, (
+                LdapSyncStatistic(
+                    name=f'sync/{ldap_server.database}/catch_up_rate',
+                    description='Seconds of offset recovered per second',
+                    unit='1'
+                ),
+                LdapSyncStatistic(
+                    name=f'sync/{ldap_server.database}/lag_growth_rate',
+                    description='Seconds of offset gained per second',
+                    unit='1'
+                ),
+                LdapSyncStatistic(
+                    name=f'sync/{ldap_server.database}/time_to_converge',
+                    description='Seconds until the offset is recovered at the current catch up rate',
+                    unit='s'
+                ),
+            ))
+            for ldap_server in ldap_servers
+            if ldap_server.database in report_servers
+        )
+        # The watermark history of each rid on each reported server, by (database, rid)
+        self._history_size = history
+        self._histories = {}
+
+        self._sample_durations = dict(
+            (ldap_server, LdapSyncStatistic(
+                name=f'sync/{ldap_server.database}/sample_duration',
+                description='Time taken to read the contextCSN',
+                unit='s',
+                tag_keys=['BaseDN']
+            ))
+            for ldap_server in ldap_servers
+        )
+        self._skew = LdapSyncStatistic(
+            name='sync/skew',
+            description='Time between the first and last contextCSN samples of a collection',
+            unit='s',
+            tag_keys=['BaseDN']
+        )
+        self._executor = None
+        if not stream:
+            self._executor = ThreadPoolExecutor(max_workers=len(ldap_servers), thread_name_prefix='sync-sample')
+
+        # The latest timestamp of each rid on each server, in microseconds: {rid: {database: timestamp}}
+        self._watermarks = {}
+        self._lock = threading.Lock()
+        self._streams = []
+        if stream:
+            self._streams = [
+                SyncStream(ldap_server, base_dn, self.update_watermarks)
+                for ldap_server in ldap_servers
+            ]
+
+    def collection_key(self):
+        # The cluster servers are queried together, so the set is its own group
+        return self
+
+    def display_name(self):
+        return f"sync:{self._base_dn}"
+
     def collect(self):
+        with instrumentation.timed(instrumentation.COLLECTION_DURATION, database=self.display_name()):
+            if self.stream:
+                for stream in self._streams:
+                    stream.start()
+                with self._lock:
+                    watermarks = dict((rid, dict(timestamps)) for rid, timestamps in self._watermarks.items())
+                self.record_offsets(watermarks)
+            else:
+                self.collect_offsets()
+                self.schedule_subsamples()
+
+    def schedule_subsamples(self):
+        """
+        Sample the offsets `subsamples - 1` more times, evenly spread
+        over the period, so a distribution aggregator sees the lag
+        between collections.
+        """
+        self._subsample_timers = [timer for timer in self._subsample_timers if timer.is_alive()]
+        for index in range(1, self.subsamples):
+            timer = threading.Timer(self.period * index / self.subsamples, self.subsample)
+            timer.daemon = True
+            timer.start()
+            self._subsample_timers.append(timer)
+
+    def subsample(self):
+        try:
+            self.collect_offsets()
+        except Exception as error:
+            logging.error(f"Failed to sample {self.display_name()}:")
+            logging.exception(error)
+
+    def stop(self):
+        for timer in self._subsample_timers:
+            timer.cancel()
+        for stream in self._streams:
+            stream.stop()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def collect_offsets(self):
         # Main Processing
         #################################################
+        ldap_servers = list(self._statistics.keys())
+        samples = dict(zip(ldap_servers, self._executor.map(self.sample, ldap_servers)))
+
         watermarks = {}
-        for ldap_server in self._statistics.keys():
-            result = ldap_server.query_dn_and_attribute(
-                dn=self._base_dn,
-                attribute=self.timestamp_attribute
+        sampled_at = {}
+        mmap = stats.stats.stats_recorder.new_measurement_map()
+        for ldap_server, (result, sent, received) in samples.items():
+            self._sample_durations[ldap_server].collect(
+                ldap_server=ldap_server,
+                measurement_map=mmap,
+                offset=received - sent
             )
             if (result):
+                sampled_at[ldap_server.database] = (sent + received) / 2
                 # Record the timestamp from each contextCSN returned
                 for value in result:
-                    result_str = value.decode('utf-8')
-                    segments = result_str.split('#')
-                    rid = str(int(segments[2], 16))  # The rid is the third segment, in hex
-                    if (rid in watermarks):
-                        watermarks[rid].update({ldap_server.database: datetime.strptime(
-                            segments[0], '%Y%m%d%H%M%S.%fZ'
-                        )})
-                    else:
-                        watermarks[rid] = {ldap_server.database: datetime.strptime(
-                            segments[0], '%Y%m%d%H%M%S.%fZ'
-                        )}
+                    csn = parse_csn(value)
+                    watermarks.setdefault(csn.rid, {})[ldap_server.database] = csn.time
+        if sampled_at:
+            self._skew.collect(
+                measurement_map=mmap,
+                offset=max(sampled_at.values()) - min(sampled_at.values())
+            )
+        tmap = tag_map.TagMap()
+        tmap.insert(
+            tag_key.TagKey('BaseDN'),
+            tag_value.TagValue(self._base_dn)
+        )
+        instrumentation.record_measurements(mmap, tmap)
+        self.record_offsets(watermarks, sampled_at)
 
+    def sample(self, ldap_server):
+        """
+        Read the contextCSN of one server, and return it with the times
+        the request was sent and the reply received.
+        """
+        sent = monotonic()
+        result = ldap_server.query_dn_and_attribute(
+            dn=self._base_dn,
+            attribute=self.timestamp_attribute
+        )
+        return result, sent, monotonic()
+
+    def update_watermarks(self, ldap_server, csns):
+        """
+        Take in the CSNs a sync stream received from a server, and
+        record the offsets of the rids which changed.
+        """
+        changed = {}
+        with self._lock:
+            for value in csns:
+                csn = parse_csn(value)
+                timestamps = self._watermarks.setdefault(csn.rid, {})
+                if timestamps.get(ldap_server.database) != csn.time:
+                    timestamps[ldap_server.database] = csn.time
+                    changed[csn.rid] = dict(timestamps)
+        if changed:
+            self.record_offsets(changed)
+
+    def record_offsets(self, watermarks, sampled_at=None):
+        """
+        Record the offset of each server from the most recent change of
+        each rid.  `sampled_at` gives the time each server was sampled,
+        to correct the offsets for the sampling skew.
+        """
+        now = monotonic()
         for rid in watermarks.keys():
             mmap = stats.stats.stats_recorder.new_measurement_map()
 
             high_water_mark = max(watermarks[rid].values())
+            if sampled_at:
+                # The server which held the most recent change soonest
+                newest_sampled_at = min(
+                    sampled_at[database]
+                    for database, watermark in watermarks[rid].items()
+                    if watermark == high_water_mark
+                )
             for ldap_server, stat in self._statistics.items():
                 if (ldap_server.database in watermarks[rid]) and (stat.report):
                     this_watermark = watermarks[rid][ldap_server.database]
-                    offset = (high_water_mark - this_watermark).total_seconds()
+                    offset = (high_water_mark - this_watermark) / 1000000
+                    if sampled_at:
+                        skew = max(newest_sampled_at - sampled_at[ldap_server.database], 0)
+                        offset = max(offset - skew, 0)
                     stat.collect(
                         ldap_server=ldap_server,
                         measurement_map=mmap,
                         offset=offset
                     )
+                    self.collect_trend(
+                        ldap_server,
+                        rid,
+                        sampled_at[ldap_server.database] if sampled_at else now,
+                        this_watermark,
+                        offset,
+                        mmap
+                    )
             # Record/Publish the data
             tmap = tag_map.TagMap()
             tmap.insert(
@@ -96,4 +310,24 @@ class SyncMetricSet:
                 tag_key.TagKey('rid'),
                 tag_value.TagValue(rid)
             )
-            mmap.record(tmap)
+            instrumentation.record_measurements(mmap, tmap)
+
+    def collect_trend(self, ldap_server, rid, sampled_at, watermark, offset, measurement_map):
+        with self._lock:
+            history = self._histories.get((ldap_server.database, rid))
+            if history is None:
+                history = WatermarkHistory(self._history_size)
+                self._histories[(ldap_server.database, rid)] = history
+            history.add(sampled_at, watermark, offset)
+            rate = history.offset_rate()
+        if rate is None:
+            return
+
+        # OpenCensus refuses negative values, so the trend is split in two
+        catch_up_rate, lag_growth_rate, time_to_converge = self._trend_statistics[ldap_server]
+        catch_up_rate.collect(ldap_server=ldap_server, measurement_map=measurement_map, offset=max(-rate, 0))
+        lag_growth_rate.collect(ldap_server=ldap_server, measurement_map=measurement_map, offset=max(rate, 0))
+        if not offset:
+            time_to_converge.collect(ldap_server=ldap_server, measurement_map=measurement_map, offset=0)
+        elif rate < 0:
+            time_to_converge.collect(ldap_server=ldap_server, measurement_map=measurement_map, offset=offset / -rate)
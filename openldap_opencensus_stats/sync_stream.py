@@ -0,0 +1,142 @@
+import logging
+import re
+import threading
+
+import ldap
+import ldap.ldapobject
+import ldap.syncrepl
+
+# The replica ID this exporter gives itself in the cookies it sends
+COOKIE_RID = '000'
+
+
+class SyncreplWatcher(ldap.ldapobject.ReconnectLDAPObject, ldap.syncrepl.SyncreplConsumer):
+    """
+    A syncrepl consumer which only follows the sync cookie.  The CSNs
+    in the cookie are the provider's contextCSN, and a new cookie comes
+    with every change, so the entries themselves are not kept.
+    """
+    def __init__(self, uri, **kwargs):
+        super().__init__(uri, **kwargs)
+        self.cookie = None
+        self.on_cookie = None
+
+    def syncrepl_get_cookie(self):
+        return self.cookie
+
+    def syncrepl_set_cookie(self, cookie):
+        self.cookie = cookie
+        if self.on_cookie is not None:
+            self.on_cookie(cookie)
+
+    def syncrepl_entry(self, dn, attrs, uuid):
+        pass
+
+    def syncrepl_delete(self, uuids):
+        pass
+
+    def syncrepl_present(self, uuids, refreshDeletes=False):
+        pass
+
+    def syncrepl_refreshdone(self):
+        pass
+
+
+class SyncStream:
+    """
+    Follows the contextCSN of one LDAP server over a long-lived RFC 4533
+    refreshAndPersist session on the base DN, and calls
+    `on_change(ldap_server, csns)` with the server's CSNs as soon as
+    they change.
+
+    The session starts from a cookie built from the contextCSN read
+    when it opens, so the refresh phase only sends the changes made
+    since, and no attributes are requested for the changed entries.
+    When the session fails it is reopened after a backoff, doubling up
+    to `max_backoff` seconds.
+    """
+    def __init__(self, ldap_server, base_dn, on_change, poll_interval=1, max_backoff=60):
+        self._ldap_server = ldap_server
+        self._base_dn = base_dn
+        self._on_change = on_change
+        self._poll_interval = poll_interval
+        self._max_backoff = max_backoff
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self.run,
+            name=f"sync:{self._base_dn}:{self._ldap_server.database}",
+            daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        backoff = 1
+        while not self._stopped.is_set():
+            try:
+                self.follow()
+                backoff = 1
+            except ldap.LDAPError as error:
+                self._ldap_server.report_error(
+                    error,
+                    f"The sync stream of {self._base_dn} on {self._ldap_server.database} failed:"
+                )
+                self._stopped.wait(backoff)
+                backoff = min(backoff * 2, self._max_backoff)
+
+    def follow(self):
+        connection = self._ldap_server.open_connection(ldap_class=SyncreplWatcher)
+        try:
+            watcher = connection.connection
+            result = watcher.search_s(self._base_dn, ldap.SCOPE_BASE, attrlist=['contextCSN'])
+            csns = [
+                value.decode('utf-8')
+                for result_dn, attributes in result
+                for value in attributes.get('contextCSN', [])
+            ]
+            self._on_change(self._ldap_server, csns)
+            watcher.cookie = f"rid={COOKIE_RID},csn={';'.join(csns)}" if csns else None
+            watcher.on_cookie = self.cookie_changed
+            msgid = watcher.syncrepl_search(
+                self._base_dn,
+                ldap.SCOPE_SUBTREE,
+                mode='refreshAndPersist',
+                attrlist=['1.1']
+            )
+            logging.info(f"Following the changes to {self._base_dn} on {self._ldap_server.database}")
+            while not self._stopped.is_set():
+                try:
+                    if not watcher.syncrepl_poll(msgid=msgid, timeout=self._poll_interval):
+                        logging.warning(f"The sync stream of {self._base_dn} on {self._ldap_server.database} "
+                                        f"was ended by the server")
+                        self._stopped.wait(self._poll_interval)
+                        return
+                except ldap.TIMEOUT:
+                    continue
+        finally:
+            connection.close()
+
+    def cookie_changed(self, cookie):
+        csns = cookie_csns(cookie)
+        if csns:
+            self._on_change(self._ldap_server, csns)
+
+
+def cookie_csns(cookie):
+    """
+    Return the CSNs of a sync cookie, such as
+    `rid=001,sid=001,csn=20230101120000.000000Z#000000#001#000000`.
+    """
+    if isinstance(cookie, bytes):
+        cookie = cookie.decode('utf-8')
+    match = re.search(r'(?:^|,)csn=([^,]*)', cookie or '')
+    if not match:
+        return []
+    return [csn for csn in match.group(1).split(';') if csn]
@@ -0,0 +1,226 @@
+import gzip
+import logging
+import math
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from opencensus.stats import aggregation_data, stats
+
+from openldap_opencensus_stats import instrumentation
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class PrometheusTextExporter:
+    """
+    Serves the statistics in the Prometheus text format, without the
+    OpenCensus Prometheus exporter.
+
+    The payload is rendered once per collection cycle, by `render()`,
+    into a byte buffer which is also compressed ahead of time, and
+    every scrape is served the buffer as it is.  Scrapes therefore cost
+    the same however often, and by however many Prometheus servers,
+    they arrive.  The metrics are named as the OpenCensus exporter
+    names them, so either may be used with the same dashboards.
+
+    With a `scrape_trigger`, a scrape first asks it for a collection,
+    as the OpenCensus exporter does in pull mode.  With `families`, the
+    statistics are taken from it rather than from the views of this
+    process, as the supervisor of the shards does.
+    """
+    def __init__(self, namespace='openldap', port=8000, address='0.0.0.0', compress=True):
+        if not namespace:
+            logging.error('The PrometheusText exporter needs a namespace')
+            raise ValueError('The PrometheusText exporter needs a namespace')
+        self.namespace = namespace
+        self.port = port
+        self.address = address
+        self.compress = compress
+        self.scrape_trigger = None
+        self.families = None
+        self._payload = b''
+        self._compressed_payload = gzip.compress(b'') if compress else None
+        self._render_lock = threading.Lock()
+        self._server = None
+
+    def render(self):
+        """
+        Render the statistics recorded so far into the payload served
+        to the scrapes.
+        """
+        with self._render_lock:
+            payload = render_text(self.namespace, families=self.families() if self.families else None)
+            compressed_payload = gzip.compress(payload, compresslevel=6) if self.compress else None
+            # Replaced together, so a scrape never sees half of a cycle
+            self._payload, self._compressed_payload = payload, compressed_payload
+
+    def payload(self, accept_encoding=''):
+        """
+        Return the payload for a scrape, and the encoding it is in.
+        """
+        if self.scrape_trigger is not None:
+            self.scrape_trigger.refresh()
+        compressed_payload = self._compressed_payload
+        if compressed_payload is not None and 'gzip' in (accept_encoding or ''):
+            return compressed_payload, 'gzip'
+        return self._payload, None
+
+    def serve_http(self):
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body, encoding = exporter.payload(self.headers.get('Accept-Encoding'))
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                if encoding:
+                    self.send_header('Content-Encoding', encoding)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(f"Scrape from {self.address_string()}: {format % args}")
+
+        self._server = ThreadingHTTPServer((str(self.address), int(self.port)), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='prometheus-text', daemon=True).start()
+
+
+def render_text(namespace, timestamp=None, families=None):
+    """
+    Render every view, or the `families` of a snapshot, in the
+    Prometheus text format, with each sample stamped with `timestamp`,
+    in milliseconds, if one is given.
+    """
+    suffix = f" {timestamp}" if timestamp is not None else ''
+    lines = []
+    for view_name, description, metric_type, columns, series in sorted(
+            snapshot() if families is None else families, key=lambda family: family[0]):
+        name = sanitize(f"{namespace}_{view_name}")
+        if metric_type == 'counter':
+            name += '_total'
+        columns = [sanitize(column) for column in columns]
+        lines.append(f"# HELP {name} {escape_help(description)}")
+        lines.append(f"# TYPE {name} {metric_type}")
+        for tag_values, data in series:
+            labels = [f'{column}="{escape_label(value)}"' for column, value in zip(columns, tag_values)]
+            lines.extend(sample + suffix for sample in render_samples(name, metric_type, labels, data))
+    return ('\n'.join(lines) + '\n').encode('utf-8') if lines else b''
+
+
+def merge_text(payloads):
+    """
+    Merge payloads rendered by `render_text`, such as those of the
+    cycles in a push batch, into one, with the samples of each metric
+    under a single HELP and TYPE, as the text format expects.
+    """
+    families = {}
+    for payload in payloads:
+        family = None
+        for line in payload.decode('utf-8').splitlines():
+            if line.startswith('# HELP '):
+                name = line.split(' ', 3)[2]
+                family = families.get(name)
+                if family is None:
+                    family = families[name] = ([line], [])
+            elif line.startswith('# TYPE '):
+                if len(family[0]) < 2:
+                    family[0].append(line)
+            else:
+                family[1].append(line)
+    lines = [line for headers, samples in families.values() for line in headers + samples]
+    return ('\n'.join(lines) + '\n').encode('utf-8') if lines else b''
+
+
+def snapshot():
+    """
+    Copy the data of every view, as plain values, while no collector
+    records into it: a list of the name, description, type, tag keys
+    and series of each view with data.
+    """
+    families = []
+    # The live view data is read, to save OpenCensus copying each view in full
+    view_data_lists = stats.stats.view_manager.measure_to_view_map._measure_to_view_data_list_map
+    with instrumentation.record_lock:
+        for view_data_list in list(view_data_lists.values()):
+            for view_data in view_data_list:
+                series = [
+                    (tuple(str(value or '') for value in tag_values), data_values(data))
+                    for tag_values, data in view_data.tag_value_aggregation_data_map.items()
+                ]
+                if not series:
+                    continue
+                families.append((
+                    view_data.view.name,
+                    view_data.view.description,
+                    series[0][1][0],
+                    [str(column) for column in view_data.view.columns],
+                    series
+                ))
+    return families
+
+
+def data_values(data):
+    """
+    The values of an aggregation, as a tuple led by its kind.
+    """
+    if isinstance(data, aggregation_data.DistributionAggregationData):
+        return 'histogram', list(data.bounds), list(data.counts_per_bucket), data.count_data, data.sum
+    if isinstance(data, aggregation_data.CountAggregationData):
+        return 'counter', data.count_data
+    if isinstance(data, aggregation_data.LastValueAggregationData):
+        return 'gauge', data.value
+    if isinstance(data, aggregation_data.SumAggregationData):
+        return 'untyped', data.sum_data
+    logging.error(f"Unsupported aggregation type {type(data).__name__}")
+    raise ValueError(f"Unsupported aggregation type {type(data).__name__}")
+
+
+def render_samples(name, metric_type, labels, values):
+    if metric_type != 'histogram':
+        yield f"{name}{format_labels(labels)} {format_value(values[1])}"
+        return
+    _, bounds, counts, count, total = values
+    cumulative = 0
+    for bound, bucket_count in zip(bounds, counts):
+        cumulative += bucket_count
+        bucket_labels = labels + ['le="' + format_value(bound) + '"']
+        yield f"{name}_bucket{format_labels(bucket_labels)} {format_value(cumulative)}"
+    bucket_labels = labels + ['le="+Inf"']
+    yield f"{name}_bucket{format_labels(bucket_labels)} {format_value(count)}"
+    yield f"{name}_count{format_labels(labels)} {format_value(count)}"
+    yield f"{name}_sum{format_labels(labels)} {format_value(total)}"
+
+
+def format_labels(labels):
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+def format_value(value):
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+def escape_help(text):
+    return (text or '').replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def escape_label(value):
+    return str(value or '').replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+_NOT_WORD = re.compile(r'[^\w]')
+
+
+def sanitize(key):
+    """
+    Replace every character other than letters, digits and the
+    underscore with an underscore, as the OpenCensus exporter does.
+    """
+    return _NOT_WORD.sub('_', key)
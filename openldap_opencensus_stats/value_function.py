@@ -0,0 +1,136 @@
+import ast
+import logging
+from functools import lru_cache
+
+# Names usable in a value function, besides `value` itself
+VALUE_FUNCTION_NAMES = {
+    'min': min,
+    'max': max,
+    'abs': abs,
+    'round': round,
+    # Sizes
+    'KB': 1000,
+    'MB': 1000 ** 2,
+    'GB': 1000 ** 3,
+    'KiB': 1024,
+    'MiB': 1024 ** 2,
+    'GiB': 1024 ** 3,
+    # Durations, in seconds
+    'ms': 1e-3,
+    'us': 1e-6,
+    'minute': 60,
+    'hour': 3600,
+    'day': 86400,
+}
+
+# The largest exponent of `**`, so a power cannot stall the collection
+MAX_EXPONENT = 64
+
+ALLOWED_NODES = (
+    ast.Expression,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.Call,
+    ast.Name,
+    ast.Load,
+    ast.Constant,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.FloorDiv,
+    ast.Mod,
+    ast.Pow,
+    ast.UAdd,
+    ast.USub,
+)
+
+
+class ValueFunction:
+    """
+    A compiled `func` expression from the configuration.
+
+    The expression is parsed and checked once, when the configuration
+    is read.  Only arithmetic on `value` and numbers is accepted, along
+    with the functions and unit constants in `VALUE_FUNCTION_NAMES`, so
+    the configuration cannot run arbitrary code.  The expression is
+    compiled into a plain function for single values, and into a list
+    comprehension which applies it to many values at once.
+    """
+    def __init__(self, expression):
+        self.expression = expression
+        parse_value_function(expression)
+        # The expression was checked, so its own text is compiled; the newline ends any comment
+        source = f"({expression.strip()}\n)"
+        namespace = dict(VALUE_FUNCTION_NAMES, __builtins__={})
+        self._function = eval(compile(f"lambda value: {source}", f"<func {expression}>", 'eval'), namespace)
+        self._batch_function = eval(
+            compile(f"lambda values: [{source} for value in values]", f"<func {expression}>", 'eval'),
+            namespace
+        )
+
+    def __call__(self, value):
+        return self._function(value)
+
+    def apply_many(self, values):
+        return self._batch_function(values)
+
+
+def parse_value_function(expression):
+    if not isinstance(expression, str) or not expression.strip():
+        logging.error(f"A value function must be a non-empty expression, not {expression!r}")
+        raise ValueError(f"A value function must be a non-empty expression, not {expression!r}")
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError as error:
+        logging.error(f"Could not parse the value function {expression!r}: {error.msg}")
+        raise ValueError(f"Could not parse the value function {expression!r}: {error.msg}")
+
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            logging.error(f"The value function {expression!r} uses unsupported syntax: {type(node).__name__}")
+            raise ValueError(f"The value function {expression!r} uses unsupported syntax: {type(node).__name__}")
+        if isinstance(node, ast.Name) and node.id != 'value' and node.id not in VALUE_FUNCTION_NAMES:
+            logging.error(f"The value function {expression!r} uses an unknown name: {node.id}")
+            raise ValueError(f"The value function {expression!r} uses an unknown name: {node.id}")
+        if isinstance(node, ast.Constant) and (isinstance(node.value, bool) or
+                                               not isinstance(node.value, (int, float))):
+            logging.error(f"The value function {expression!r} uses a constant which is not a number")
+            raise ValueError(f"The value function {expression!r} uses a constant which is not a number")
+        if isinstance(node, ast.Call) and (node.keywords or not isinstance(node.func, ast.Name) or
+                                           not callable(VALUE_FUNCTION_NAMES.get(node.func.id))):
+            logging.error(f"The value function {expression!r} calls something other than "
+                          f"{', '.join(name for name, item in VALUE_FUNCTION_NAMES.items() if callable(item))}")
+            raise ValueError(f"The value function {expression!r} calls something other than "
+                             f"{', '.join(name for name, item in VALUE_FUNCTION_NAMES.items() if callable(item))}")
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Pow):
+            check_power(expression, node)
+    return tree
+
+
+def check_power(expression, node):
+    """
+    Only accept a power of a number no greater than `MAX_EXPONENT`, of
+    a base which is not itself a power, as a power of integers can take
+    all but forever to compute.
+    """
+    exponent = node.right
+    if isinstance(exponent, ast.UnaryOp):
+        exponent = exponent.operand
+    if not isinstance(exponent, ast.Constant) or abs(exponent.value) > MAX_EXPONENT:
+        logging.error(f"The value function {expression!r} raises to a power other than a number "
+                      f"up to {MAX_EXPONENT}")
+        raise ValueError(f"The value function {expression!r} raises to a power other than a number "
+                         f"up to {MAX_EXPONENT}")
+    if any(isinstance(child, ast.Pow) for child in ast.walk(node.left)):
+        logging.error(f"The value function {expression!r} raises a power to a power")
+        raise ValueError(f"The value function {expression!r} raises a power to a power")
+
+
+@lru_cache(maxsize=None)
+def compile_value_function(expression='value'):
+    """
+    Return the compiled value function for the expression.  Statistics
+    that share an expression share the compiled function.
+    """
+    return ValueFunction(expression)
@@ -13,12 +13,13 @@ setup(
     author="Mark Donnelly",
     author_email="mark@painless-security.com",
     license='AGPL 3.0',
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*', 'tests', 'tests.*']),
     install_requires=[
         'grpcio==1.47.0',
         'opencensus-ext-stackdriver==0.8.0',
         'opencensus-ext-prometheus',
         'opencensus==0.10.0',
+        'prometheus_client',
         'python-ldap',
         'pyyaml',
     ],
@@ -0,0 +1,126 @@
+import ldap.ldapobject
+import pytest
+import yaml
+
+from benchmarks.collection import benchmark_configuration
+from benchmarks.fake_ldap import FakeLDAPObject, monitor_tree, SYNC_BASE_DN
+from openldap_opencensus_stats.configuration import Configuration
+from openldap_opencensus_stats.ldap_server import LdapServerPool
+
+
+class Tree(dict):
+    """
+    A monitor tree whose changes are seen by the connections made to it.
+    """
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.connections = []
+
+    def connect(self, uri):
+        connection = FakeLDAPObject(uri, tree=self)
+        self.connections.append(connection)
+        return connection
+
+    def changed(self):
+        for connection in self.connections:
+            connection.__init__(connection.uri, tree=self)
+
+
+@pytest.fixture
+def tree(monkeypatch):
+    tree = Tree(monitor_tree(entries=0, databases=2))
+    monkeypatch.setattr(LdapServerPool, '_ldap_servers', {})
+    monkeypatch.setattr(ldap.ldapobject, 'ReconnectLDAPObject', tree.connect)
+    return tree
+
+
+@pytest.fixture
+def config_file(tmp_path):
+    config_file = tmp_path / 'config.yml'
+
+    def write(configuration):
+        config_file.write_text(yaml.safe_dump(configuration))
+        return str(config_file)
+    return write
+
+
+def test_reload_only_rebuilds_what_changed(tree, config_file):
+    configuration_dict = benchmark_configuration(2)
+    configuration = Configuration(config_file(configuration_dict))
+    server_metric_sets = dict(configuration._server_metric_sets)
+    sync_metric_set = configuration._sync_metric_sets[SYNC_BASE_DN]
+
+    # Unchanged, everything is kept
+    configuration.reconfigure()
+    assert configuration._server_metric_sets == server_metric_sets
+    assert configuration._sync_metric_sets[SYNC_BASE_DN] is sync_metric_set
+
+    configuration_dict['ldapServers'][1]['connection']['timeout'] = 10
+    config_file(configuration_dict)
+    configuration.reconfigure()
+    assert configuration._server_metric_sets['ldap1'] is server_metric_sets['ldap1']
+    assert configuration._server_metric_sets['ldap2'] is not server_metric_sets['ldap2']
+    # The sync entry reads the changed server
+    assert configuration._sync_metric_sets[SYNC_BASE_DN] is not sync_metric_set
+
+
+def test_reload_retires_removed_servers(tree, config_file):
+    configuration_dict = benchmark_configuration(2)
+    configuration = Configuration(config_file(configuration_dict))
+    kept = configuration._server_metric_sets['ldap1']
+    retired = set(configuration._server_metric_sets['ldap2'].metric_sets())
+    assert retired.issubset(configuration.metric_sets())
+
+    del configuration_dict['ldapServers'][1]
+    del configuration_dict['sync']
+    config_file(configuration_dict)
+    configuration.reconfigure()
+    assert list(configuration._server_metric_sets) == ['ldap1']
+    assert configuration._server_metric_sets['ldap1'] is kept
+    assert configuration._sync_metric_sets == {}
+    assert retired.isdisjoint(configuration.metric_sets())
+    assert set(configuration.metric_sets()) == set(kept.metric_sets())
+
+
+def test_rediscover_adds_and_retires_children(tree, config_file):
+    configuration = Configuration(config_file(benchmark_configuration(1)))
+
+    def databases():
+        return set(
+            definition.dn
+            for definition in configuration._server_metric_sets['ldap1']._statistics
+            if 'Database' in definition.dn
+        )
+    before = databases()
+    tree['cn=Database 2,cn=Databases,cn=Monitor'] = dict(tree['cn=Database 1,cn=Databases,cn=Monitor'])
+    del tree['cn=Database 0,cn=Databases,cn=Monitor']
+    tree.changed()
+    configuration.rediscover()
+    after = databases()
+    assert any('Database 0' in dn for dn in before)
+    assert not any('Database 0' in dn for dn in after)
+    assert any('Database 2' in dn for dn in after)
+
+
+def test_rediscover_skips_the_metric_sets_rebuilt_meanwhile(tree, config_file):
+    configuration_dict = benchmark_configuration(1)
+    configuration = Configuration(config_file(configuration_dict))
+    stale = configuration._server_metric_sets['ldap1']
+    search = stale.rediscover
+
+    def search_during_a_reload():
+        changes = search()
+        configuration_dict['ldapServers'][0]['connection']['timeout'] = 10
+        config_file(configuration_dict)
+        configuration.reconfigure()
+        return changes
+    stale.rediscover = search_during_a_reload
+
+    tree['cn=Database 2,cn=Databases,cn=Monitor'] = dict(tree['cn=Database 1,cn=Databases,cn=Monitor'])
+    tree.changed()
+    configuration.rediscover()
+    rebuilt = configuration._server_metric_sets['ldap1']
+    assert rebuilt is not stale
+    assert not any('Database 2' in definition.dn for definition in stale._statistics)
+    assert any('Database 2' in definition.dn for definition in rebuilt._statistics)
+    assert set(rebuilt.metric_sets()).issubset(configuration.metric_sets())
@@ -0,0 +1,64 @@
+import ldap
+
+from openldap_opencensus_stats.discovery import DiscoveryCache
+
+
+class Server:
+    def __init__(self, children):
+        self.database = 'example'
+        self.children = children
+        self.queries = 0
+
+    def query(self, dn, scope, attr_list):
+        self.queries += 1
+        return [(f"cn={child},{dn}", {'cn': [child.encode()]}) for child in self.children]
+
+
+def test_search_is_made_once(tmp_path):
+    server = Server(['a', 'b'])
+    cache = DiscoveryCache(str(tmp_path / 'cache.json'))
+    first = cache.search(server, 'cn=Monitor', attributes=['cn'])
+    second = cache.search(server, 'cn=Monitor', attributes=['cn'])
+    assert first == second == {'cn=a,cn=Monitor': {'cn': ['a']}, 'cn=b,cn=Monitor': {'cn': ['b']}}
+    assert server.queries == 1
+
+
+def test_revalidation_hands_back_changes(tmp_path):
+    file_name = str(tmp_path / 'cache.json')
+    server = Server(['a', 'b'])
+    cache = DiscoveryCache(file_name)
+    cache.search(server, 'cn=Monitor', attributes=['cn'])
+    cache.save()
+
+    server.children = ['a', 'c']
+    restarted = DiscoveryCache(file_name)
+    assert list(restarted.search(server, 'cn=Monitor', attributes=['cn'])) == ['cn=a,cn=Monitor', 'cn=b,cn=Monitor']
+    assert server.queries == 1
+
+    changes = []
+    with restarted._lock:
+        stale = restarted._stale
+        restarted._stale = {}
+    restarted.revalidate(stale, on_changed=changes.append)
+    assert changes == [[('example', ldap.SCOPE_ONELEVEL, 'cn=Monitor')]]
+    assert list(restarted.search(server, 'cn=Monitor', attributes=['cn'])) == ['cn=a,cn=Monitor', 'cn=c,cn=Monitor']
+    assert list(DiscoveryCache(file_name).search(server, 'cn=Monitor', attributes=['cn'])) == \
+        ['cn=a,cn=Monitor', 'cn=c,cn=Monitor']
+
+
+def test_unchanged_revalidation_is_quiet(tmp_path):
+    file_name = str(tmp_path / 'cache.json')
+    server = Server(['a'])
+    cache = DiscoveryCache(file_name)
+    cache.search(server, 'cn=Monitor', attributes=['cn'])
+    cache.save()
+
+    restarted = DiscoveryCache(file_name)
+    restarted.search(server, 'cn=Monitor', attributes=['cn'])
+    changes = []
+    with restarted._lock:
+        stale = restarted._stale
+        restarted._stale = {}
+    restarted.revalidate(stale, on_changed=changes.append)
+    assert changes == []
+    assert server.queries == 2
@@ -0,0 +1,41 @@
+import threading
+
+from opencensus.ext.prometheus import stats_exporter
+from opencensus.stats import stats
+from prometheus_client import CollectorRegistry
+
+from openldap_opencensus_stats import instrumentation
+from openldap_opencensus_stats.configuration import LockedPrometheusCollector
+
+
+def new_collector():
+    instrumentation.register_views()
+    instrumentation.record(instrumentation.BINDS, 1, database='test')
+    collector = LockedPrometheusCollector(
+        options=stats_exporter.Options(namespace='test', registry=CollectorRegistry(auto_describe=True))
+    )
+    binds = stats.stats.view_manager.measure_to_view_map.get_view('exporter/binds', None)
+    return collector, binds
+
+
+def test_prometheus_collector_waits_for_the_record_lock():
+    collector, binds = new_collector()
+    collector.add_view_data(binds)
+    metrics = []
+    with instrumentation.record_lock:
+        reader = threading.Thread(target=lambda: metrics.extend(collector.collect()))
+        reader.start()
+        reader.join(0.2)
+        assert reader.is_alive()
+    reader.join(5)
+    assert {metric.name for metric in metrics} == {'test_exporter_binds'}
+
+
+def test_prometheus_collector_registers_within_a_recording():
+    collector, binds = new_collector()
+    # Views reach the collector from within a recording, which holds the lock
+    registering = threading.Thread(target=collector.add_view_data, args=(binds,))
+    with instrumentation.record_lock:
+        registering.start()
+        registering.join(5)
+        assert not registering.is_alive()
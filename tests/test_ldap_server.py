@@ -0,0 +1,64 @@
+import ldap
+import ldap.controls
+import ldap.ldapobject
+import pytest
+
+from benchmarks.fake_ldap import FakeLDAPObject, monitor_tree, OPERATIONS
+from openldap_opencensus_stats.ldap_server import LdapServer
+
+
+class OnePagedSearch(FakeLDAPObject):
+    """
+    Fails a paged search sent while another is still being paged, as
+    a server keeping the paging state of one search per connection would.
+    """
+    def __init__(self, uri, tree=None):
+        super().__init__(uri, tree=tree)
+        self.paging = None
+        self.sent = []
+
+    def search_ext(self, base, scope, filterstr='(objectClass=*)', attrlist=None, serverctrls=None):
+        msgid = super().search_ext(base, scope, filterstr=filterstr, attrlist=attrlist, serverctrls=serverctrls)
+        self.sent.append(base)
+        if serverctrls:
+            # The next page of the same search is asked for once the last is read
+            assert self.paging is None or self.paging[0] == base, f"{base} was sent while another search was paged"
+            self.paging = (base, msgid)
+        return msgid
+
+    def next_message(self, msgid):
+        result = super().next_message(msgid)
+        result_type, result_data, result_msgid, result_controls = result
+        if result_type == ldap.RES_SEARCH_RESULT and self.paging is not None and msgid == self.paging[1]:
+            if not any(control.cookie for control in result_controls):
+                self.paging = None
+        return result
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    tree = monitor_tree(entries=100)
+    connections = []
+
+    def connect(uri):
+        connections.append(OnePagedSearch(uri, tree=tree))
+        return connections[-1]
+    monkeypatch.setattr(ldap.ldapobject, 'ReconnectLDAPObject', connect)
+    return connections
+
+
+def test_paged_searches_are_sent_one_at_a_time(connections):
+    server = LdapServer('ldap://example.org/', database='example', page_size=2)
+    results = server.query_many([
+        {'dn': 'cn=Operations,cn=Monitor', 'scope': ldap.SCOPE_ONELEVEL},
+        {'dn': 'cn=Monitor', 'scope': ldap.SCOPE_BASE},
+        {'dn': 'cn=Connections,cn=Monitor', 'scope': ldap.SCOPE_ONELEVEL},
+        {'dn': 'cn=Statistics,cn=Monitor', 'scope': ldap.SCOPE_BASE},
+    ])
+    assert len(results[0]) == len(OPERATIONS)
+    assert [dn for dn, attributes in results[1]] == ['cn=Monitor']
+    assert len(results[2]) > 2
+    assert [dn for dn, attributes in results[3]] == ['cn=Statistics,cn=Monitor']
+    connection, = connections
+    # The searches of single entries are still sent ahead
+    assert connection.sent[:3] == ['cn=Monitor', 'cn=Statistics,cn=Monitor', 'cn=Operations,cn=Monitor']
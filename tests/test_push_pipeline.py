@@ -0,0 +1,225 @@
+import os
+import threading
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep
+
+import pytest
+
+from openldap_opencensus_stats import instrumentation, push_pipeline
+from openldap_opencensus_stats.push_pipeline import BATCH_HEADER, HttpSender, PushPipeline, RejectedBatch, Spool
+
+
+class Endpoint:
+    """
+    An HTTP stand-in which answers with the statuses it is given, in
+    turn, and keeps the batches it accepts.
+    """
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.batches = []
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                status = endpoint.statuses.pop(0) if endpoint.statuses else 204
+                if status < 300:
+                    endpoint.batches.append(body)
+                self.send_response(status)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def url(self):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/"
+
+
+@pytest.fixture
+def endpoint():
+    endpoint = Endpoint()
+    yield endpoint
+    endpoint.server.shutdown()
+    endpoint.server.server_close()
+
+
+@pytest.fixture
+def recorded(monkeypatch):
+    recorded = []
+    monkeypatch.setattr(
+        push_pipeline.instrumentation,
+        'record',
+        lambda measure, value, **tags: recorded.append((measure, value))
+    )
+    return recorded
+
+
+def wait_for(condition, timeout=5):
+    deadline = monotonic() + timeout
+    while not condition() and monotonic() < deadline:
+        sleep(0.01)
+    return condition()
+
+
+def count(recorded, measure):
+    return sum(value for recorded_measure, value in recorded if recorded_measure is measure)
+
+
+def test_sender_posts_the_batch(endpoint):
+    HttpSender(endpoint.url(), compressed=False)(b'batch')
+    assert endpoint.batches == [b'batch']
+
+
+def test_sender_tells_rejections_from_failures(endpoint):
+    send = HttpSender(endpoint.url(), compressed=False)
+    endpoint.statuses = [400]
+    with pytest.raises(RejectedBatch):
+        send(b'bad')
+    for status in [429, 503]:
+        endpoint.statuses = [status]
+        with pytest.raises(urllib.error.HTTPError) as error:
+            send(b'later')
+        assert not isinstance(error.value, RejectedBatch)
+    assert endpoint.batches == []
+
+
+def test_sender_raises_when_the_endpoint_is_down(endpoint):
+    url = endpoint.url()
+    endpoint.server.shutdown()
+    endpoint.server.server_close()
+    with pytest.raises(urllib.error.URLError) as error:
+        HttpSender(url, timeout=1)(b'batch')
+    assert not isinstance(error.value, RejectedBatch)
+
+
+def test_spool_replays_oldest_first(tmp_path):
+    spool = Spool(str(tmp_path / 'spool'))
+    for batch in [b'one', b'two', b'three']:
+        assert spool.append(batch)
+    # Kept over a restart
+    spool = Spool(str(tmp_path / 'spool'))
+    assert spool.size() == 3 * BATCH_HEADER.size + len(b'onetwothree')
+    sent = []
+    spool.replay(sent.append)
+    assert sent == [b'one', b'two', b'three']
+    assert spool.size() == 0
+    assert not os.path.exists(tmp_path / 'spool')
+
+
+def test_spool_keeps_what_a_failure_left_unsent(tmp_path):
+    spool = Spool(str(tmp_path / 'spool'))
+    for batch in [b'one', b'two', b'three']:
+        spool.append(batch)
+    sent = []
+
+    def send(batch):
+        if batch == b'two':
+            raise OSError('down')
+        sent.append(batch)
+    with pytest.raises(OSError):
+        spool.replay(send)
+    assert sent == [b'one']
+    assert spool.size() == 2 * BATCH_HEADER.size + len(b'twothree')
+    spool.replay(sent.append)
+    assert sent == [b'one', b'two', b'three']
+
+
+def test_spool_passes_over_rejected_batches(tmp_path):
+    spool = Spool(str(tmp_path / 'spool'))
+    for batch in [b'one', b'bad', b'three']:
+        spool.append(batch)
+    sent, rejected = [], []
+
+    def send(batch):
+        if batch == b'bad':
+            raise RejectedBatch('bad')
+        sent.append(batch)
+    spool.replay(send, rejected=rejected.append)
+    assert sent == [b'one', b'three']
+    assert [str(error) for error in rejected] == ['bad']
+    assert spool.size() == 0
+
+
+def test_spool_drops_a_partial_batch(tmp_path):
+    path = tmp_path / 'spool'
+    path.write_bytes(BATCH_HEADER.pack(3) + b'one' + BATCH_HEADER.pack(10) + b'cut')
+    sent = []
+    Spool(str(path)).replay(sent.append)
+    assert sent == [b'one']
+    assert not path.exists()
+
+
+def test_full_spool_refuses_batches(tmp_path):
+    spool = Spool(str(tmp_path / 'spool'), max_bytes=2 * (BATCH_HEADER.size + 3))
+    assert spool.append(b'one')
+    assert spool.append(b'two')
+    assert not spool.append(b'six')
+    sent = []
+    spool.replay(sent.append)
+    assert sent == [b'one', b'two']
+
+
+def new_pipeline(endpoint, **options):
+    return PushPipeline(
+        HttpSender(endpoint.url(), compressed=False),
+        batch_size=1,
+        batch_interval=0,
+        compress=False,
+        backoff=0.01,
+        max_backoff=0.01,
+        **options
+    )
+
+
+def test_pipeline_drops_a_rejected_batch(endpoint, recorded):
+    endpoint.statuses = [400]
+    pipeline = new_pipeline(endpoint)
+    pipeline.put(b'bad')
+    pipeline.put(b'good')
+    pipeline.close()
+    assert endpoint.batches == [b'good']
+    assert count(recorded, instrumentation.PUSH_DROPPED) == 1
+    assert count(recorded, instrumentation.PUSH_FAILURES) == 0
+    assert count(recorded, instrumentation.PUSH_BATCHES) == 1
+
+
+def test_pipeline_retries_a_transient_failure(endpoint, recorded):
+    endpoint.statuses = [503, 429]
+    pipeline = new_pipeline(endpoint)
+    pipeline.put(b'one')
+    # Closing gives up on retrying
+    assert wait_for(lambda: endpoint.batches)
+    pipeline.close()
+    assert endpoint.batches == [b'one']
+    assert count(recorded, instrumentation.PUSH_FAILURES) == 2
+    assert count(recorded, instrumentation.PUSH_DROPPED) == 0
+
+
+def test_pipeline_replays_past_a_rejected_spooled_batch(endpoint, recorded, tmp_path):
+    spool_file = str(tmp_path / 'spool')
+    spool = Spool(spool_file)
+    spool.append(b'bad')
+    spool.append(b'spooled')
+    endpoint.statuses = [400]
+    pipeline = new_pipeline(endpoint, spool_file=spool_file)
+    pipeline.put(b'new')
+    pipeline.close()
+    assert endpoint.batches == [b'spooled', b'new']
+    assert count(recorded, instrumentation.PUSH_DROPPED) == 1
+    assert pipeline.backlog() == (0, 0)
+    assert not os.path.exists(spool_file)
+
+
+def test_pipeline_spools_while_the_endpoint_is_down(endpoint, recorded, tmp_path):
+    spool_file = str(tmp_path / 'spool')
+    endpoint.statuses = [503]
+    pipeline = new_pipeline(endpoint, spool_file=spool_file, spool_max_bytes=BATCH_HEADER.size + 3)
+    pipeline.put(b'one')
+    pipeline.close()
+    assert endpoint.batches == []
+    assert pipeline.backlog() == (0, BATCH_HEADER.size + 3)
+    assert count(recorded, instrumentation.PUSH_FAILURES) == 1
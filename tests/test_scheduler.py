@@ -0,0 +1,176 @@
+import threading
+
+import pytest
+
+from openldap_opencensus_stats import instrumentation, scheduler
+from openldap_opencensus_stats.collector import CollectionEngine
+from openldap_opencensus_stats.scheduler import Scheduler
+
+
+class MetricSet:
+    def __init__(self, name, period=None, hang=None):
+        self.name = name
+        self.period = period
+        self.hang = hang
+        self.collections = 0
+
+    def collection_key(self):
+        return self.name
+
+    def display_name(self):
+        return self.name
+
+    def collect(self):
+        self.collections += 1
+        if self.hang is not None:
+            self.hang.wait(10)
+
+
+class Engine:
+    """
+    Records what is dispatched, and reports the skipped and overdue
+    metric sets it is told to.
+    """
+    def __init__(self):
+        self.dispatched = []
+        self.skipped = []
+        self.late = []
+
+    def dispatch(self, metric_sets, deadline=None):
+        self.dispatched.append((list(metric_sets), deadline))
+        return [metric_set for metric_set in metric_sets if metric_set in self.skipped]
+
+    def overdue(self):
+        late, self.late = self.late, []
+        return late
+
+
+@pytest.fixture(autouse=True)
+def views():
+    instrumentation.register_views()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(scheduler, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_collections_follow_a_fixed_grid(clock):
+    engine = Engine()
+    fast, slow = MetricSet('fast', period=1), MetricSet('slow', period=3)
+    schedule = Scheduler(engine, period=5, jitter=False)
+    for _ in range(6):
+        schedule.run_once([fast, slow])
+        clock[0] += 1
+    assert [[metric_set.name for metric_set in due] for due, deadline in engine.dispatched] == [
+        ['fast', 'slow'], ['fast'], ['fast'], ['fast', 'slow'], ['fast'], ['fast'],
+    ]
+    # The deadline defaults to the shortest period of those due
+    assert {deadline for due, deadline in engine.dispatched} == {1}
+    assert schedule.overruns == {fast: 0, slow: 0}
+
+
+def test_delay_is_the_time_until_the_next_due(clock):
+    metric_set = MetricSet('one', period=2)
+    schedule = Scheduler(Engine(), period=5, jitter=False)
+    schedule.run_once([metric_set])
+    clock[0] += 0.5
+    assert schedule.delay([metric_set]) == 1.5
+    assert schedule.delay([]) == 5
+
+
+def test_skipped_and_overdue_collections_are_overruns(clock):
+    engine = Engine()
+    hung, healthy = MetricSet('hung', period=1), MetricSet('healthy', period=1)
+    schedule = Scheduler(engine, period=5, jitter=False)
+    schedule.run_once([hung, healthy])
+    engine.late = [hung]
+    engine.skipped = [hung]
+    for _ in range(3):
+        clock[0] += 1
+        schedule.run_once([hung, healthy])
+    # One for missing the deadline, and one for each slot skipped since
+    assert schedule.overruns == {hung: 4, healthy: 0}
+
+
+def test_a_late_loop_skips_the_missed_slots(clock):
+    metric_set = MetricSet('one', period=1)
+    schedule = Scheduler(Engine(), period=5, jitter=False)
+    schedule.run_once([metric_set])
+    clock[0] += 3.5
+    schedule.run_once([metric_set])
+    assert schedule.overruns[metric_set] == 2
+    # Back on the grid anchored at the first collection
+    assert schedule.delay([metric_set]) == 0.5
+
+
+def test_forget_drops_the_retired_metric_sets(clock):
+    kept, retired = MetricSet('kept'), MetricSet('retired')
+    schedule = Scheduler(Engine(), period=1, jitter=False)
+    schedule.run_once([kept, retired])
+    schedule.forget([kept])
+    assert list(schedule.overruns) == [kept]
+    clock[0] += 1
+    schedule.run_once([kept])
+
+
+def test_configure_rejects_a_bad_period():
+    with pytest.raises(ValueError):
+        Scheduler(Engine(), period=0)
+
+
+def test_a_hung_server_does_not_hold_up_the_others():
+    hang = threading.Event()
+    hung, healthy = MetricSet('hung', hang=hang), MetricSet('healthy')
+    cycles = []
+    engine = CollectionEngine(max_workers=2, on_collected=lambda: cycles.append(1))
+    try:
+        assert engine.dispatch([hung, healthy], deadline=0.05) == []
+        assert engine.dispatch([hung, healthy], deadline=0.05) == [hung]
+        threading.Event().wait(0.2)
+        assert engine.overdue() == [hung]
+        # Each is only reported once
+        assert engine.overdue() == []
+        assert healthy.collections == 2
+    finally:
+        hang.set()
+    engine._executor.shutdown(wait=True)
+    assert engine._in_flight == {}
+    assert hung.collections == 1
+    # The cycles with the hung server end once it answers
+    assert len(cycles) == 2
+
+
+def test_collect_waits_for_the_deadline():
+    hang = threading.Event()
+    hung, healthy = MetricSet('hung', hang=hang), MetricSet('healthy')
+    engine = CollectionEngine(max_workers=2)
+    try:
+        assert engine.collect([hung, healthy], deadline=0.05) == [hung]
+        assert engine.collect([hung, healthy], deadline=0.05) == [hung]
+        assert healthy.collections == 2
+    finally:
+        hang.set()
+    engine._executor.shutdown(wait=True)
+    assert engine._in_flight == {}
+
+
+def test_a_reload_while_a_collection_is_hung():
+    hang = threading.Event()
+    hung, healthy = MetricSet('hung', hang=hang), MetricSet('healthy')
+    engine = CollectionEngine(max_workers=2)
+    schedule = Scheduler(engine, period=0.05, deadline=0.05, jitter=False)
+    try:
+        schedule.run_once([hung, healthy])
+        # The reload retires the metric set whose collection is hung
+        schedule.forget([healthy])
+        threading.Event().wait(0.2)
+        schedule.run_once([healthy])
+        assert list(schedule.overruns) == [healthy]
+    finally:
+        hang.set()
+    engine._executor.shutdown(wait=True)
+    assert engine._in_flight == {}
+    assert healthy.collections == 2
@@ -0,0 +1,115 @@
+import pytest
+
+from openldap_opencensus_stats.ldap_summary_statistic import SAMPLE_BATCH, ChildrenSummary, LdapSummaryStatistic
+from openldap_opencensus_stats.value_function import MAX_EXPONENT, ValueFunction, compile_value_function
+
+
+@pytest.mark.parametrize('expression, value, expected', [
+    ('value', 3.0, 3.0),
+    ('value * 64', 2.0, 128.0),
+    ('max(value / MiB, 0) + 1', 2 * 1024 ** 2, 3.0),
+    ('round(value / ms)', 0.25, 250),
+    ('-value ** 2', 3.0, -9.0),
+    ('value ** -0.5', 4.0, 0.5),
+    (f'value ** {MAX_EXPONENT}', 1.0, 1.0),
+    ('value / 1000  # milliseconds', 2000.0, 2.0),
+])
+def test_value_functions(expression, value, expected):
+    function = ValueFunction(expression)
+    assert function(value) == expected
+    assert function.apply_many([value, value]) == [expected, expected]
+
+
+@pytest.mark.parametrize('expression', [
+    '',
+    '   ',
+    None,
+    'value +',
+    'value.real',
+    '__import__("os")',
+    'open("/etc/passwd")',
+    'lambda: value',
+    '[value]',
+    'value if value else 0',
+    'value < 1',
+    '"value"',
+    'True + value',
+    'round(value, ndigits=2)',
+    'unknown * value',
+    'MiB(value)',
+])
+def test_rejected_value_functions(expression):
+    with pytest.raises(ValueError):
+        ValueFunction(expression)
+
+
+@pytest.mark.parametrize('expression', [
+    '9 ** 9 ** 9',
+    'value ** value',
+    f'value ** {MAX_EXPONENT + 1}',
+    f'value ** -{MAX_EXPONENT + 1}',
+    '(value ** 2) ** 2',
+    'value ** max(value, 2)',
+])
+def test_unbounded_powers_are_rejected(expression):
+    with pytest.raises(ValueError):
+        ValueFunction(expression)
+
+
+def test_compiled_functions_are_shared():
+    assert compile_value_function('value * 2') is compile_value_function('value * 2')
+
+
+def test_summary_applies_the_function_in_batches():
+    summary = ChildrenSummary(top=3, value_function=compile_value_function('value * 2'))
+    samples = [float(sample) for sample in range(SAMPLE_BATCH * 2 + 10)]
+    for sample in samples:
+        summary.add_sample(sample)
+    # Only whole batches have gone through the function until it is flushed
+    assert summary.count == SAMPLE_BATCH * 2
+    summary.flush()
+    assert summary.count == len(samples)
+    assert summary.total == sum(samples) * 2
+    assert summary.smallest == 0
+    assert summary.largest == samples[-1] * 2
+    assert sorted(summary.values, reverse=True) == [sample * 2 for sample in samples[-1:-4:-1]]
+
+
+class Server:
+    database = 'test'
+
+
+class MeasurementMap:
+    def __init__(self):
+        self.values = {}
+
+    def measure_float_put(self, measure, value):
+        self.values[measure.name] = value
+
+
+def test_summary_statistic_flushes_its_samples():
+    statistic = LdapSummaryStatistic(
+        dn='cn=Connections,cn=Monitor',
+        name='test/connections/ops',
+        attribute='monitorConnectionOpsReceived',
+        child_pattern='cn=Connection',
+        summarize=['count', 'sum', 'max'],
+        unit='1',
+        value_function='value * 2'
+    )
+    children = [
+        (f'cn=Connection {index},cn=Connections,cn=Monitor', {'monitorConnectionOpsReceived': [str(index).encode()]})
+        for index in range(10)
+    ]
+    children.append(('cn=Current,cn=Connections,cn=Monitor', {'monitorConnectionOpsReceived': [b'1000']}))
+    maps = {}
+    statistic.collect(
+        ldap_server=Server(),
+        measurement_maps=lambda tags: maps.setdefault(tuple(sorted(tags.items())), MeasurementMap()),
+        children=children
+    )
+    assert maps[()].values == {
+        'test/connections/ops/count': 10,
+        'test/connections/ops/sum': 90,
+        'test/connections/ops/max': 18,
+    }